@@ -560,13 +560,9 @@ class AccessModel(ModelData):
         #Replace the null values with zeros (values above upper)
         self.results.fillna(0, inplace=True)
 
-        #Find list within matrix with negative values.
-        #When constructing the matrix with p2p, the negative values (-1) are the edges on the border of the bounding box.
-        list_id=self.time_val2.index[self.time_val2['time'] <0].tolist()
-        for i in list_id:
-            for j in self.results.keys():
-                self.results.at[i,j] = -9999
-        self.results=self.results.replace(-9999, np.nan)
+        #Drop sources that reach no dest (see ModelData.process)
+        self.results = self.results.mask(self.unreachable.reindex(self.results.index,
+            fill_value=False), axis=0)
         
         self.good_to_write = True
         self.logger.info("Finished calculating hssa in {:,.2f} seconds".format(time.time() - start_time))
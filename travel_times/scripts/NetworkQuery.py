@@ -2,6 +2,29 @@ import requests, logging
 import pandas as pd
 from geopy.distance import vincenty
 
+#tag filters for OSM ways of each network type. A way needs a highway
+#tag and must not match any of the (tag, regex) pairs, as in Overpass'
+#["tag"!~"regex"] (ways without the tag pass)
+WAY_FILTERS = {
+    'drive': [('highway', 'cycleway|footway|path|pedestrian|steps|track|proposed|construction|bridleway|abandoned|platform|raceway|service'),
+              ('motor_vehicle', 'no'), ('motorcar', 'no'),
+              ('service', 'parking|parking_aisle|driveway|emergency_access')],
+    'walk': [('highway', 'motor|proposed|construction|abandoned|platform|raceway'),
+             ('foot', 'no'), ('pedestrians', 'no')],
+    'bike': [('highway', 'motor|proposed|construction|abandoned|platform|raceway'),
+             ('bicycle', 'no')]
+}
+WAY_FILTERS['bicycle'] = WAY_FILTERS['bike']
+
+
+def overpass_filter(network_type):
+    '''
+    Return the Overpass way filter string for a network type.
+    '''
+    rules = ''.join('["{}"!~"{}"]'.format(tag, regex) for tag, regex in WAY_FILTERS[network_type])
+
+    return '["highway"]' + rules
+
 
 class Query(object):
     '''
@@ -27,12 +50,8 @@ class Query(object):
         '''
 
         #Choose request parameters based on network type
-        if self.network_type == 'drive':
-            data = '[maxsize:2000000000][out:json][timeout:900];(way["highway"]["highway"!~"cycleway|footway|path|pedestrian|steps|track|proposed|construction|bridleway|abandoned|platform|raceway|service"]["motor_vehicle"!~"no"]["motorcar"!~"no"]["service"!~"parking|parking_aisle|driveway|emergency_access"]({},{},{},{});>;);out;'.format(self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3])
-        elif self.network_type == 'walk':
-            data = '[maxsize:2000000000][out:json][timeout:900];(way["highway"]["highway"!~"motor|proposed|construction|abandoned|platform|raceway"]["foot"!~"no"]["pedestrians"!~"no"]({},{},{},{});>;);out;'.format(self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3])
-        elif self.network_type == 'bicycle' or self.network_type == 'bike':
-            data = '[maxsize:2000000000][out:json][timeout:900];(way["highway"]["highway"!~"motor|proposed|construction|abandoned|platform|raceway"]["bicycle"!~"no"]({},{},{},{});>;);out;'.format(self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3])
+        if self.network_type in WAY_FILTERS:
+            data = '[maxsize:2000000000][out:json][timeout:900];(way{}({},{},{},{});>;);out;'.format(overpass_filter(self.network_type), self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3])
         else:
             self.logger.error('unrecognized network_type: {}'.format(self.network_type))
 
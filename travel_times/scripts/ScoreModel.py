@@ -7,6 +7,7 @@ import matplotlib.patches as mpatches
 from matplotlib import mlab
 import matplotlib as mpl
 from p2p import TransitMatrix
+from p2p_server import matrixClient, SERVER_VARIABLE
 import os.path, csv, math, sys, logging, json, time
 import copy
 
@@ -32,6 +33,7 @@ class ModelData(object):
         self.n_dests_in_range = {}
         self.time = {}
         self.time_val2 = {}
+        self.unreachable = {}
         self.use_n_nearest = 10
 
         self.sources_nn = {}
@@ -131,7 +133,6 @@ class ModelData(object):
         rv = {}
         included_cats = set()
         nearest_cat_template = {}
-        n_dests_in_range_template = {}
         for data in self.dests.itertuples():
             self.dest2cats[data[ID]] = str(data[CAT])
             if str(data[CAT]) in included_cats:
@@ -140,76 +141,67 @@ class ModelData(object):
                 self.cat2dests[str(data[CAT])] = [data[ID]]
                 included_cats.add(data[CAT])
                 nearest_cat_template[data[CAT]] = None
-                n_dests_in_range_template[data[CAT]] = 0
 
 
-        #pre map sources->dests (in range) and dests->sources (in range)
-        already_added_a = set()
-        already_added_b = set()
+        #fetch every source->dest time at once
+        times = self.sp_matrix.get_submatrix(self.source_id_list, self.dest_id_list)
+        source_ids = np.asarray(list(self.source_id_list), dtype=object)
+        dest_ids = np.asarray(list(self.dest_id_list), dtype=object)
+        dest_cats = np.array([self.get_category(dest_id) for dest_id in dest_ids], dtype=object)
+
+        #Specify non negative values in order to disregard epsilon values.
+        reachable = times >= 0
+        #Within upper limit buffer range (default is 30 minutes.)
+        in_range = reachable & (times <= self.upper)
+
+        #closest dest and number of dests in range for each category of every source
         near_nbr = {}
         n_dests_in_range = {}
-        time_val2 = {}
-        time_val={}
-
-        for source_id in self.source_id_list:
-            near_nbr[source_id] = copy.deepcopy(nearest_cat_template)
-            n_dests_in_range[source_id] = copy.deepcopy(n_dests_in_range_template)
-            for dest_id in self.dest_id_list:
-                time_val = self.get_time(source_id, dest_id)
-                cat = self.get_category(dest_id)
-                self.time_val = self.get_time(source_id, dest_id)
-                self.time_val2[source_id] = self.get_time(source_id, dest_id)
-
-                #update the closest dest for each category of this source.
-                #Specify non negative values in order to disregard epsilon values.
-                if time_val>=0:
-                    if near_nbr[source_id][cat] is None:
-                        near_nbr[source_id][cat] = time_val
-                    elif time_val < near_nbr[source_id][cat]:
-                        near_nbr[source_id][cat] = time_val
-
-                #Within upper limit buffer range (default is 30 minutes.)
-                if time_val <= self.upper and time_val>=0:
-                    #increment the number of destinations in range of this source
-                    n_dests_in_range[source_id][cat] += 1
-
-                    if source_id in already_added_a:
-                        self.source2dest[source_id].append((dest_id, time_val))
-                    else:
-                        self.source2dest[source_id] = [(dest_id,time_val)]
-                        already_added_a.add(source_id)
-                    if dest_id in already_added_b:
-                        self.dest2source[dest_id].append((source_id, time_val))
-                    else:
-                        self.dest2source[dest_id] = [(source_id, time_val)]
-                        already_added_b.add(dest_id)
-                
-        #convert dictionaries to dataframes
-        self.near_nbr = pd.DataFrame.from_dict(near_nbr, 
-            orient='index')
-
-        self.n_dests_in_range = pd.DataFrame.from_dict(n_dests_in_range, 
-            orient='index')
-
-        self.time_val2 = pd.DataFrame.from_dict(self.time_val2, orient='index')
-
-        #Rename column to 'time'
-        self.time_val2=self.time_val2.rename(columns={0:'time'})
-
-        #Find list within matrix with negative values.
-        #When constructing the matrix with p2p, the negative values (-999) are the edges on the border of the bounding box.
-        list_id=self.time_val2.index[self.time_val2['time'] <0].tolist()
-
-        #In final output of metrics, drop the negative values of time distance travel matrix
-        for i in list_id:
-            for j in self.n_dests_in_range.keys():
-                self.n_dests_in_range.at[i,j] = -9999
-        self.n_dests_in_range=self.n_dests_in_range.replace(-9999, np.nan)
-
-        for i in list_id:
-            for j in self.near_nbr.keys():
-                self.near_nbr.at[i,j] = -9999
-        self.near_nbr=self.near_nbr.replace(-9999, np.nan)
+        for cat in nearest_cat_template:
+            cols = dest_cats == str(cat)
+            cat_times = np.where(reachable[:, cols], times[:, cols], np.inf)
+            closest = cat_times.min(axis=1) if cols.any() else np.full(len(source_ids), np.inf)
+            near_nbr[cat] = np.where(np.isfinite(closest), closest, np.nan)
+            n_dests_in_range[cat] = in_range[:, cols].sum(axis=1)
+
+        self.near_nbr = pd.DataFrame(near_nbr, index=source_ids)
+        self.n_dests_in_range = pd.DataFrame(n_dests_in_range, index=source_ids)
+
+        #pre map sources->dests (in range) and dests->sources (in range),
+        #both in the order of the sp matrix
+        rows, cols = np.nonzero(in_range)
+        in_range_times = times[rows, cols].tolist()
+        pairs = list(zip(dest_ids[cols].tolist(), in_range_times))
+        for chunk in np.split(np.arange(len(rows)), np.flatnonzero(np.diff(rows)) + 1):
+            if len(chunk):
+                self.source2dest[source_ids[rows[chunk[0]]]] = pairs[chunk[0]:chunk[-1] + 1]
+
+        pairs = list(zip(source_ids[rows].tolist(), in_range_times))
+        order = np.argsort(cols, kind='stable')
+        by_dest = {}
+        for chunk in np.split(order, np.flatnonzero(np.diff(cols[order])) + 1):
+            if len(chunk):
+                by_dest[cols[chunk[0]]] = [pairs[k] for k in chunk]
+        #dests keyed in the order they are first reached
+        _, first = np.unique(cols, return_index=True)
+        for col in cols[np.sort(first)]:
+            self.dest2source[dest_ids[col]] = by_dest[col]
+
+        #time to the last dest of each source
+        self.time_val2 = pd.DataFrame({'time': times[:, -1] if len(dest_ids) else
+            np.zeros(len(source_ids), dtype=np.int64)}, index=source_ids)
+
+        #Sources that reach none of the dests (only -1 times), e.g. points on
+        #an island of an older matrix. A source is judged on all its dests,
+        #not on the time to the last one.
+        self.unreachable = pd.Series(~reachable.any(axis=1) if len(dest_ids) else
+            np.zeros(len(source_ids), dtype=bool), index=source_ids)
+
+        #In final output of metrics, drop the sources that reach no dest
+        self.n_dests_in_range = self.n_dests_in_range.mask(self.unreachable.reindex(self.n_dests_in_range.index,
+            fill_value=False), axis=0)
+        self.near_nbr = self.near_nbr.mask(self.unreachable.reindex(self.near_nbr.index,
+            fill_value=False), axis=0)
 
         #Get nearest neighbor facility in minutes
         self.near_nbr =self.near_nbr/60
@@ -341,8 +333,21 @@ class ModelData(object):
         ModelData will attempt to load from file.
         If filename is not supplied, ModelData will generate
         a shortest path matrix using p2p (must be installed).
+        If P2P_SERVER names the address of a p2p_server, the file
+        is looked up there instead of loaded.
         '''
 
+        #use a shared copy if a server is running
+        server = os.environ.get(SERVER_VARIABLE)
+        if filename and server:
+            try:
+                self.sp_matrix = matrixClient(server, filename)
+                self.sp_matrix_good = True
+                self.logger.info('Using sp matrix {} from server at {}'.format(filename, server))
+                return
+            except (OSError, ValueError) as err:
+                self.logger.warning('Could not use the p2p server at {} ({}), loading {}'.format(server, err, filename))
+
         #try to load from file if given
         if filename:
             self.sp_matrix = TransitMatrix(network_type=self.network_type, 
@@ -1,18 +1,33 @@
 import numpy as np
 import multiprocessing, math
 import scipy.spatial
+import scipy.sparse
+import scipy.sparse.csgraph
 from sklearn.neighbors import NearestNeighbors
-from geopy.distance import vincenty
+from shapely.geometry import LineString
 from NetworkQuery import Query
-from jellyfish import jaro_winkler
 import geopandas as gpd
 import pandas as pd
 import time, sys, os.path, csv, json, logging, os, psutil
 from pandana.loaders import osm
+from p2p_matrix import index_csv
+from p2p_engine import spTMatrix, write_network, write_nn, collapse_chains, count_edges, edges_to_csr, last_mile, UNREACHABLE, ROWS_PER_TASK
+from p2p_ch import CHIndex
+from p2p_store import NetworkStore
+from p2p_osm import network_from_file
+from p2p_checkpoint import blockCheckpoint, hash_files
+from p2p_tiles import tileSet
+from p2p_topk import nearestSearch
+from p2p_catchments import catchmentSearch
+from p2p_route import networkRouter
+from p2p_planner import plan_run
+from p2p_streets import match_speed_limits, speed_limit_hash, parse_maxspeed, highway_speeds, MPH_TO_KMH
 try:
     from pyengine import *
+    PYENGINE_AVAILABLE = True
 except:
-    print('Unable to import pyengine. Try running setup.py again')
+    PYENGINE_AVAILABLE = False
+    print('Unable to import pyengine. Try running setup.py again (falling back to the scipy backend)')
 
 # Program to calculate the network time between every point in a set, hence: "p2p".
 # Written by Logan Noel for the Center for Spatial Data Science, 2018.
@@ -34,6 +49,70 @@ def geo_area(lat1, lon1, lat2, lon2):
     return area
 
 
+def project_xy(lat, lon, lat0):
+    '''
+    Project arrays of coordinates to meters with an equirectangular
+    projection centered on latitude lat0. Distances are accurate
+    enough over a metro area to find nearest neighbors.
+    Returns: (N, 2) array of x, y
+    '''
+    EARTH_RADIUS = 6371000 #meters
+    x = np.radians(lon) * EARTH_RADIUS * math.cos(math.radians(lat0))
+    y = np.radians(lat) * EARTH_RADIUS
+
+    return np.column_stack([x, y])
+
+
+def vincenty_distance(lat1, lon1, lat2, lon2):
+    '''
+    Distance in meters between arrays of points on the WGS-84
+    ellipsoid, using the inverse Vincenty formula (as in geopy).
+    '''
+    MAJOR = 6378137.0 #meters
+    FLATTENING = 1 / 298.257223563
+    MINOR = (1 - FLATTENING) * MAJOR
+    MAX_ITERATIONS = 20
+
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(v, dtype=np.float64)) 
+        for v in (lat1, lon1, lat2, lon2)]
+    L = lon2 - lon1
+    U1 = np.arctan((1 - FLATTENING) * np.tan(lat1))
+    U2 = np.arctan((1 - FLATTENING) * np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lambda_lon = L
+    for _ in range(MAX_ITERATIONS):
+        sin_lambda, cos_lambda = np.sin(lambda_lon), np.cos(lambda_lon)
+        sin_sigma = np.sqrt((cos_U2 * sin_lambda) ** 2 +
+            (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lambda) ** 2)
+        coincident = sin_sigma == 0
+        sin_sigma = np.where(coincident, 1, sin_sigma)
+        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lambda
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        sin_alpha = cos_U1 * cos_U2 * sin_lambda / sin_sigma
+        cos_sq_alpha = 1 - sin_alpha ** 2
+        #points on the equator have no cos_2_sigma_m term
+        cos_2_sigma_m = np.where(cos_sq_alpha != 0, 
+            cos_sigma - 2 * sin_U1 * sin_U2 / np.where(cos_sq_alpha != 0, cos_sq_alpha, 1), 0)
+        C = FLATTENING / 16 * cos_sq_alpha * (4 + FLATTENING * (4 - 3 * cos_sq_alpha))
+        lambda_prev = lambda_lon
+        lambda_lon = L + (1 - C) * FLATTENING * sin_alpha * (sigma + C * sin_sigma * 
+            (cos_2_sigma_m + C * cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)))
+        if (np.abs(lambda_lon - lambda_prev) <= 1e-12).all():
+            break
+
+    u_sq = cos_sq_alpha * (MAJOR ** 2 - MINOR ** 2) / (MINOR ** 2)
+    A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = B * sin_sigma * (cos_2_sigma_m + B / 4 * (cos_sigma * 
+        (-1 + 2 * cos_2_sigma_m ** 2) - B / 6 * cos_2_sigma_m * 
+        (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2_sigma_m ** 2)))
+    distance = MINOR * A * (sigma - delta_sigma)
+
+    return np.where(coincident, 0.0, distance)
+
+
 class pyTMatrix(object):
     '''
     A wrapper for C++ based pandas DataFrame like object.
@@ -65,6 +144,29 @@ class pyTMatrix(object):
             nn_sinfile.encode('UTF-8'), outfile.encode('UTF-8'), N, impedence,
             num_threads, outer_node_rows, outer_node_cols, mode, write_mode)
 
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        return self.tm.get(source, dest)
+
+    def get_many(self, sources, dests):
+        '''
+        Fetch the time values for each (sources[i], dests[i]) pair
+        (one call into the C++ module per pair).
+        '''
+        return np.array([self.tm.get(source, dest) 
+            for source, dest in zip(sources, dests)], dtype=np.int64)
+
+    def get_submatrix(self, sources, dests):
+        '''
+        Fetch the times from every source to every dest.
+        '''
+        values = self.get_many([source for source in sources for dest in dests],
+            [dest for source in sources for dest in dests])
+
+        return values.reshape(len(sources), len(dests))
+
 
 
 class TransitMatrix(object):
@@ -74,17 +176,63 @@ class TransitMatrix(object):
         -network_type: 'walk', 'drive' or 'bike'
         -epsilon: [optional] smooth out the network edges
         -primary_input: 
+        -output_type: [optional] 'csv', 'tmat' (binary, memory mapped on
+        load; requires the scipy backend), 'json' (n_best_matches only) or
+        'topk' (the n_best_matches nearest destinations of each origin as
+        compact arrays, searching only as far as needed; per destination
+        category when the hints of the destinations name a 'category'
+        column. Requires the scipy backend) or 'catchment' (see
+        catchment_times).
+        -backend: [optional] 'pyengine' (C++) or 'scipy'. Defaults to
+        pyengine when it is installed.
+        -max_time: [optional] travel time cap in seconds. Pairs slower than
+        this are dropped and the matrix is stored as sparse triplets (.npz).
+        Requires the scipy backend.
+        -use_ch: [optional] answer the matrix from a contraction hierarchy
+        index, built once per network and cached next to the edge list.
+        Requires the scipy backend.
+        -network_store: [optional] directory of a local NetworkStore. The
+        network is cut out of the store instead of downloaded (the store
+        is only filled from OSM if it doesn't cover the bounding box).
+        -osm_file: [optional] a local .osm/.osm.pbf extract to build the
+        network from instead of the Overpass API.
+        -checkpoint_dir: [optional] directory to compute the matrix in
+        blocks of rows, each saved to a part file as it finishes (along
+        with the network and nn files). Requires the scipy backend.
+        -resume: [optional] with checkpoint_dir, skip the network download,
+        nearest neighbor matching and blocks already completed there.
+        -shared_checkpoint: [optional] with checkpoint_dir on a directory
+        other hosts can reach, let workers started there with
+        `python p2p_checkpoint.py <checkpoint_dir>` claim blocks of rows
+        too. The run merges the blocks once all of them are complete.
+        -memory_budget: [optional] memory (GB) the run should fit in; the
+        thread count, search size, checkpoint blocks and load_to_mem are
+        chosen to fit. Defaults to most of the available memory.
+        -catchment_times: [optional] with output_type 'catchment', time
+        thresholds (seconds, e.g. [600, 1200, 1800]). One search is run
+        from each secondary point (facility) over the reversed network out
+        to the largest threshold, giving the primary points (origins)
+        within each threshold and a catchment polygon around them, written
+        to a GeoPackage (or GeoParquet, for a .parquet output_filename).
+        Requires the scipy backend.
+        -tile_km: [optional] with max_time, split the origins into square
+        tiles of this size (km), each searched in its own process on the
+        part of the network it reaches within max_time.
     '''
     def __init__(self, network_type, epsilon=0.05, primary_input=None, 
         secondary_input=None, output_type='csv', n_best_matches=4, 
         read_from_file=None, write_to_file=False, load_to_mem=True,
-        primary_hints=None, secondary_hints=None):
+        primary_hints=None, secondary_hints=None, backend=None,
+        max_time=None, use_ch=False, network_store=None, osm_file=None,
+        checkpoint_dir=None, resume=False, memory_budget=None, tile_km=None,
+        shared_checkpoint=False, catchment_times=None):
 
         self.network_type = network_type
         self.epsilon = epsilon
         self.primary_input = primary_input
         self.secondary_input = secondary_input
         self.sl_data = None
+        self.sl_hash = None
         self.primary_data = None
         self.secondary_data = None
         self.num_nodes = 0
@@ -108,11 +256,44 @@ class TransitMatrix(object):
 
         self.primary_hints = primary_hints
         self.secondary_hints = secondary_hints
+        #columns (x, y, id) read from each input, as hinted or entered
+        self.input_columns = {}
 
         self.bbox = []
-        self.node_pair_to_speed = {}
+        self.edge_speeds = None
         self.tmatrix = None
 
+        self.max_time = max_time
+        self.use_ch = use_ch
+        self.network_store = network_store
+        self.osm_file = osm_file
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        self.shared_checkpoint = shared_checkpoint
+        self.checkpoint = None
+        self.memory_budget = memory_budget
+        self.tile_km = tile_km
+        self.catchment_times = catchment_times
+        self.rows_per_task = ROWS_PER_TASK
+        self.island_nodes = None
+        self.edge_list = None
+        self.nn_matches = {}
+        self.router = None
+        self.router_lat0 = None
+        #network before simplification, for route()
+        self.route_network = None
+
+        #these options can only be handled by the scipy backend
+        scipy_only = (use_ch or max_time is not None or output_type in ('tmat', 'topk', 'catchment') or
+            checkpoint_dir is not None or tile_km is not None or
+            (read_from_file and read_from_file.endswith(('.npz', '.tmat', '.topk'))))
+        if not backend:
+            if PYENGINE_AVAILABLE and not scipy_only:
+                backend = 'pyengine'
+            else:
+                backend = 'scipy'
+        self.backend = backend
+
         #CONSTANTS
         self.HUMAN_WALK_SPEED = 5 #km per hour
         self.BIKE_SPEED = 15 #km per hour
@@ -133,6 +314,19 @@ class TransitMatrix(object):
         assert network_type in ['drive', 'walk', 'bike'], "network_type is not one of: ['drive', 'walk', 'bike'] "
 
         assert (write_to_file or load_to_mem or read_from_file), "Need to (write_to_file and or load_to_mem) or read_from_file, can't do nothing"
+        assert backend in ['pyengine', 'scipy'], "backend is not one of: ['pyengine', 'scipy']"
+        assert backend != 'pyengine' or PYENGINE_AVAILABLE, "pyengine backend requested but pyengine could not be imported"
+        assert output_type in ['csv', 'tmat', 'json', 'topk', 'catchment'], "output_type is not one of: ['csv', 'tmat', 'json', 'topk', 'catchment']"
+        assert not scipy_only or backend == 'scipy', "max_time, use_ch, checkpoint_dir, tile_km, topk and catchment output, .npz, .tmat and .topk matrices require the scipy backend"
+        assert checkpoint_dir or not resume, "resume requires a checkpoint_dir"
+        assert not tile_km or max_time is not None, "tile_km requires max_time"
+        assert not (tile_km and checkpoint_dir), "tile_km and checkpoint_dir can't be combined"
+        assert checkpoint_dir or not shared_checkpoint, "shared_checkpoint requires a checkpoint_dir"
+        assert not (shared_checkpoint and use_ch), "shared_checkpoint and use_ch can't be combined"
+        assert output_type != 'topk' or not (checkpoint_dir or tile_km), "topk output can't be combined with checkpoint_dir or tile_km"
+        assert (output_type == 'catchment') == bool(catchment_times), "catchment output requires catchment_times (and the reverse)"
+        assert output_type != 'catchment' or secondary_input, "catchment output requires a secondary_input (the facilities)"
+        assert output_type != 'catchment' or not (checkpoint_dir or tile_km or use_ch or max_time is not None), "catchment output can't be combined with checkpoint_dir, tile_km, use_ch or max_time"
 
     def get(self, source, dest):
         '''
@@ -140,11 +334,74 @@ class TransitMatrix(object):
         '''
         assert self.tmatrix != None, "tmatrix does not yet exist"
         try:
-            return self.tmatrix.tm.get(str(source), str(dest))
-        except:
+            return self.tmatrix.get(str(source), str(dest))
+        except KeyError:
             self.logger.error('Source, dest pair could not be found')
 
 
+    def get_many(self, sources, dests):
+        '''
+        Fetch the time values for each (sources[i], dests[i]) pair.
+        Returns: numpy array (-1 for unreachable or unknown pairs)
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        assert len(sources) == len(dests), "sources and dests must be the same length"
+        return self.tmatrix.get_many([str(source) for source in sources],
+            [str(dest) for dest in dests])
+
+
+    def get_submatrix(self, source_ids, dest_ids):
+        '''
+        Fetch the times from every source to every dest.
+        Returns: numpy array of shape (len(source_ids), len(dest_ids))
+        (-1 for unreachable or unknown pairs)
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        return self.tmatrix.get_submatrix([str(source) for source in source_ids],
+            [str(dest) for dest in dest_ids])
+
+
+    def get_row(self, source):
+        '''
+        Fetch the times from source to every dest.
+        Returns: pandas Series indexed by dest id
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        assert self.backend == 'scipy', "get_row requires the scipy backend (use get_submatrix)"
+        return self.tmatrix.get_row(str(source))
+
+
+    def get_col(self, dest):
+        '''
+        Fetch the times from every source to dest.
+        Returns: pandas Series indexed by source id
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        assert self.backend == 'scipy', "get_col requires the scipy backend (use get_submatrix)"
+        return self.tmatrix.get_col(str(dest))
+
+
+    def get_catchments(self):
+        '''
+        Fetch the catchments (catchment output).
+        Returns: (catchments, members) GeoDataFrames, see
+        p2p_catchments.catchmentSet
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        assert self.tmatrix.catchments is not None, "no catchments in memory (load_to_mem)"
+        return self.tmatrix.catchments.catchments, self.tmatrix.catchments.members
+
+
+    def get_nearest(self, source):
+        '''
+        Fetch the nearest destinations of source (topk output).
+        Returns: pandas DataFrame of dest, (category,) rank and seconds
+        '''
+        assert self.tmatrix != None, "tmatrix does not yet exist"
+        assert self.backend == 'scipy', "get_nearest requires the scipy backend"
+        return self.tmatrix.get_nearest(str(source))
+
+
     def _load_parameters(self, filename='p2p_parameters.json'):
         '''
         Load model parameters from json.
@@ -199,6 +456,74 @@ class TransitMatrix(object):
         return filename
 
 
+    def _get_intermediate_filename(self, keyword, extension='csv'):
+        '''
+        Return the filename for an intermediate (network or nn) file,
+        kept in the checkpoint directory if there is one.
+        '''
+        if self.checkpoint:
+            return self.checkpoint.path('{}.{}'.format(keyword, extension))
+
+        return self._get_output_filename(keyword, extension)
+
+
+    def _checkpoint_request(self):
+        '''
+        What the intermediate files of a checkpoint are computed from:
+        the input csvs (path and content hash), the columns read from
+        them, the speed limit table and the parameters that change the
+        network or matrix.
+        '''
+        request = {'network_type': self.network_type, 'epsilon': self.epsilon,
+            'max_time': self.max_time, 'columns': self.input_columns,
+            'primary_hints': self.primary_hints, 'secondary_hints': self.secondary_hints,
+            'speed_limits': self.sl_hash}
+        for key, filename in (('primary_input', self.primary_input),
+            ('secondary_input', self.secondary_input)):
+            request[key] = [os.path.abspath(filename), hash_files([filename])] if filename else None
+
+        #as stored in (and read back from) the manifest
+        return json.loads(json.dumps(request))
+
+
+    def _save_checkpoint_inputs(self):
+        '''
+        Record the intermediate files in the checkpoint manifest, along
+        with the request they were computed for.
+        '''
+        self.checkpoint.manifest['inputs'] = {'network_filename': self.network_filename,
+            'nn_primary_filename': self.nn_primary_filename,
+            'nn_secondary_filename': self.nn_secondary_filename,
+            'num_nodes': self.num_nodes, 'num_edges': self.num_edges,
+            'request': self._checkpoint_request()}
+        self.checkpoint.save()
+
+
+    def _restore_checkpoint_inputs(self):
+        '''
+        Pick up the intermediate files of an earlier run from the
+        checkpoint manifest. Returns: True if they could all be used
+        (they exist and were computed for the same request).
+        '''
+        inputs = self.checkpoint.manifest.get('inputs')
+        if not inputs:
+            return False
+        if inputs.get('request') != self._checkpoint_request():
+            self.logger.warning('The checkpoint in {} was computed for other inputs or parameters'.format(self.checkpoint_dir))
+            return False
+        filenames = [inputs['network_filename'], inputs['nn_primary_filename'],
+            inputs['nn_secondary_filename']]
+        if not all(os.path.isfile(filename) for filename in filenames):
+            return False
+
+        self.network_filename, self.nn_primary_filename, self.nn_secondary_filename = filenames
+        self.num_nodes = inputs['num_nodes']
+        self.num_edges = inputs['num_edges']
+        self.logger.info('Resuming with the network and nn files in: {}'.format(self.checkpoint_dir))
+
+        return True
+
+
     def _load_sl_data(self, sl_filename):
         '''
         Load speed limit data from .csv. Identify street name and speed
@@ -230,6 +555,7 @@ class TransitMatrix(object):
         self.sl_data.rename(columns=clean_names, inplace=True)
 
         self.sl_data = self.sl_data[['street_name','speed_limit']]
+        self.sl_hash = speed_limit_hash(sl_filename, street_name, speed_limit)
 
 
     def _parse_csv(self, primary):
@@ -275,6 +601,7 @@ class TransitMatrix(object):
             ycol = input('Enter the longitude coordinate: ')
         while idx not in source_data_columns:
             idx = input('Enter the index name: ')
+        self.input_columns['primary' if primary else 'secondary'] = [xcol, ycol, idx]
 
         #drop nan lines
         pre_drop_indices = source_data.index
@@ -292,10 +619,15 @@ class TransitMatrix(object):
         source_data.set_index(idx, inplace=True)
         source_data.rename(columns={xcol:'x',ycol:'y'},inplace=True)
         source_data.index = source_data.index.map(str)
+        columns = ['x', 'y']
+        hints = self.primary_hints if primary else self.secondary_hints
+        if hints and hints.get('category') in source_data.columns:
+            source_data['category'] = source_data[hints['category']].astype(str)
+            columns.append('category')
         if primary:
-            self.primary_data = source_data[['x','y']]
+            self.primary_data = source_data[columns]
         else:
-            self.secondary_data = source_data[['x','y']]
+            self.secondary_data = source_data[columns]
 
 
     def _load_inputs(self):
@@ -363,8 +695,13 @@ class TransitMatrix(object):
         '''
         if not output_filename:
             key_phrase = '{}_full_results'.format(self.network_type)
+            extension = self.output_type
+            if self.output_type == 'catchment':
+                extension = 'gpkg'
+            if self.max_time is not None and self.output_type in ('csv', 'tmat'):
+                extension = 'npz'
             self.output_filename = self._get_output_filename(key_phrase, 
-                self.output_type)
+                extension)
         else:
             self.output_filename = output_filename
 
@@ -385,9 +722,35 @@ class TransitMatrix(object):
         self.available_threads = no_cores
 
 
+    def _plan_run(self):
+        '''
+        Fit the thread count, search task size, checkpoint block size
+        and load_to_mem/write_to_file to the memory budget.
+        '''
+        n_rows = len(self.primary_data)
+        if self.secondary_input:
+            n_cols = len(self.secondary_data)
+        else:
+            n_cols = n_rows
+        dense = self.output_type in ('csv', 'tmat') and self.max_time is None
+
+        plan = plan_run(self.num_nodes, self.num_edges, n_rows, n_cols,
+            self.backend, self.available_threads, self.load_to_mem,
+            self.write_to_file, dense, self.memory_budget, self.max_time)
+
+        self.available_threads = plan.num_threads
+        self.rows_per_task = plan.rows_per_task
+        self.load_to_mem = plan.load_to_mem
+        self.write_to_file = plan.write_to_file
+        if self.checkpoint:
+            self.checkpoint.block_rows = plan.block_rows
+
+
     def _clean_speed_limits(self):
         '''
-        Map road segments to speed limits.
+        Map road segments to speeds (km/h): the OSM maxspeed tag, then
+        the speed of the road class, then the speed limit table (MPH,
+        converted).
         '''
         edges = self.edges
         sl_file = self.sl_data
@@ -397,8 +760,7 @@ class TransitMatrix(object):
         #clean the table and standardize names
         sl_file.dropna(inplace=True, axis=0, how='any')
         sl_file['street_name'] = sl_file['street_name'].str.upper()
-        edges['name'].fillna('PRIVATE', inplace=True)
-        edges['name'] = edges['name'].str.upper()
+        edges['name'] = edges['name'].fillna('PRIVATE').str.upper()
         sl_file = sl_file[sl_file['speed_limit'] > 0]
         
         #load mappings for easy use
@@ -406,77 +768,58 @@ class TransitMatrix(object):
         for row in sl_file.itertuples():
             limits[row[1]] = row[2]
 
-        #extract edge names/ids from OSM network and assign defaut speed
-        STR_NAME = edges.columns.get_loc('name') + 1
-        network_streets = {}
-        for data in edges.itertuples():
-            network_streets[data[STR_NAME]] = 25
-        
-        remaining_names = set(limits.keys())
-
-        perfect_match = 0
-        great_match = 0
-        good_match = 0
-        non_match = 0
-
-        #assign default value
-        network_streets['PRIVATE'] = self.DEFAULT_DRIVE_SPEED
-
-        #attempt to match edges in OSM to known street names
-        #and assign corresponding speed limit
-        for name in network_streets.keys():
-            if name != 'PRIVATE':
-                if name in remaining_names:
-                    network_streets[name] = limits[name]
-                    perfect_match += 1
-                else:
-                    best_distance = 0
-                    best_match = None
-                    for potential_match in remaining_names:
-                        distance = jaro_winkler(name, potential_match)
-                        if distance >= 0.97:
-                            best_distance = distance
-                            best_match = potential_match
-                            great_match += 1
-                            break
-                        if distance > best_distance:
-                            best_distance = distance
-                            best_match = potential_match
-                    if best_match and best_distance > 0.9:
-                        network_streets[name] = limits[best_match]
-                        good_match += 1
-                    else:
-                        non_match += 1
-                        network_streets[name] = 25
-
-
-        node_pair_to_speed = {}
-        for data in edges.itertuples():
-            if data[STR_NAME] in network_streets.keys():
-                speed =  network_streets[data[STR_NAME]]
-            else:
-                speed = 25
-            node_pair_to_speed[(data[0][0], data[0][1])] = speed
-            node_pair_to_speed[(data[0][1], data[0][0])] = speed 
+        #match edges in OSM to known street names (exactly, or through
+        #the street name index) and assign corresponding speed limit
+        names = [name for name in edges['name'].unique() if name != 'PRIVATE']
+        if not os.path.exists("data/"):
+            os.makedirs("data/")
+        cache_filename = 'data/street_names_{}.json'.format(self.sl_hash[:16])
+        matches, counts = match_speed_limits(names, limits, cache_filename)
+        network_streets = {name: np.nan if speed is None else speed for name, speed in matches.items()}
+
+        #speed of each edge (applies to both directions), from the first
+        #source that has one; all in km/h
+        no_tag = np.full(len(edges), np.nan)
+        sources = [('maxspeed', parse_maxspeed(edges['maxspeed']) if 'maxspeed' in edges else no_tag),
+            ('highway', highway_speeds(edges['highway']) if 'highway' in edges else no_tag),
+            ('speed limit table', edges['name'].map(network_streets).astype(float).values * MPH_TO_KMH)]
+        edge_speeds = no_tag.copy()
+        covered = []
+        for source, speeds in sources:
+            fill = np.isnan(edge_speeds) & ~np.isnan(speeds)
+            edge_speeds[fill] = speeds[fill]
+            covered.append('{:,} from {}'.format(int(fill.sum()), source))
+
+        #assign default values
+        unset = np.isnan(edge_speeds)
+        unnamed = (edges['name'] == 'PRIVATE').values
+        edge_speeds[unset & unnamed] = self.DEFAULT_DRIVE_SPEED
+        edge_speeds[unset & ~unnamed] = 25 * MPH_TO_KMH
+        covered.append('{:,} default'.format(int(unset.sum())))
 
         self.logger.info('''Matching street network completed in 
-            {:,.2f} seconds: {} perfect matches, {} near perfect matches,
-            {} good matches and {} non matches'''.format(time.time() - start_time, 
-                perfect_match, great_match, good_match, non_match))
+            {:,.2f} seconds: {} perfect matches, {} normalized matches,
+            {} near perfect matches, {} good matches, {} non matches
+            and {} cached matches'''.format(time.time() - start_time, 
+                counts['perfect'], counts['normalized'], counts['great'],
+                counts['good'], counts['none'], counts['cached']))
+        self.logger.info('Edge speeds: {}'.format(', '.join(covered)))
 
-        self.node_pair_to_speed = node_pair_to_speed
+        self.edge_speeds = edge_speeds
 
       
     def _cost_model(self, distance, sl):
         '''
-        Return the edge impedence as specified by the cost model.
+        Return the edge impedences (seconds) as specified by the cost
+        model, given arrays of edge distances (meters) and (drive only)
+        speed limits (km/h, see _clean_speed_limits).
         '''
         if self.network_type == 'walk':
-            return int((distance / self.WALK_CONSTANT) + self.WALK_NODE_PENALTY)
+            impedence = (distance / self.WALK_CONSTANT) + self.WALK_NODE_PENALTY
         elif self.network_type == 'bike':
-            return int((distance / self.BIKE_CONSTANT) + self.BIKE_NODE_PENALTY)
+            impedence = (distance / self.BIKE_CONSTANT) + self.BIKE_NODE_PENALTY
         else:
-            if sl:
+            if sl is not None:
                 edge_speed_limit = sl
             else:
                 #if we weren't provided speed limit data, we use defaults
@@ -484,27 +827,37 @@ class TransitMatrix(object):
                 self.logger.warning('Using default drive speed. Results will be inaccurate')
                 edge_speed_limit = self.DEFAULT_DRIVE_SPEED
             drive_constant = (edge_speed_limit / self.ONE_HOUR) * self.ONE_KM
-            return int((distance / drive_constant) + self.DRIVE_NODE_PENALTY) 
+            impedence = (distance / drive_constant) + self.DRIVE_NODE_PENALTY
+
+        return impedence.astype(np.int64)
 
 
     def _request_network(self):
         '''
-        Fetch a street network from OSM that encompasses the data points.
-        Writes three .csv files:
-            distance_matrix: matrix representing the distance from each point in
-            the OSM network to every other point (in meters)
-            nodes: list of all nodes in the network
-            edges: list of all edges in the network
+        Fetch a street network from OSM that encompasses the data points
+        and build its directed edge list (from_loc, to_loc, impedence),
+        by node position.
         '''
         
-        self.network_filename = self._get_output_filename("raw_network")
+        if self.backend == 'scipy':
+            self.network_filename = self._get_intermediate_filename("raw_network", 'npy')
+        else:
+            self.network_filename = self._get_intermediate_filename("raw_network")
         self._get_bbox()
 
-        #query OSM
+        #query OSM (or the local network store)
         try:
-            self.nodes, self.edges = osm.network_from_bbox(self.bbox[0], 
-                self.bbox[1], self.bbox[2], self.bbox[3],
-                network_type=self.network_type)
+            if self.osm_file:
+                self.nodes, self.edges = network_from_file(self.osm_file,
+                    self.network_type, self.bbox)
+            elif self.network_store:
+                store = NetworkStore(self.network_store)
+                self.nodes, self.edges = store.get_network(self.network_type,
+                    self.bbox)
+            else:
+                self.nodes, self.edges = osm.network_from_bbox(self.bbox[0], 
+                    self.bbox[1], self.bbox[2], self.bbox[3],
+                    network_type=self.network_type)
         except:
             request_error = '''Error trying to download OSM network. 
             Did you reverse lat/long? 
@@ -524,53 +877,155 @@ class TransitMatrix(object):
         start_time = time.time()
 
         #map index name to position
-        node_index_to_loc = {}
-        for i, index_name in enumerate(self.nodes.index):
-            node_index_to_loc[index_name] = i
-
-        DISTANCE = self.edges.columns.get_loc('distance') + 1
-        FROM_IDX = self.edges.columns.get_loc('from') + 1
-        TO_IDX = self.edges.columns.get_loc('to') + 1
-        ONEWAY = self.edges.columns.get_loc('oneway') + 1
-
-        #create a mapping of each node to every other connected node
-        #transform them by cost model as well
-        with open(self.network_filename, 'w') as csvfile:
-            writer = csv.writer(csvfile)
-            for data in self.edges.itertuples():
-                from_idx = data[FROM_IDX]
-                to_idx = data[TO_IDX]
-                if self.node_pair_to_speed:
-                    impedence = self._cost_model(data[DISTANCE], 
-                        self.node_pair_to_speed[(from_idx, to_idx)])
-                else:
-                    impedence = self._cost_model(data[DISTANCE], None)
-                oneway = data[ONEWAY]
-                
-                writer.writerow([node_index_to_loc[from_idx], 
-                    node_index_to_loc[to_idx], impedence])
-
-                if oneway != 'yes':
-                    writer.writerow([node_index_to_loc[to_idx], 
-                        node_index_to_loc[from_idx], impedence])
+        from_loc = self.nodes.index.get_indexer(self.edges['from'])
+        to_loc = self.nodes.index.get_indexer(self.edges['to'])
+        assert (from_loc >= 0).all() and (to_loc >= 0).all(), "edges reference nodes missing from the network"
 
-        
-        self.logger.info("Prepared raw network in {:,.2f} seconds and wrote to: {}".format(time.time() - start_time, self.network_filename))
+        impedence = self._cost_model(self.edges['distance'].values, self.edge_speeds)
+
+        #every edge that isn't one way (every edge, when walking) is also
+        #added in reverse, right after its forward copy
+        if self.network_type == 'walk':
+            two_way = np.ones(self.num_edges, dtype=bool)
+        else:
+            two_way = (self.edges['oneway'] != 'yes').values
+        edge_order = np.concatenate([np.arange(self.num_edges), np.flatnonzero(two_way)])
+        order = np.argsort(edge_order, kind='stable')
+        all_from = np.concatenate([from_loc, to_loc[two_way]])[order]
+        all_to = np.concatenate([to_loc, from_loc[two_way]])[order]
+        all_impedence = np.concatenate([impedence, impedence[two_way]])[order]
+
+        #only the main strongly connected component is searched
+        keep = self._main_component(all_from, all_to)
+        if not keep.all():
+            new_loc = np.cumsum(keep) - 1
+            kept_edges = keep[all_from] & keep[all_to]
+            all_from = new_loc[all_from[kept_edges]]
+            all_to = new_loc[all_to[kept_edges]]
+            all_impedence = all_impedence[kept_edges]
+            self.island_nodes = self.nodes[~keep]
+            self.nodes = self.nodes[keep]
+            self.num_nodes = len(self.nodes)
+            self.num_edges = int((keep[from_loc] & keep[to_loc]).sum())
+
+        self.edge_list = (all_from, all_to, all_impedence)
+
+        self.logger.info("Prepared raw network in {:,.2f} seconds".format(time.time() - start_time))
+
+
+    def _simplify_network(self):
+        '''
+        Merge chains of degree 2 nodes (geometry vertices of OSM ways)
+        into single edges, keeping every node a point snapped to.
+        '''
+        #route() snaps to and draws through every node, like _match_nn
+        self.route_network = (self.nodes, self.edge_list)
+        self.router = None
+        if self.use_ch:
+            #the contraction hierarchy is cached by the hash of the network
+            #file, which must not depend on the nodes points snap to (and
+            #contracting chains is cheap anyway)
+            self.logger.info('Kept the full network for the contraction hierarchy')
+            return
+
+        start_time = time.time()
+        num_nodes, num_edges = self.num_nodes, len(self.edge_list[0])
+
+        pinned = np.zeros(self.num_nodes, dtype=bool)
+        for node_loc, _, _ in self.nn_matches.values():
+            pinned[node_loc] = True
+        all_from, all_to, all_impedence, keep = collapse_chains(*self.edge_list,
+            self.num_nodes, pinned)
+
+        new_loc = np.cumsum(keep) - 1
+        for filename, (node_loc, ids, distance) in self.nn_matches.items():
+            self.nn_matches[filename] = (new_loc[node_loc], ids, distance)
+        self.edge_list = (all_from, all_to, all_impedence)
+        self.nodes = self.nodes[keep]
+        self.num_nodes = len(self.nodes)
+        self.num_edges = count_edges(all_from, all_to, self.num_nodes)
+
+        self.logger.info('Simplified network in {:,.2f} seconds: {:,} nodes -> {:,} ({:.1%}), {:,} directed edges -> {:,} ({:.1%})'.format(time.time() - start_time,
+            num_nodes, self.num_nodes, self.num_nodes / max(num_nodes, 1),
+            num_edges, len(all_from), len(all_from) / max(num_edges, 1)))
+
+
+    def _write_network(self):
+        '''
+        Write the edge list (binary .npy for the scipy backend, .csv
+        for pyengine) and the nearest neighbor files.
+        '''
+        write_network(self.network_filename, *self.edge_list)
+        for filename, (node_loc, ids, distance) in self.nn_matches.items():
+            write_nn(filename, node_loc, ids, distance)
+
+        self.logger.info("Wrote raw network to: {}".format(self.network_filename))
+
+
+    def _get_matrix_class(self):
+        '''
+        Return the matrix class for the selected backend.
+        '''
+        if self.backend == 'pyengine':
+            return pyTMatrix
+        return spTMatrix
+
+
+    def _get_engine_args(self):
+        '''
+        Return the keyword arguments only understood by the scipy backend.
+        '''
+        if self.backend == 'pyengine':
+            return {}
+        args = {'max_time': self.max_time, 'checkpoint': self.checkpoint,
+            'rows_per_task': self.rows_per_task}
+        if self.use_ch:
+            #one cache for every run (network files are numbered, and kept
+            #in the checkpoint directory if there is one)
+            args['ch_index'] = CHIndex.for_network(self.network_filename,
+                self.num_nodes, 'data')
+        if self.tile_km:
+            data = self.primary_data
+            args['tiles'] = tileSet.from_xy(project_xy(data['x'].values, data['y'].values,
+                data['x'].mean()), self.tile_km * self.ONE_KM)
+            self.logger.info('Split {:,} origins into {:,} tiles of {} km'.format(len(data),
+                len(args['tiles']), self.tile_km))
+        if self.output_type == 'topk':
+            dests = self.secondary_data if self.secondary_input else self.primary_data
+            categories = dests['category'].values if 'category' in dests else None
+            args['nearest'] = nearestSearch(self.n_best_matches, categories)
+        if self.output_type == 'catchment':
+            args['catchment'] = catchmentSearch(self.catchment_times,
+                self.nodes[['x', 'y']].values, self.primary_data[['y', 'x']].values)
+        return args
+
+
+    def _get_impedence_constant(self):
+        '''
+        Return the speed (meters per second) used for the last mile
+        between the data points and the network.
+        '''
+        if self.network_type == 'walk':
+            return self.WALK_CONSTANT
+        elif self.network_type == 'bike':
+            return self.BIKE_CONSTANT
+        return self.DRIVE_CONSTANT
 
 
     def _calc_shortest_path(self):
         '''
         Outsources the work of computing the shortest path matrix
-        to a C++ module.
+        to a C++ module (or the scipy backend).
         '''
 
         start_time = time.time()
+        matrix_class = self._get_matrix_class()
 
         #if we are provided a .csv shortest path matrix, load it 
         #to memory
         if self.read_from_file:
             try:
-                self.tmatrix = pyTMatrix(self.read_from_file,
+                self.tmatrix = matrix_class(self.read_from_file,
                     "none", "none", "none", 0, 0.0, 1, 0, 0, 0, 
                     write_to_file=False, load_to_mem=False, read_from_file=True)
                 logger_vars = time.time() - start_time
@@ -581,12 +1036,7 @@ class TransitMatrix(object):
                 sys.exit()
 
         #determine initialization conditions for generating matrix
-        if self.network_type == 'walk':
-            imp_val = self.WALK_CONSTANT
-        elif self.network_type == 'bike':
-            imp_val = self.BIKE_CONSTANT
-        else:
-            imp_val = self.DRIVE_CONSTANT
+        imp_val = self._get_impedence_constant()
 
 
         outer_node_rows = len(self.primary_data)
@@ -594,25 +1044,56 @@ class TransitMatrix(object):
             outer_node_cols = len(self.secondary_data)
         else:
             outer_node_cols = len(self.primary_data)
-        if self.output_type == 'csv':
-            nearest_neighbors = 0
-        else:
+        if self.output_type == 'json':
             nearest_neighbors = self.n_best_matches
+        else:
+            nearest_neighbors = 0
     
         if self.write_to_file:
             self.logger.info('Writing to file: {}'.format(self.output_filename))
         
-        self.tmatrix = pyTMatrix(self.network_filename,
+        self.tmatrix = matrix_class(self.network_filename,
             self.nn_primary_filename, self.nn_secondary_filename,
             self.output_filename, self.num_nodes, imp_val, 
             self.available_threads, outer_node_rows, outer_node_cols, 
             nearest_neighbors, write_to_file=self.write_to_file, 
-            load_to_mem=self.load_to_mem, read_from_file=False)
+            load_to_mem=self.load_to_mem, read_from_file=False,
+            **self._get_engine_args())
         
         logger_vars = time.time() - start_time
-        self.logger.info('Shortest path matrix computed in {:,.2f} seconds'.format(logger_vars))
+        self.logger.info('Shortest path matrix computed ({} backend) in {:,.2f} seconds'.format(self.backend, logger_vars))
+
+        #a matrix that wasn't kept in memory (or didn't fit) is read back
+        #from its file: .tmat through a memory map, csv through its index
+        if (not self.load_to_mem and self.write_to_file and
+            self.output_type in ('csv', 'tmat', 'topk')):
+            if self.output_filename.endswith('.csv'):
+                index_csv(self.output_filename)
+            self.tmatrix = spTMatrix(self.output_filename,
+                "none", "none", "none", 0, 0.0, 1, 0, 0, 0, 
+                write_to_file=False, load_to_mem=False, read_from_file=True)
     
 
+    def _main_component(self, from_loc, to_loc):
+        '''
+        Find the largest strongly connected component of the directed
+        network. Nodes outside it (islands cut off by the bounding box,
+        one way stubs) can't reach or can't be reached from the rest of
+        the network, so pairs snapped to them would come out as -1.
+        Returns: boolean mask over the nodes
+        '''
+        start_time = time.time()
+        graph = scipy.sparse.csr_matrix((np.ones(len(from_loc), dtype=np.int8),
+            (from_loc, to_loc)), shape=(self.num_nodes, self.num_nodes))
+        n_components, labels = scipy.sparse.csgraph.connected_components(graph,
+            directed=True, connection='strong')
+        keep = labels == np.bincount(labels).argmax()
+
+        self.logger.info('Found {:,} strongly connected components in {:,.2f} seconds; dropped {:,} of {:,} nodes outside the main component'.format(n_components,
+            time.time() - start_time, int((~keep).sum()), self.num_nodes))
+
+        return keep
+
     def _match_nn(self, secondary):
         '''
         Maps each the index of each node in the raw distance 
@@ -623,43 +1104,46 @@ class TransitMatrix(object):
         between the (primary/secondary) source and its nearest OSM node.
         '''
 
+        #binary for the scipy backend, csv for pyengine
+        extension = 'npz' if self.backend == 'scipy' else 'csv'
         if secondary:
-            self.nn_secondary_filename = self._get_output_filename("nn_secondary")
+            self.nn_secondary_filename = self._get_intermediate_filename("nn_secondary", extension)
             data = self.secondary_data
             filename = self.nn_secondary_filename
         else:
-            self.nn_primary_filename = self._get_output_filename("nn_primary")
+            self.nn_primary_filename = self._get_intermediate_filename("nn_primary", extension)
             self.nn_secondary_filename = self.nn_primary_filename
             data = self.primary_data
             filename = self.nn_primary_filename
 
         nodes = self.nodes[['x', 'y']]
-
-        node_indices = nodes.index
         start_time = time.time()
-        KM_TO_METERS = 1000
 
-        #make a kd tree in the lat, long dimension
-        node_array = pd.DataFrame.as_matrix(nodes)
-        kd_tree = scipy.spatial.cKDTree(node_array)
+        #make a kd tree of the nodes projected to meters
+        #(source data x is latitude, y is longitude)
+        lat0 = nodes['y'].mean()
+        kd_tree = scipy.spatial.cKDTree(project_xy(nodes['y'].values, 
+            nodes['x'].values, lat0))
 
         #map each node in the source/dest data to the nearest
-        #corresponding node in the OSM network
-        #and write to file
-        with open(filename, 'w') as csvfile_w:
-            writer = csv.writer(csvfile_w)
-            for row in data.itertuples():
-                origin_id, origin_y, origin_x = row
-                latlong_diff, node_loc = kd_tree.query([origin_x, origin_y],k=1)
-                node_number = node_indices[node_loc]
-                distance = vincenty((origin_y, origin_x), (nodes.loc[node_number].y, 
-                    nodes.loc[node_number].x)).km
-
-                distance = int(distance * KM_TO_METERS)
-
-                writer.writerow([node_loc, origin_id, distance])
+        #corresponding node in the OSM network in one query
+        points = project_xy(data['x'].values, data['y'].values, lat0)
+        node_dist, node_loc = kd_tree.query(points, k=1)
+        distance = vincenty_distance(data['x'].values, data['y'].values,
+            nodes['y'].values[node_loc], nodes['x'].values[node_loc])
+        self.nn_matches[filename] = (node_loc, data.index.values, distance.astype(np.int64))
+        matched_nodes = np.unique(node_loc)
 
         self.logger.info('Nearest Neighbor matching completed in {:,.2f} seconds'.format(time.time() - start_time))
+        self.logger.info('{:,} points snapped to {:,} unique nodes (dedup ratio: {:,.2f})'.format(len(data),
+            len(matched_nodes), len(data) / max(len(matched_nodes), 1)))
+
+        #points that would have snapped to a dropped island
+        if self.island_nodes is not None and len(self.island_nodes):
+            island_tree = scipy.spatial.cKDTree(project_xy(self.island_nodes['y'].values,
+                self.island_nodes['x'].values, lat0))
+            island_dist, _ = island_tree.query(points, k=1)
+            self.logger.info('{:,} points were snapped to the main component instead of a dropped island node'.format(int((island_dist < node_dist).sum())))
 
 
 
@@ -682,20 +1166,10 @@ class TransitMatrix(object):
         print("Cleaned up calculation artifacts")
 
 
-    def process(self, speed_limit_filename=None, output_filename=None, 
-                cleanup=True, debug=False):
+    def _load_all(self, speed_limit_filename):
         '''
-        Process the data.
+        Load the inputs, parameters and speed limit table.
         '''
-
-        self.set_logging(debug)
-
-        #load from file if given
-        if self.read_from_file:
-            self.logger.info('Loading data from file: {}'.format(self.read_from_file))
-            self._calc_shortest_path()
-            return
-
         #sanity check
         if self.network_type == 'drive':
             if not speed_limit_filename:
@@ -714,9 +1188,15 @@ class TransitMatrix(object):
 
         self._load_sl_data(speed_limit_filename)
 
-        start_time = time.time()
 
-        self._set_output_filename(output_filename)
+    def prepare(self, speed_limit_filename=None, debug=False):
+        '''
+        Fetch and prepare the network around the data points for route()
+        without computing a matrix.
+        '''
+        self.set_logging(debug)
+        start_time = time.time()
+        self._load_all(speed_limit_filename)
 
         self._request_network()
 
@@ -724,6 +1204,110 @@ class TransitMatrix(object):
         if self.secondary_input:
             self._match_nn(True)
 
+        self._simplify_network()
+
+        self.logger.info('Prepared the network in {:,.2f} seconds'.format(time.time() - start_time))
+
+
+    def _get_router(self):
+        '''
+        Build (once) the router over the prepared network, as it was
+        before simplification.
+        '''
+        if self.router is None:
+            assert self.route_network is not None, "prepare() or process() the network first (not from a resumed checkpoint)"
+            nodes, (from_loc, to_loc, impedence) = self.route_network
+            graph = edges_to_csr(from_loc, to_loc, impedence.astype(np.float64), len(nodes))
+            self.router_lat0 = nodes['y'].mean()
+            self.router = networkRouter(graph, project_xy(nodes['y'].values,
+                nodes['x'].values, self.router_lat0))
+
+        return self.router
+
+
+    def route(self, origin, dest, geometry=False):
+        '''
+        Find the travel time from origin to dest ((lat, lon) pairs) the
+        way the matrix would: both points are snapped to the nearest
+        network node and their last miles added. The prepared graph and
+        KD tree stay loaded between queries.
+        Returns: seconds (-1 if unreachable), and if geometry, the
+        shapely LineString (lon, lat) from origin through the network
+        nodes on the path to dest
+        '''
+        router = self._get_router()
+        nodes = self.route_network[0]
+        lat = np.array([origin[0], dest[0]], dtype=np.float64)
+        lon = np.array([origin[1], dest[1]], dtype=np.float64)
+        _, (src_node, dst_node) = router.nearest(project_xy(lat, lon, self.router_lat0))
+        distance = vincenty_distance(lat, lon, nodes['y'].values[[src_node, dst_node]],
+            nodes['x'].values[[src_node, dst_node]]).astype(np.int64)
+        src_imp, dst_imp = last_mile(distance[:1], distance[1:], self._get_impedence_constant())
+
+        cost, path = router.shortest_path(src_node, dst_node)
+        if src_node == dst_node:
+            seconds = 0
+        elif math.isinf(cost):
+            seconds = UNREACHABLE
+        else:
+            seconds = int(cost) + int(src_imp[0]) + int(dst_imp[0])
+        if not geometry:
+            return seconds
+
+        coords = [(origin[1], origin[0])]
+        coords += list(zip(nodes['x'].values[path], nodes['y'].values[path]))
+        coords.append((dest[1], dest[0]))
+
+        return seconds, LineString(coords)
+
+
+    def process(self, speed_limit_filename=None, output_filename=None, 
+                cleanup=True, debug=False):
+        '''
+        Process the data.
+        '''
+
+        self.set_logging(debug)
+
+        #load from file if given
+        if self.read_from_file:
+            self.logger.info('Loading data from file: {}'.format(self.read_from_file))
+            self._calc_shortest_path()
+            return
+
+        self._load_all(speed_limit_filename)
+
+        start_time = time.time()
+
+        self._set_output_filename(output_filename)
+
+        if self.checkpoint_dir:
+            self.checkpoint = blockCheckpoint(self.checkpoint_dir,
+                shared=self.shared_checkpoint)
+            if not self.resume:
+                self.checkpoint.reset()
+
+        if not (self.resume and self._restore_checkpoint_inputs()):
+            #blocks computed from inputs that had to be rebuilt can't be trusted
+            if self.checkpoint and self.resume:
+                self.logger.warning('Could not reuse the network and nn files in {}, starting over'.format(self.checkpoint_dir))
+                self.checkpoint.reset()
+
+            self._request_network()
+
+            self._match_nn(False)
+            if self.secondary_input:
+                self._match_nn(True)
+
+            self._simplify_network()
+
+            self._write_network()
+
+            if self.checkpoint:
+                self._save_checkpoint_inputs()
+
+        self._plan_run()
+
         self._calc_shortest_path()
 
         self._cleanup_artifacts(cleanup)
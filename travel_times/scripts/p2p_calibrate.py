@@ -1,6 +1,8 @@
 import requests
 import random
 from p2p import TransitMatrix
+from p2p_engine import load_network, read_nn, shortest_paths
+from p2p_ch import CHIndex
 import pandas as pd
 import numpy as np
 import sys
@@ -121,3 +123,32 @@ def calibrate(network_type='walk', input_file='resources/LEHD_blocks.csv',
 
         sample_one_matrix(df.sample(sample_size), tm, gh_type_name, api_key)
     
+
+
+def check_ch_exactness(network_type='walk', primary_input='data/ORIG/tracts2010.csv',
+    secondary_input='data/DEST/health_chicago.csv', sl_file=None):
+    '''
+    Check that the contraction hierarchy index gives exactly the same
+    network times as plain Dijkstra for the points in the input files
+    (by default the bundled tracts and health facilities).
+    Returns the number of mismatched pairs (0 if the index is exact).
+    '''
+    primary_hints = {'xcol':'lat', 'ycol':'lon', 'idx':'geoid10'}
+    secondary_hints = {'xcol':'lat', 'ycol':'lon', 'idx':'agency_id'}
+    tm = TransitMatrix(network_type=network_type, primary_input=primary_input,
+        secondary_input=secondary_input, primary_hints=primary_hints,
+        secondary_hints=secondary_hints, backend='scipy')
+    tm.process(speed_limit_filename=sl_file, cleanup=False)
+
+    graph = load_network(tm.network_filename, tm.num_nodes)
+    sources = read_nn(tm.nn_primary_filename)[0]
+    targets = read_nn(tm.nn_secondary_filename)[0]
+    ch = CHIndex.for_network(tm.network_filename, tm.num_nodes)
+
+    plain = np.vstack([block for row, block in shortest_paths(graph, sources, targets)])
+    indexed = np.vstack([block for row, block in ch.many_to_many(sources, targets)])
+    mismatches = int((plain != indexed).sum())
+
+    print('compared {} pairs, {} mismatches'.format(plain.size, mismatches))
+
+    return mismatches
@@ -0,0 +1,133 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import logging, os, time
+from p2p_engine import shortest_paths, finalize_block, UNREACHABLE, ROWS_PER_TASK
+
+# Facility catchments (network isochrones) for p2p. Instead of a matrix,
+# one search is run from each facility over the reversed network, bounded
+# at the largest time threshold, so the cost depends on the number of
+# facilities and not on the number of origins. For every facility and
+# threshold this gives the origins within the threshold (with their times)
+# and a catchment polygon around the network nodes and origins reached.
+
+logger = logging.getLogger(__name__)
+
+#concave hull ratio of the polygons (0 follows the reached points most
+#closely, 1 gives their convex hull)
+HULL_RATIO = 0.3
+
+#buffer (degrees, ~50m) around catchments too small to span a polygon
+POINT_BUFFER = 0.0005
+
+
+def _polygon(xy):
+    '''
+    Concave hull of (N, 2) lon/lat points, as a polygon.
+    '''
+    if not len(xy):
+        return shapely.Polygon()
+    hull = shapely.concave_hull(shapely.multipoints(xy), ratio=HULL_RATIO)
+    if hull.geom_type != 'Polygon':
+        hull = hull.buffer(POINT_BUFFER)
+
+    return hull
+
+
+class catchmentSearch(object):
+    '''
+    A catchment request: time thresholds (seconds) and the lon/lat of
+    the network nodes and of the origins (aligned with the primary nn
+    file) to draw polygons with.
+    '''
+    def __init__(self, thresholds, node_xy, origin_xy):
+        assert len(thresholds) and min(thresholds) > 0, "need positive thresholds"
+        self.thresholds = sorted(thresholds)
+        self.node_xy = np.asarray(node_xy)
+        self.origin_xy = np.asarray(origin_xy)
+
+
+    def results(self, graph, org_loc, org_ids, org_imp, fac_loc, fac_ids, fac_imp,
+        num_threads=1, rows_per_task=ROWS_PER_TASK):
+        '''
+        Search from every facility (one search per node) over the
+        reversed graph, out to the largest threshold. Origin times are
+        the usual matrix times (origin to facility, last miles included).
+        Returns: catchmentSet, ordered by facility
+        '''
+        start_time = time.time()
+        limit = self.thresholds[-1]
+        reverse = graph.T.tocsr()
+        unique_fac, fac_inv = np.unique(fac_loc, return_inverse=True)
+        logger.info('Searching {:,} catchments from {:,} nodes out to {} seconds'.format(len(fac_loc),
+            len(unique_fac), limit))
+
+        catchments = []
+        members = []
+        for row, block in shortest_paths(reverse, unique_fac, np.arange(graph.shape[0]),
+            num_threads, limit, rows_per_task):
+            #facilities snapped to the nodes searched in this block
+            facs = np.flatnonzero((fac_inv >= row) & (fac_inv < row + len(block)))
+            node_times = block[fac_inv[facs] - row]
+            result = finalize_block(node_times[:, org_loc].T, org_loc, fac_loc[facs],
+                org_imp, fac_imp[facs], limit).T
+            for f, times, origin_times in zip(facs, node_times, result):
+                reached = np.flatnonzero(origin_times != UNREACHABLE)
+                reached = reached[np.argsort(origin_times[reached], kind='stable')]
+                members.append((np.full(len(reached), f), reached, origin_times[reached]))
+                #nodes by their time to the facility (with its last mile)
+                times = times + fac_imp[f]
+                for threshold in self.thresholds:
+                    inside = reached[origin_times[reached] <= threshold]
+                    xy = np.concatenate([self.node_xy[times <= threshold], self.origin_xy[inside]])
+                    catchments.append((f, threshold, len(inside), _polygon(xy)))
+
+        catchments.sort(key=lambda catchment: (catchment[0], catchment[1]))
+        catchments = gpd.GeoDataFrame({'facility': [fac_ids[f] for f, _, _, _ in catchments],
+            'threshold': [threshold for _, threshold, _, _ in catchments],
+            'origins': [count for _, _, count, _ in catchments]},
+            geometry=[polygon for _, _, _, polygon in catchments], crs='EPSG:4326')
+
+        if members:
+            facs, origins, seconds = (np.concatenate(column) for column in zip(*members))
+        else:
+            facs, origins, seconds = (np.zeros(0, dtype=np.int64) for _ in range(3))
+        order = np.argsort(facs, kind='stable')
+        facs, origins, seconds = facs[order], origins[order], seconds[order]
+        members = gpd.GeoDataFrame({'facility': np.asarray(fac_ids)[facs].astype(str),
+            'origin': np.asarray(org_ids)[origins].astype(str),
+            'seconds': seconds.astype(np.int32)},
+            geometry=gpd.points_from_xy(self.origin_xy[origins, 0], self.origin_xy[origins, 1]),
+            crs='EPSG:4326')
+
+        logger.info('Found {:,} catchments holding {:,} origin facility pairs in {:,.2f} seconds'.format(len(catchments),
+            len(members), time.time() - start_time))
+
+        return catchmentSet(catchments, members)
+
+
+class catchmentSet(object):
+    '''
+    The catchments (GeoDataFrame of facility, threshold, origins and
+    polygon) and their members (GeoDataFrame of facility, origin,
+    seconds and the origin's point) of a catchmentSearch.
+    '''
+    def __init__(self, catchments, members):
+        self.catchments = catchments
+        self.members = members
+
+
+    def save(self, filename):
+        '''
+        Write to a GeoPackage (layers 'catchments' and 'members'), or to
+        GeoParquet files when filename ends in .parquet (members go to
+        <name>_members.parquet).
+        '''
+        if filename.endswith('.parquet'):
+            self.catchments.to_parquet(filename)
+            self.members.to_parquet('{}_members.parquet'.format(os.path.splitext(filename)[0]))
+            return
+        if os.path.isfile(filename):
+            os.remove(filename)
+        self.catchments.to_file(filename, layer='catchments', driver='GPKG')
+        self.members.to_file(filename, layer='members', driver='GPKG')
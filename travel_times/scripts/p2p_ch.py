@@ -0,0 +1,256 @@
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+import hashlib, heapq, logging, os.path, time
+from p2p_engine import load_network
+
+# Contraction hierarchies (CH) for p2p. The index is built once per
+# prepared edge list and cached next to it, after which any new set of
+# sources and destinations on that network can be answered with a
+# many-to-many bucket query instead of full Dijkstra searches.
+
+logger = logging.getLogger(__name__)
+
+#witness searches give up after settling this many nodes (a failed
+#witness search only costs an extra shortcut, never correctness)
+WITNESS_SETTLE_LIMIT = 60
+
+#number of upward searches run at once (each needs a dense row of N)
+SEARCHES_PER_CHUNK = 16
+
+
+def network_hash(filename):
+    '''
+    Return the sha1 of an edge list file.
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def _upward_search(graph, sources, limit):
+    '''
+    Dijkstra restricted to the upward graph of a CH from each source.
+    Returns: (source positions, settled nodes, distances)
+    '''
+    dist = dijkstra(graph, directed=True, indices=sources, limit=limit)
+    rows, nodes = np.nonzero(np.isfinite(dist))
+
+    return rows, nodes, dist[rows, nodes]
+
+
+class CHIndex(object):
+    '''
+    A contraction hierarchy over a directed p2p network.
+    fwd holds the upward edges used by searches from sources and
+    bwd the (reversed) upward edges used by searches from targets.
+    '''
+    def __init__(self, num_nodes, rank, fwd, bwd, source_hash=None):
+        self.num_nodes = num_nodes
+        self.rank = rank
+        self.fwd = fwd
+        self.bwd = bwd
+        self.source_hash = source_hash
+
+
+    @classmethod
+    def build(cls, graph, source_hash=None):
+        '''
+        Contract every node of a CSR graph, in order of edge difference
+        with lazy updates, and return the resulting index.
+        '''
+        start_time = time.time()
+        N = graph.shape[0]
+        graph = graph.tocoo()
+        out_edges = [dict() for _ in range(N)]
+        in_edges = [dict() for _ in range(N)]
+        for u, v, w in zip(graph.row.tolist(), graph.col.tolist(), graph.data.tolist()):
+            if u != v:
+                out_edges[u][v] = w
+                in_edges[v][u] = w
+
+        def witness(u, skip, targets, max_cost):
+            #bounded dijkstra from u that avoids the node being contracted
+            dist = {u: 0}
+            heap = [(0, u)]
+            settled = 0
+            remaining = set(targets)
+            while heap and remaining and settled < WITNESS_SETTLE_LIMIT:
+                d, x = heapq.heappop(heap)
+                if d > dist.get(x, np.inf):
+                    continue
+                if d > max_cost:
+                    break
+                remaining.discard(x)
+                settled += 1
+                for y, w in out_edges[x].items():
+                    if y == skip:
+                        continue
+                    nd = d + w
+                    if nd < dist.get(y, np.inf):
+                        dist[y] = nd
+                        heapq.heappush(heap, (nd, y))
+            return dist
+
+        def shortcuts(v):
+            #shortcuts needed if v were contracted now
+            needed = []
+            outs = out_edges[v]
+            for u, w_in in in_edges[v].items():
+                targets = [w for w in outs if w != u]
+                if not targets:
+                    continue
+                max_cost = w_in + max(outs[w] for w in targets)
+                dist = witness(u, v, targets, max_cost)
+                for w in targets:
+                    cost = w_in + outs[w]
+                    if dist.get(w, np.inf) > cost:
+                        needed.append((u, w, cost))
+            return needed
+
+        deleted = [0] * N
+        heap = [(len(in_edges[v]) * len(out_edges[v]) - len(in_edges[v]) - len(out_edges[v]), v)
+            for v in range(N)]
+        heapq.heapify(heap)
+        contracted = bytearray(N)
+        rank = np.empty(N, dtype=np.int64)
+        fwd = ([], [], [])
+        bwd = ([], [], [])
+        order = 0
+        n_shortcuts = 0
+        while heap:
+            priority, v = heapq.heappop(heap)
+            if contracted[v]:
+                continue
+            needed = shortcuts(v)
+            priority = len(needed) - len(in_edges[v]) - len(out_edges[v]) + deleted[v]
+            if heap and priority > heap[0][0]:
+                heapq.heappush(heap, (priority, v))
+                continue
+
+            #every remaining neighbor will rank above v
+            for w, c in out_edges[v].items():
+                fwd[0].append(v)
+                fwd[1].append(w)
+                fwd[2].append(c)
+                del in_edges[w][v]
+                deleted[w] += 1
+            for u, c in in_edges[v].items():
+                bwd[0].append(v)
+                bwd[1].append(u)
+                bwd[2].append(c)
+                del out_edges[u][v]
+                deleted[u] += 1
+            for u, w, c in needed:
+                if c < out_edges[u].get(w, np.inf):
+                    out_edges[u][w] = c
+                    in_edges[w][u] = c
+                    n_shortcuts += 1
+            out_edges[v] = {}
+            in_edges[v] = {}
+            contracted[v] = 1
+            rank[v] = order
+            order += 1
+
+        def to_csr(edges):
+            return scipy.sparse.csr_matrix((np.array(edges[2], dtype=np.float64),
+                (np.array(edges[0], dtype=np.int64), np.array(edges[1], dtype=np.int64))),
+                shape=(N, N))
+
+        logger.info('Built contraction hierarchy with {:,} shortcuts in {:,.2f} seconds'.format(n_shortcuts,
+            time.time() - start_time))
+
+        return cls(N, rank, to_csr(fwd), to_csr(bwd), source_hash)
+
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Load an index written by save().
+        '''
+        with np.load(filename) as data:
+            N = int(data['num_nodes'])
+            fwd = scipy.sparse.csr_matrix((data['fwd_data'], data['fwd_indices'],
+                data['fwd_indptr']), shape=(N, N))
+            bwd = scipy.sparse.csr_matrix((data['bwd_data'], data['bwd_indices'],
+                data['bwd_indptr']), shape=(N, N))
+            return cls(N, data['rank'], fwd, bwd, str(data['source_hash']))
+
+
+    def save(self, filename):
+        '''
+        Write the index to a .npz file.
+        '''
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, num_nodes=self.num_nodes, rank=self.rank,
+                fwd_indptr=self.fwd.indptr, fwd_indices=self.fwd.indices,
+                fwd_data=self.fwd.data, bwd_indptr=self.bwd.indptr,
+                bwd_indices=self.bwd.indices, bwd_data=self.bwd.data,
+                source_hash=str(self.source_hash))
+
+
+    @classmethod
+    def for_network(cls, network_filename, num_nodes, cache_dir=None):
+        '''
+        Return the index for an edge list, loading it from the cache in
+        cache_dir (by default next to the edge list) or building (and
+        caching) it.
+        '''
+        source_hash = network_hash(network_filename)
+        if cache_dir is None:
+            cache_dir = os.path.dirname(network_filename)
+        filename = os.path.join(cache_dir, 'ch_{}.npz'.format(source_hash[:16]))
+        if os.path.isfile(filename):
+            index = cls.load(filename)
+            if index.source_hash == source_hash and index.num_nodes == num_nodes:
+                logger.info('Loaded contraction hierarchy from: {}'.format(filename))
+                return index
+
+        index = cls.build(load_network(network_filename, num_nodes), source_hash)
+        index.save(filename)
+        logger.info('Wrote contraction hierarchy to: {}'.format(filename))
+
+        return index
+
+
+    def many_to_many(self, sources, targets, limit=np.inf):
+        '''
+        Generator over (start row, block) of network times from sources
+        to targets (inf if unreachable or beyond limit), using one
+        backward search per target and one forward search per source.
+        '''
+        #bucket every node reached by a backward search with (target, dist)
+        bucket_v = [np.empty(0, dtype=np.int64)]
+        bucket_t = [np.empty(0, dtype=np.int64)]
+        bucket_d = [np.empty(0)]
+        for col in range(0, len(targets), SEARCHES_PER_CHUNK):
+            cols, nodes, dists = _upward_search(self.bwd,
+                targets[col:col + SEARCHES_PER_CHUNK], limit)
+            bucket_v.append(nodes)
+            bucket_t.append(cols + col)
+            bucket_d.append(dists)
+        bucket_v = np.concatenate(bucket_v)
+        order = np.argsort(bucket_v, kind='stable')
+        bucket_v = bucket_v[order]
+        bucket_t = np.concatenate(bucket_t)[order]
+        bucket_d = np.concatenate(bucket_d)[order]
+        bucket_ptr = np.searchsorted(bucket_v, np.arange(self.num_nodes + 1))
+
+        for row in range(0, len(sources), SEARCHES_PER_CHUNK):
+            chunk = sources[row:row + SEARCHES_PER_CHUNK]
+            block = np.full((len(chunk), len(targets)), np.inf)
+            rows, nodes, dists = _upward_search(self.fwd, chunk, limit)
+            starts = bucket_ptr[nodes]
+            lengths = bucket_ptr[nodes + 1] - starts
+            total = lengths.sum()
+            if total:
+                #indices of every bucket entry at the settled nodes
+                offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                idx = offsets + np.arange(total)
+                cells = np.repeat(rows, lengths) * len(targets) + bucket_t[idx]
+                np.minimum.at(block.ravel(), cells, np.repeat(dists, lengths) + bucket_d[idx])
+            block[block > limit] = np.inf
+            yield row, block
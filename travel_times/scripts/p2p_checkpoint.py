@@ -0,0 +1,466 @@
+import numpy as np
+import glob, hashlib, json, logging, multiprocessing, os, socket, sys, threading, time, uuid
+from p2p_engine import (network_times, finalize_block, sparse_rows, load_network, read_nn,
+    last_mile, ROWS_PER_TASK)
+
+# Checkpointed matrix generation for p2p. The rows of the matrix are split
+# into fixed size blocks that a process pool computes independently. Each
+# finished block is written atomically to its own part file and recorded
+# in a manifest, so a run that dies can be resumed without recomputing
+# the blocks (or re-downloading the network) it already finished. With
+# max_time, part files only hold the pairs within it.
+#
+# A shared checkpoint lives in a directory several hosts can reach. The
+# coordinator (TransitMatrix) publishes the network, nn files and layout
+# in the manifest, and it and any workers started on other hosts
+# (python p2p_checkpoint.py <directory>) claim blocks by creating a lock
+# file for each. Locks are touched while their block runs, so the block
+# of a worker that died is claimed again once its lock goes stale.
+
+logger = logging.getLogger(__name__)
+
+#rows per part file
+BLOCK_ROWS = 2048
+
+MANIFEST = 'manifest.json'
+
+#seconds without a heartbeat before a claimed block is claimed again
+STALE_AFTER = 300
+
+#seconds between checks on blocks claimed by other processes
+POLL_SECONDS = 2
+
+#state shared with worker processes (set by _init_worker)
+_worker_args = None
+
+
+def hash_files(filenames, digest=None):
+    '''
+    Hash the contents of files (added to digest, if given).
+    Returns: hex digest
+    '''
+    digest = digest or hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _atomic_json(filename, data):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as outfile:
+        json.dump(data, outfile)
+    os.replace(temp_filename, filename)
+
+
+class blockCheckpoint(object):
+    '''
+    A directory of part files (one finalized block of rows each, dense
+    or, if sparse, as the pairs kept) and the manifest that records
+    which blocks are complete, along with the intermediate files
+    (network, nn) of the run and a hash of them. If shared, blocks
+    are claimed through lock files so that other processes (see
+    run_worker) can compute some of them.
+    '''
+    def __init__(self, directory, block_rows=BLOCK_ROWS, shared=False,
+        stale_after=STALE_AFTER):
+        self.directory = directory
+        self.block_rows = block_rows
+        self.shared = shared
+        self.stale_after = stale_after
+        self.sparse = False
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._load()
+
+
+    def _load(self):
+        filename = os.path.join(self.directory, MANIFEST)
+        if not os.path.isfile(filename):
+            return {'done': []}
+        with open(filename) as json_data:
+            return json.load(json_data)
+
+
+    def save(self):
+        '''
+        Write the manifest (atomically).
+        '''
+        _atomic_json(os.path.join(self.directory, MANIFEST), self.manifest)
+
+
+    def reset(self, keep_inputs=False):
+        '''
+        Forget every completed block (and input, unless keep_inputs), and
+        remove the part and lock files left behind.
+        '''
+        for filename in glob.glob(self.path('part_*')):
+            os.remove(filename)
+        inputs = self.manifest.get('inputs')
+        self.manifest = {'done': [], 'run_id': uuid.uuid4().hex}
+        if keep_inputs and inputs:
+            self.manifest['inputs'] = inputs
+        self.save()
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def part_filename(self, block):
+        return self.path('part_{:05d}.{}'.format(block, 'npz' if self.sparse else 'npy'))
+
+
+    def lock_filename(self, block):
+        return self.path('part_{:05d}.lock'.format(block))
+
+
+    def is_done(self, block):
+        '''
+        Whether a block is complete. In a shared checkpoint, blocks
+        finished by other processes only show up as part files.
+        '''
+        if not os.path.isfile(self.part_filename(block)):
+            return False
+        return self.shared or block in self.manifest['done']
+
+
+    def mark_done(self, block):
+        if block not in self.manifest['done']:
+            self.manifest['done'].append(block)
+        self.save()
+
+
+    def bounds(self, n_rows):
+        '''
+        The (block, start row, end row) of every block.
+        '''
+        return [(block, start, min(start + self.block_rows, n_rows))
+            for block, start in enumerate(range(0, n_rows, self.block_rows))]
+
+
+    def check_inputs(self, network_filename, nn_primary_filename, nn_secondary_filename,
+        impedence):
+        '''
+        Record a hash of the network and nn files and the last mile
+        impedence, forgetting the completed blocks if they were computed
+        from different ones.
+        '''
+        inputs_hash = hash_files((network_filename, nn_primary_filename, nn_secondary_filename),
+            hashlib.sha1(repr(float(impedence)).encode()))
+        if self.manifest['done'] and self.manifest.get('inputs_hash') != inputs_hash:
+            logger.warning('The network or nn files changed since the blocks in {} were computed, starting over'.format(self.directory))
+            self.reset(keep_inputs=True)
+        self.manifest['inputs_hash'] = inputs_hash
+        self.save()
+
+
+    def check_layout(self, n_rows, n_cols, block_rows, max_time, sparse=False):
+        '''
+        Record the matrix layout, or make sure it matches the one the
+        completed blocks were computed with.
+        '''
+        layout = {'n_rows': int(n_rows), 'n_cols': int(n_cols),
+            'block_rows': int(block_rows), 'max_time': max_time, 'sparse': sparse}
+        if self.manifest['done']:
+            assert dict({'sparse': False}, **self.manifest.get('layout', {})) == layout, "checkpoint in {} was computed with a different layout: {}".format(self.directory,
+                self.manifest.get('layout'))
+        self.manifest['layout'] = layout
+        self.save()
+
+
+    def publish_job(self, network_filename, nn_primary_filename,
+        nn_secondary_filename, num_nodes, impedence, rows_per_task=ROWS_PER_TASK):
+        '''
+        Record what workers need to compute blocks: the network and nn
+        files (relative to the checkpoint directory, which may be mounted
+        elsewhere on other hosts) and the last mile impedence.
+        '''
+        self.manifest['job'] = {'network_filename': os.path.relpath(network_filename, self.directory),
+            'nn_primary_filename': os.path.relpath(nn_primary_filename, self.directory),
+            'nn_secondary_filename': os.path.relpath(nn_secondary_filename, self.directory),
+            'num_nodes': int(num_nodes), 'impedence': float(impedence),
+            'rows_per_task': int(rows_per_task)}
+        self.save()
+
+
+    def claim(self, block):
+        '''
+        Try to claim a block by creating its lock file, taking over a
+        lock that hasn't been touched for stale_after seconds.
+        Returns: True if this process now holds the block
+        '''
+        lock_filename = self.lock_filename(block)
+        for attempt in range(2):
+            try:
+                fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(lock_filename)
+                except FileNotFoundError:
+                    continue
+                if attempt or age < self.stale_after:
+                    return False
+                logger.warning('Claiming block {} again (its lock was last touched {:,.0f} seconds ago)'.format(block,
+                    age))
+                self.release(block)
+                continue
+            with os.fdopen(fd, 'w') as outfile:
+                outfile.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+            #finished while this process was looking
+            if os.path.isfile(self.part_filename(block)):
+                self.release(block)
+                return False
+            return True
+
+        return False
+
+
+    def release(self, block):
+        try:
+            os.remove(self.lock_filename(block))
+        except FileNotFoundError:
+            pass
+
+
+    def _heartbeat(self, block, stop):
+        while not stop.wait(self.stale_after / 4):
+            try:
+                os.utime(self.lock_filename(block))
+            except FileNotFoundError:
+                pass
+
+
+    def claim_and_run(self, task):
+        '''
+        Compute a block unless another process holds it, touching its
+        lock while it runs. The lock is released whether or not the block
+        finishes, so a block that failed can be claimed again right away.
+        Returns: the block, or None if it is held elsewhere
+        '''
+        block, start, end, part_filename = task
+        if not self.claim(block):
+            return None
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(block, stop), daemon=True)
+        heartbeat.start()
+        unchecked_filename = '{}.{}.unchecked'.format(part_filename, os.getpid())
+        try:
+            _run_block((block, start, end, unchecked_filename))
+            #don't mix a block of an older job into the directory
+            if self._load().get('run_id') != self.manifest.get('run_id'):
+                os.remove(unchecked_filename)
+                return None
+            os.replace(unchecked_filename, part_filename)
+            return block
+        finally:
+            stop.set()
+            heartbeat.join()
+            self.release(block)
+
+
+    def _run_shared(self, pending, num_threads, args):
+        '''
+        Compute the blocks this process can claim, then wait for the
+        ones claimed by other processes, claiming any that are released
+        or go stale.
+        '''
+        if num_threads > 1 and len(pending) > 1:
+            pool = multiprocessing.Pool(min(num_threads, len(pending)),
+                initializer=_init_worker, initargs=args)
+            try:
+                computed = [block for block in pool.imap_unordered(self.claim_and_run, pending)
+                    if block is not None]
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            _init_worker(*args)
+            computed = [block for block in map(self.claim_and_run, pending)
+                if block is not None]
+        logger.info('Computed {:,} of {:,} pending blocks here'.format(len(computed), len(pending)))
+
+        _init_worker(*args)
+        waiting = pending
+        while True:
+            waiting = [task for task in waiting if not os.path.isfile(task[3])]
+            if not waiting:
+                break
+            logger.debug('Waiting on {:,} blocks claimed by other workers'.format(len(waiting)))
+            for task in waiting:
+                self.claim_and_run(task)
+            time.sleep(POLL_SECONDS)
+
+
+    def results(self, graph, src_loc, dst_loc, src_imp, dst_imp,
+        num_threads=1, limit=np.inf, max_time=None, ch=None, rows_per_task=ROWS_PER_TASK,
+        sparse=False):
+        '''
+        Generator over (positions, finalized block) for every block of
+        rows, in order. Blocks missing from the checkpoint are computed by
+        num_threads processes (and, if shared, any workers) and written to
+        part files first; completed blocks are read back from their part
+        files. If sparse, blocks are kept (and given) as the reachable
+        pairs, (count per row, col positions, times) (see
+        p2p_engine.sparse_rows).
+        '''
+        n_rows = len(src_loc)
+        self.sparse = sparse
+        #blocks already completed fix the block size
+        if self.manifest['done'] and 'layout' in self.manifest:
+            self.block_rows = self.manifest['layout']['block_rows']
+        self.check_layout(n_rows, len(dst_loc), self.block_rows, max_time, sparse)
+        bounds = self.bounds(n_rows)
+        pending = [(block, start, end, self.part_filename(block))
+            for block, start, end in bounds if not self.is_done(block)]
+        logger.info('{:,} of {:,} blocks already complete in {}'.format(len(bounds) - len(pending),
+            len(bounds), self.directory))
+
+        args = (graph, src_loc, dst_loc, src_imp, dst_imp, limit, max_time, ch, rows_per_task,
+            sparse)
+        if self.shared:
+            self._run_shared(pending, num_threads, args)
+            pending = []
+        if num_threads > 1 and len(pending) > 1:
+            pool = multiprocessing.Pool(min(num_threads, len(pending)),
+                initializer=_init_worker, initargs=args)
+            computed = pool.imap(_run_block, pending)
+        else:
+            pool = None
+            _init_worker(*args)
+            computed = (_run_block(task) for task in pending)
+
+        try:
+            for block, start, end in bounds:
+                if self.shared:
+                    if block not in self.manifest['done']:
+                        self.mark_done(block)
+                elif not self.is_done(block):
+                    assert next(computed) == block
+                    self.mark_done(block)
+                    logger.info('Finished block {} of {}'.format(block + 1, len(bounds)))
+                if sparse:
+                    with np.load(self.part_filename(block)) as part:
+                        yield start + part['rows'], (part['counts'], part['cols'], part['times'])
+                else:
+                    yield np.arange(start, end), np.load(self.part_filename(block), mmap_mode='r')
+        finally:
+            #blocks still running when the run stops are redone on resume
+            if pool:
+                pool.terminate()
+                pool.join()
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _run_block(task):
+    '''
+    Compute and finalize one block of rows and write its part file
+    (the positions in the block, count per row, col positions and times
+    of the reachable pairs, if sparse).
+    '''
+    block, start, end, part_filename = task
+    graph, src_loc, dst_loc, src_imp, dst_imp, limit, max_time, ch, rows_per_task, sparse = _worker_args
+    if sparse:
+        pieces = []
+    else:
+        result = np.empty((end - start, len(dst_loc)), dtype=np.int32)
+    for rows, times in network_times(graph, src_loc[start:end], dst_loc, 1, limit, ch,
+        rows_per_task):
+        finalized = finalize_block(times, src_loc[start:end][rows], dst_loc,
+            src_imp[start:end][rows], dst_imp, max_time)
+        if sparse:
+            pieces.append((rows,) + sparse_rows(finalized))
+        else:
+            result[rows] = finalized
+
+    temp_filename = '{}.{}.tmp'.format(part_filename, os.getpid())
+    with open(temp_filename, 'wb') as outfile:
+        if sparse:
+            rows, counts, cols, times = (np.concatenate(column) for column in zip(*pieces))
+            np.savez(outfile, rows=rows, counts=counts, cols=cols, times=times)
+        else:
+            np.save(outfile, result)
+    os.replace(temp_filename, part_filename)
+
+    return block
+
+
+def _worker_loop(directory, stale_after, poll):
+    '''
+    Claim and compute the blocks of a shared checkpoint until all of
+    them are complete. Returns: the number of blocks computed
+    '''
+    checkpoint = blockCheckpoint(directory, shared=True, stale_after=stale_after)
+    #wait for the coordinator to publish the job
+    while not ('job' in checkpoint.manifest and 'layout' in checkpoint.manifest):
+        time.sleep(poll)
+        checkpoint.manifest = checkpoint._load()
+    run_id = checkpoint.manifest.get('run_id')
+    job = checkpoint.manifest['job']
+    layout = checkpoint.manifest['layout']
+    checkpoint.block_rows = layout['block_rows']
+    checkpoint.sparse = layout.get('sparse', False)
+
+    graph = load_network(checkpoint.path(job['network_filename']), job['num_nodes'])
+    src_loc, _, src_dist = read_nn(checkpoint.path(job['nn_primary_filename']))
+    dst_loc, _, dst_dist = read_nn(checkpoint.path(job['nn_secondary_filename']))
+    src_imp, dst_imp = last_mile(src_dist, dst_dist, job['impedence'])
+    max_time = layout['max_time']
+    limit = max_time if max_time is not None else np.inf
+    _init_worker(graph, src_loc, dst_loc, src_imp, dst_imp, limit, max_time, None,
+        job['rows_per_task'], checkpoint.sparse)
+
+    bounds = checkpoint.bounds(layout['n_rows'])
+    pending = [(block, start, end, checkpoint.part_filename(block))
+        for block, start, end in bounds]
+    computed = 0
+    while True:
+        pending = [task for task in pending if not os.path.isfile(task[3])]
+        if not pending:
+            break
+        #the coordinator started over with another job
+        if checkpoint._load().get('run_id') != run_id:
+            logger.warning('The job in {} changed, starting over'.format(directory))
+            return computed + _worker_loop(directory, stale_after, poll)
+        for task in pending:
+            if checkpoint.claim_and_run(task) is not None:
+                computed += 1
+                logger.info('Finished block {} of {}'.format(task[0] + 1, len(bounds)))
+                break
+        else:
+            time.sleep(poll)
+
+    return computed
+
+
+def run_worker(directory, num_workers=1, stale_after=STALE_AFTER, poll=POLL_SECONDS):
+    '''
+    Help compute the matrix of a shared checkpoint with num_workers
+    processes until every block is complete. directory is the
+    checkpoint_dir of a TransitMatrix run with shared_checkpoint, as
+    seen from this host; workers started before the coordinator wait
+    for it to publish the job.
+    Returns: the number of blocks computed here
+    '''
+    if num_workers == 1:
+        return _worker_loop(directory, stale_after, poll)
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        return sum(pool.starmap(_worker_loop, [(directory, stale_after, poll)] * num_workers))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    logger.info('Computed {:,} blocks'.format(run_worker(sys.argv[1], num_workers)))
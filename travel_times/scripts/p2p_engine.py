@@ -0,0 +1,823 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+import multiprocessing, csv, json, logging, time
+from p2p_matrix import binaryMatrixWriter, packedMatrix, nearestMatrix, indexedCsvMatrix, open_matrix
+
+# Pure python (numpy/scipy) shortest path engine for p2p. Reads the same
+# raw_network and nn files as pyengine and produces the same matrix, so
+# it can stand in for the C++ module on hosts where it won't build.
+
+logger = logging.getLogger(__name__)
+
+#matches the sentinel written by tmat.h for unreachable pairs
+UNREACHABLE = -1
+
+#number of search rows handed to a worker at once
+ROWS_PER_TASK = 64
+
+#graph shared with worker processes (set by _init_worker)
+_worker_graph = None
+_worker_cols = None
+_worker_limit = np.inf
+
+
+def write_network(filename, from_loc, to_loc, impedence):
+    '''
+    Write a raw_network edge list (from_loc, to_loc, impedence). A .npy
+    filename gets a binary (3, E) int64 array, anything else the csv
+    read by pyengine.
+    '''
+    edges = np.vstack([from_loc, to_loc, impedence]).astype(np.int64)
+    if filename.endswith('.npy'):
+        np.save(filename, edges)
+    else:
+        pd.DataFrame(edges.T).to_csv(filename, header=False, index=False)
+
+
+def load_network(filename, num_nodes):
+    '''
+    Load a raw_network edge list (from_loc, to_loc, impedence), either
+    .npy or csv, into a directed CSR graph with num_nodes vertices.
+    Parallel edges are reduced to the cheapest one, as Dijkstra would.
+    '''
+    if filename.endswith('.npy'):
+        edges = np.load(filename, mmap_mode='r')
+        return edges_to_csr(np.array(edges[0]), np.array(edges[1]),
+            edges[2].astype(np.float64), num_nodes)
+
+    edges = pd.read_csv(filename, header=None, names=['from', 'to', 'weight'],
+        dtype={'from': np.int64, 'to': np.int64, 'weight': np.float64})
+
+    return edges_to_csr(edges['from'].values, edges['to'].values,
+        edges['weight'].values, num_nodes)
+
+
+def edges_to_csr(from_loc, to_loc, weight, num_nodes):
+    '''
+    Build a CSR graph from edge arrays, keeping the cheapest of
+    any parallel edges. Zero weight edges are kept explicitly.
+    '''
+    order = np.lexsort((weight, to_loc, from_loc))
+    from_loc = from_loc[order]
+    to_loc = to_loc[order]
+    weight = weight[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (from_loc[1:] != from_loc[:-1]) | (to_loc[1:] != to_loc[:-1])
+
+    return scipy.sparse.csr_matrix((weight[keep], (from_loc[keep], to_loc[keep])),
+        shape=(num_nodes, num_nodes))
+
+
+def is_undirected(graph):
+    '''
+    True if every edge of a CSR graph has a reverse edge of the same
+    weight (so the network time from A to B equals B to A).
+    '''
+    graph = graph.tocsr(copy=True)
+    graph.sort_indices()
+    transpose = graph.T.tocsr()
+    transpose.sort_indices()
+
+    return (np.array_equal(graph.indptr, transpose.indptr) and
+        np.array_equal(graph.indices, transpose.indices) and
+        np.array_equal(graph.data, transpose.data))
+
+
+def collapse_chains(from_loc, to_loc, impedence, num_nodes, pinned):
+    '''
+    Merge chains of degree 2 nodes into single edges. A node is merged
+    away when it only passes traffic through: one edge in and one out
+    (one way) or both directions to exactly two neighbors (two way),
+    unless it is pinned (a boolean mask over the nodes, e.g. the nodes
+    points snap to). Chain edges get the sum of their impedences, so
+    shortest paths between the remaining nodes are unchanged.
+    Returns: the new (from_loc, to_loc, impedence), by new node position,
+    and the boolean mask of nodes kept
+    '''
+    from_loc = np.asarray(from_loc, dtype=np.int64)
+    to_loc = np.asarray(to_loc, dtype=np.int64)
+    impedence = np.asarray(impedence, dtype=np.int64)
+    in_degree = np.bincount(to_loc, minlength=num_nodes)
+    out_degree = np.bincount(from_loc, minlength=num_nodes)
+
+    #edges of each node, grouped by head and by tail
+    in_order = np.argsort(to_loc, kind='stable')
+    out_order = np.argsort(from_loc, kind='stable')
+    in_start = np.concatenate([[0], np.cumsum(in_degree)[:-1]])
+    out_start = np.concatenate([[0], np.cumsum(out_degree)[:-1]])
+    last = max(len(from_loc) - 1, 0)
+    in_a = from_loc[in_order[np.minimum(in_start, last)]]
+    in_b = from_loc[in_order[np.minimum(in_start + 1, last)]]
+    out_a = out_order[np.minimum(out_start, last)]
+    out_b = out_order[np.minimum(out_start + 1, last)]
+
+    one_way = (in_degree == 1) & (out_degree == 1) & (in_a != to_loc[out_a])
+    two_way = ((in_degree == 2) & (out_degree == 2) & (in_a != in_b) &
+        (np.minimum(in_a, in_b) == np.minimum(to_loc[out_a], to_loc[out_b])) &
+        (np.maximum(in_a, in_b) == np.maximum(to_loc[out_a], to_loc[out_b])))
+    self_loop = np.bincount(from_loc[from_loc == to_loc], minlength=num_nodes) > 0
+    merged = (one_way | two_way) & ~pinned & ~self_loop
+
+    #the edge a chain continues on after entering a merged node
+    #(the out edge that doesn't turn back)
+    next_edge = np.where(to_loc[out_a[to_loc]] != from_loc, out_a[to_loc], out_b[to_loc])
+
+    #follow every edge leaving a kept node to the next kept node
+    start = np.flatnonzero(~merged[from_loc])
+    end = start.copy()
+    cost = impedence[start].copy()
+    active = np.flatnonzero(merged[to_loc[end]])
+    while len(active):
+        end[active] = next_edge[end[active]]
+        cost[active] += impedence[end[active]]
+        active = active[merged[to_loc[end[active]]]]
+
+    keep = ~merged
+    new_loc = np.cumsum(keep) - 1
+    new_from = new_loc[from_loc[start]]
+    new_to = new_loc[to_loc[end]]
+    not_loop = new_from != new_to
+
+    return new_from[not_loop], new_to[not_loop], cost[not_loop], keep
+
+
+def count_edges(from_loc, to_loc, num_nodes):
+    '''
+    Count the edges of a directed edge list the way a network's
+    num_edges does: a two way edge (both directions present) once, and
+    a one way edge once.
+    '''
+    keys = np.asarray(from_loc, dtype=np.int64) * num_nodes + to_loc
+    reverse = np.asarray(to_loc, dtype=np.int64) * num_nodes + from_loc
+    two_way = np.isin(reverse, keys) & (keys != reverse)
+
+    return len(keys) - int(two_way.sum()) // 2
+
+
+def write_nn(filename, node_loc, ids, dist):
+    '''
+    Write a nn file (node location, id, last mile distance in meters).
+    A .npz filename gets binary arrays, anything else the csv read
+    by pyengine.
+    '''
+    if filename.endswith('.npz'):
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, loc=np.asarray(node_loc, dtype=np.int64),
+                id=np.asarray(ids, dtype=str), dist=np.asarray(dist, dtype=np.int64))
+    else:
+        pd.DataFrame({'loc': node_loc, 'id': ids, 'dist': dist}).to_csv(filename,
+            header=False, index=False)
+
+
+def read_nn(filename):
+    '''
+    Read a nn file written by TransitMatrix._match_nn (.npz or csv).
+    Returns: (node locations, ids, last mile distances in meters)
+    '''
+    if filename.endswith('.npz'):
+        with np.load(filename) as nn:
+            return nn['loc'], nn['id'].astype(object), nn['dist']
+
+    nn = pd.read_csv(filename, header=None, names=['loc', 'id', 'dist'],
+        dtype={'loc': np.int64, 'id': str, 'dist': np.int64})
+
+    return nn['loc'].values, nn['id'].values, nn['dist'].values
+
+
+def _init_worker(graph, cols, limit=np.inf):
+    '''
+    Share the graph, target columns and search limit with a worker process.
+    '''
+    global _worker_graph, _worker_cols, _worker_limit
+    _worker_graph = graph
+    _worker_cols = cols
+    _worker_limit = limit
+
+
+def _search_rows(sources):
+    '''
+    Run Dijkstra from each source node and keep only the target columns.
+    Searches stop expanding once they pass the limit.
+    '''
+    dist = dijkstra(_worker_graph, directed=True, indices=sources,
+        limit=_worker_limit)
+
+    return dist[:, _worker_cols]
+
+
+def shortest_paths(graph, sources, targets, num_threads=1, limit=np.inf,
+    rows_per_task=ROWS_PER_TASK):
+    '''
+    Generator over (start row, block) where block holds the network
+    times from a run of sources to every target node (inf if unreachable
+    or beyond limit). Searches are farmed out to num_threads processes,
+    rows_per_task sources at a time.
+    '''
+    tasks = [sources[i:i + rows_per_task] for i in range(0, len(sources), rows_per_task)]
+    if num_threads > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(num_threads, initializer=_init_worker,
+            initargs=(graph, targets, limit))
+        try:
+            row = 0
+            for block in pool.imap(_search_rows, tasks):
+                yield row, block
+                row += len(block)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(graph, targets, limit)
+        row = 0
+        for task in tasks:
+            block = _search_rows(task)
+            yield row, block
+            row += len(block)
+
+
+def network_times(graph, sources, targets, num_threads=1, limit=np.inf, ch=None,
+    rows_per_task=ROWS_PER_TASK):
+    '''
+    Generator over (positions, block) where block holds the network times
+    from the sources at the given positions to every target. Only one
+    search is run per unique node; rows sharing a node are expanded from
+    its result. When there are fewer unique targets than sources, the
+    searches run backwards from the targets over the transposed graph
+    (so oneway edges are still respected) and the times are transposed
+    back to the usual source by target orientation; they are held until
+    every search is done, densely (float32) or, with a limit, as the
+    pairs within it. If a contraction
+    hierarchy (ch) is given, its bucket query is used instead.
+    '''
+    order = np.argsort(sources, kind='stable')
+    unique_sources, first, counts = np.unique(sources[order], return_index=True,
+        return_counts=True)
+    bounds = np.append(first, len(sources))
+    unique_targets, target_inv = np.unique(targets, return_inverse=True)
+    logger.info('Deduplicated {:,} origins to {:,} nodes and {:,} destinations to {:,} nodes'.format(len(sources),
+        len(unique_sources), len(targets), len(unique_targets)))
+
+    def expand(u_row, block):
+        u_end = u_row + len(block)
+        positions = order[bounds[u_row]:bounds[u_end]]
+        return positions, np.repeat(block, counts[u_row:u_end], axis=0)[:, target_inv]
+
+    if ch is not None:
+        for u_row, block in ch.many_to_many(unique_sources, unique_targets, limit):
+            yield expand(u_row, block)
+        return
+
+    if len(unique_targets) >= len(unique_sources):
+        for u_row, block in shortest_paths(graph, unique_sources, unique_targets,
+            num_threads, limit, rows_per_task):
+            yield expand(u_row, block)
+        return
+
+    logger.info('Searching the reversed graph from {:,} destinations instead of {:,} origins'.format(len(unique_targets),
+        len(unique_sources)))
+    reverse = graph.T.tocsr()
+    searches = shortest_paths(reverse, unique_targets, unique_sources, num_threads,
+        limit, rows_per_task)
+    if np.isinf(limit):
+        #every pair is kept until the last search is done (as float32,
+        #which holds whole seconds exactly)
+        times = np.empty((len(unique_sources), len(unique_targets)), dtype=np.float32)
+        for col, block in searches:
+            times[:, col:col + len(block)] = block.T
+        for u_row in range(0, len(unique_sources), rows_per_task):
+            yield expand(u_row, times[u_row:u_row + rows_per_task].astype(np.float64))
+        return
+
+    #with a limit, only the pairs within it are kept, in row order
+    rows = [np.empty(0, dtype=np.int32)]
+    cols = [np.empty(0, dtype=np.int32)]
+    values = [np.empty(0, dtype=np.float32)]
+    for col, block in searches:
+        block_cols, block_rows = np.nonzero(np.isfinite(block))
+        rows.append(block_rows.astype(np.int32))
+        cols.append((block_cols + col).astype(np.int32))
+        values.append(block[block_cols, block_rows].astype(np.float32))
+    rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+    row_order = np.argsort(rows, kind='stable')
+    rows, cols, values = rows[row_order], cols[row_order], values[row_order]
+    row_ptr = np.searchsorted(rows, np.arange(0, len(unique_sources) + rows_per_task, rows_per_task))
+    for chunk, u_row in enumerate(range(0, len(unique_sources), rows_per_task)):
+        block = np.full((min(rows_per_task, len(unique_sources) - u_row), len(unique_targets)), np.inf)
+        kept = slice(row_ptr[chunk], row_ptr[chunk + 1])
+        block[rows[kept] - u_row, cols[kept]] = values[kept]
+        yield expand(u_row, block)
+
+
+def last_mile(src_dist, dst_dist, impedence):
+    '''
+    Convert last mile distances to impedences the way tmat.h does,
+    including the single precision arithmetic and truncation.
+    '''
+    impedence = np.float32(impedence)
+    src_imp = (src_dist.astype(np.float32) / impedence).astype(np.int64)
+    dst_imp = (dst_dist.astype(np.float32) * impedence).astype(np.int64)
+
+    return src_imp, dst_imp
+
+
+def finalize_block(block, src_loc, dst_loc, src_imp, dst_imp, max_time=None):
+    '''
+    Add the last mile impedences to a block of network times, zero out
+    pairs sharing a node and mark unreachable pairs (and those slower
+    than max_time, if given).
+    '''
+    unreachable = np.isinf(block)
+    block[unreachable] = 0
+    result = block.astype(np.int64) + src_imp[:, None] + dst_imp[None, :]
+    result[src_loc[:, None] == dst_loc[None, :]] = 0
+    if max_time is not None:
+        unreachable |= result > max_time
+    result[unreachable] = UNREACHABLE
+
+    return result
+
+
+def sparse_rows(result):
+    '''
+    The reachable pairs of a finalized block, as (count per row, col
+    positions, times) with col positions sorted within each row.
+    '''
+    keep = result != UNREACHABLE
+
+    return keep.sum(axis=1), np.nonzero(keep)[1].astype(np.int32), result[keep].astype(np.int32)
+
+
+class sparseMatrix(object):
+    '''
+    A travel time matrix stored as (source, dest, seconds) triplets
+    in row major (CSR) order. Used when the matrix is capped at
+    max_time, so only pairs within range are kept.
+    '''
+    def __init__(self, row_ids, col_ids, indptr, cols, times):
+        self.row_ids = np.asarray(row_ids).astype(str)
+        self.col_ids = np.asarray(col_ids).astype(str)
+        self.indptr = indptr
+        self.cols = cols
+        self.times = times
+        self._keys = None
+
+    @classmethod
+    def from_blocks(cls, col_ids, blocks):
+        '''
+        Build from an iterable of (row ids, finalized dense block),
+        dropping unreachable pairs.
+        '''
+        return cls.from_pieces(col_ids, ((block_ids,) + sparse_rows(block)
+            for block_ids, block in blocks))
+
+    @classmethod
+    def from_pieces(cls, col_ids, pieces):
+        '''
+        Build from an iterable of (row ids, count per row, col positions,
+        times), with col positions sorted within each row.
+        '''
+        row_ids = []
+        counts = []
+        cols = []
+        times = []
+        for piece_ids, piece_counts, piece_cols, piece_times in pieces:
+            row_ids.append(piece_ids)
+            counts.append(piece_counts)
+            cols.append(piece_cols)
+            times.append(piece_times)
+        if counts:
+            row_ids = np.concatenate(row_ids)
+            indptr = np.zeros(len(row_ids) + 1, dtype=np.int64)
+            np.cumsum(np.concatenate(counts), out=indptr[1:])
+            cols = np.concatenate(cols)
+            times = np.concatenate(times)
+        else:
+            indptr = np.zeros(1, dtype=np.int64)
+            cols = np.empty(0, dtype=np.int32)
+            times = np.empty(0, dtype=np.int32)
+
+        return cls(row_ids, col_ids, indptr, cols, times)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Load triplets written by save().
+        '''
+        with np.load(filename) as data:
+            return cls(data['row_ids'], data['col_ids'], data['indptr'],
+                data['cols'], data['times'])
+
+    def save(self, filename):
+        '''
+        Write the triplets to a .npz file.
+        '''
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, row_ids=self.row_ids, col_ids=self.col_ids,
+                indptr=self.indptr, cols=self.cols, times=self.times)
+
+    def __len__(self):
+        return len(self.times)
+
+    def get_loc(self, row, col):
+        '''
+        Fetch the time value at (row position, col position), or
+        UNREACHABLE if the pair was not stored.
+        '''
+        start, end = self.indptr[row], self.indptr[row + 1]
+        k = start + np.searchsorted(self.cols[start:end], col)
+        if k < end and self.cols[k] == col:
+            return int(self.times[k])
+        return UNREACHABLE
+
+    def get_locs(self, rows, cols):
+        '''
+        Vectorized get_loc over (broadcastable) arrays of positions.
+        '''
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.int64),
+            np.asarray(cols, dtype=np.int64))
+        if self._keys is None:
+            #cols are sorted within each row, so row major keys are sorted
+            stored_rows = np.repeat(np.arange(len(self.row_ids)), np.diff(self.indptr))
+            self._keys = stored_rows * len(self.col_ids) + self.cols
+        query = rows * len(self.col_ids) + cols
+        k = np.searchsorted(self._keys, query)
+        found = k < len(self._keys)
+        found[found] = self._keys[k[found]] == query[found]
+        values = np.full(query.shape, UNREACHABLE, dtype=np.int64)
+        values[found] = self.times[k[found]]
+
+        return values
+
+    def triplets(self):
+        '''
+        Return the (source, dest, seconds) triplets as a DataFrame.
+        '''
+        rows = np.repeat(np.arange(len(self.row_ids)), np.diff(self.indptr))
+        return pd.DataFrame({'source': self.row_ids[rows],
+            'dest': self.col_ids[self.cols], 'seconds': self.times})
+
+
+class spTMatrix(object):
+    '''
+    A scipy based stand in for pyTMatrix. Takes the same arguments
+    and exposes the same get(). If max_time (seconds) is given, searches
+    stop at max_time and the matrix is kept as a sparseMatrix. If
+    ch_index (a p2p_ch.CHIndex) is given, it answers the searches.
+    Matrices are written (and read) as .tmat files when the filename
+    ends in .tmat; those are memory mapped rather than loaded. A csv
+    matrix with a current index (p2p_matrix.index_csv) is read by
+    seeking to the rows needed rather than loaded.
+    get_many, get_submatrix, get_row and get_col look up many
+    pairs at once, whichever way the matrix is held.
+    If checkpoint (a p2p_checkpoint.blockCheckpoint) is given, rows
+    are computed in blocks saved to (and resumed from) its part files;
+    a shared checkpoint also publishes the job for workers on other
+    hosts.
+    Symmetric requests (same nn file for sources and destinations) over
+    an undirected network are held and written as a packed upper
+    triangle (p2p_matrix.packedMatrix). If tiles (a p2p_tiles.tileSet)
+    is given with max_time, each tile of origins is searched on its own
+    subnetwork. If nearest (a p2p_topk.nearestSearch) is given, only the
+    k nearest destinations of each origin are searched for and kept (as
+    a p2p_matrix.nearestMatrix, written to .topk files). If catchment (a
+    p2p_catchments.catchmentSearch) is given, the origins and polygon
+    within each of its thresholds of every destination are found instead
+    of a matrix (written to a GeoPackage or GeoParquet).
+    '''
+    def __init__(self, infile, nn_pinfile, nn_sinfile, outfile,
+     N, impedence, num_threads, outer_node_rows, outer_node_cols, mode,
+     write_to_file, load_to_mem, read_from_file=False, max_time=None,
+     ch_index=None, checkpoint=None, rows_per_task=ROWS_PER_TASK, tiles=None,
+     nearest=None, catchment=None):
+
+        self.data = None
+        self.sparse = None
+        self.matrix = None
+        self.nearest = None
+        self.catchments = None
+        self.row_index = pd.Index([])
+        self.col_index = pd.Index([])
+
+        if read_from_file:
+            if infile.endswith('.npz'):
+                self.sparse = sparseMatrix.load(infile)
+                self._set_index(self.sparse.row_ids, self.sparse.col_ids)
+            elif infile.endswith('.tmat'):
+                self.matrix = open_matrix(infile)
+                self.row_index = self.matrix.row_index
+                self.col_index = self.matrix.col_index
+            elif infile.endswith('.topk'):
+                self._keep_nearest(nearestMatrix.load(infile), outfile, False, True)
+            elif indexedCsvMatrix.is_current(infile):
+                self.matrix = indexedCsvMatrix.open(infile)
+                self.row_index = self.matrix.row_index
+                self.col_index = self.matrix.col_index
+            else:
+                self._load_csv(infile)
+            return
+
+        start_time = time.time()
+        graph = load_network(infile, N)
+        src_loc, src_ids, src_dist = read_nn(nn_pinfile)
+        dst_loc, dst_ids, dst_dist = read_nn(nn_sinfile)
+        src_imp, dst_imp = last_mile(src_dist, dst_dist, impedence)
+        logger.debug('Loaded graph with {} nodes and {} edges in {:,.2f} seconds'.format(N,
+            graph.nnz, time.time() - start_time))
+
+        if max_time is not None:
+            limit = max_time
+        else:
+            limit = np.inf
+
+        if catchment is not None:
+            assert not mode and checkpoint is None and tiles is None and nearest is None, "catchment can't be combined with mode, checkpoint, tiles or nearest"
+            catchments = catchment.results(graph, src_loc, src_ids, src_imp, dst_loc,
+                dst_ids, dst_imp, num_threads, rows_per_task)
+            if write_to_file:
+                catchments.save(outfile)
+            if load_to_mem:
+                self.catchments = catchments
+            return
+
+        if nearest is not None:
+            assert not mode and checkpoint is None and tiles is None, "nearest can't be combined with mode, checkpoint or tiles"
+            source, rank, dest, seconds = nearest.results(graph, src_loc, dst_loc,
+                src_imp, dst_imp, num_threads, max_time, ch_index, rows_per_task,
+                skip_same_node=nn_pinfile == nn_sinfile)
+            self._keep_nearest(nearestMatrix(src_ids, dst_ids, source, rank, dest, seconds,
+                nearest.categories), outfile, write_to_file, load_to_mem)
+            return
+
+        #a symmetric request over an undirected network only needs
+        #the upper triangle
+        to_tmat = write_to_file and outfile.endswith('.tmat')
+        if (nn_pinfile == nn_sinfile and not mode and max_time is None and
+            checkpoint is None and ch_index is None and (load_to_mem or to_tmat) and
+            is_undirected(graph)):
+            self._compute_packed(graph, src_loc, src_ids, src_imp, dst_imp, outfile,
+                num_threads, rows_per_task, write_to_file, load_to_mem)
+            return
+
+        if tiles is not None:
+            assert max_time is not None and not mode, "tiles require max_time"
+            pieces = ((src_ids[rows], counts, cols, times) for rows, counts, cols, times in tiles.results(graph,
+                src_loc, dst_loc, src_imp, dst_imp, max_time, num_threads, rows_per_task))
+            self._keep_sparse(sparseMatrix.from_pieces(dst_ids, pieces), len(src_ids),
+                max_time, outfile, write_to_file, load_to_mem)
+            return
+
+        if load_to_mem and not mode and max_time is None:
+            self.data = np.empty((len(src_ids), len(dst_ids)), dtype=np.int32)
+            self._set_index(src_ids, dst_ids)
+
+        best = {}
+        pieces = []
+        outcsv = None
+        outbinary = None
+        if write_to_file and not mode and max_time is None:
+            if outfile.endswith('.tmat'):
+                outbinary = binaryMatrixWriter(outfile, dst_ids)
+            else:
+                outcsv = open(outfile, 'w', newline='')
+                writer = csv.writer(outcsv)
+                writer.writerow([''] + list(dst_ids))
+
+        #only the pairs within max_time are kept of each block
+        sparse = max_time is not None and not mode
+        if checkpoint is not None:
+            checkpoint.check_inputs(infile, nn_pinfile, nn_sinfile, impedence)
+            if checkpoint.shared:
+                checkpoint.publish_job(infile, nn_pinfile, nn_sinfile, N, impedence,
+                    rows_per_task)
+            results = checkpoint.results(graph, src_loc, dst_loc, src_imp,
+                dst_imp, num_threads, limit, max_time, ch_index, rows_per_task, sparse)
+        else:
+            results = ((rows, finalize_block(block, src_loc[rows], dst_loc,
+                src_imp[rows], dst_imp, max_time)) for rows, block in network_times(graph,
+                src_loc, dst_loc, num_threads, limit, ch_index, rows_per_task))
+            if sparse:
+                results = ((rows, sparse_rows(result)) for rows, result in results)
+
+        try:
+            for rows, result in results:
+                if mode:
+                    self._find_best(result, src_ids[rows], src_loc[rows],
+                        dst_ids, dst_loc, mode, best)
+                    continue
+                if sparse:
+                    pieces.append((src_ids[rows],) + result)
+                    continue
+                if self.data is not None:
+                    self.data[rows] = result
+                if outcsv:
+                    for source_id, values in zip(src_ids[rows], result):
+                        writer.writerow([source_id] + values.tolist())
+                if outbinary:
+                    outbinary.write_rows(src_ids[rows], result)
+        finally:
+            if outcsv:
+                outcsv.close()
+            if outbinary:
+                outbinary.close()
+
+        if mode and write_to_file:
+            with open(outfile, 'w') as jsonfile:
+                json.dump(best, jsonfile)
+
+        if sparse:
+            self._keep_sparse(sparseMatrix.from_pieces(dst_ids, pieces), len(src_ids),
+                max_time, outfile, write_to_file, load_to_mem)
+
+
+    def _keep_sparse(self, sparse, n_rows, max_time, outfile, write_to_file, load_to_mem):
+        '''
+        Write and/or hold a matrix capped at max_time.
+        '''
+        logger.info('Kept {:,} of {:,} pairs within {} seconds'.format(len(sparse),
+            n_rows * len(sparse.col_ids), max_time))
+        if write_to_file:
+            sparse.save(outfile)
+        if load_to_mem:
+            self.sparse = sparse
+            self._set_index(sparse.row_ids, sparse.col_ids)
+
+
+    def _keep_nearest(self, nearest, outfile, write_to_file, load_to_mem):
+        '''
+        Write and/or hold the nearest destinations of each origin. Held
+        results also answer get() and friends (pairs outside the k
+        nearest are UNREACHABLE).
+        '''
+        if write_to_file:
+            nearest.save(outfile)
+        if load_to_mem:
+            self.nearest = nearest
+            self.sparse = sparseMatrix.from_pieces(nearest.col_ids, [nearest.pieces()])
+            self._set_index(nearest.row_ids, nearest.col_ids)
+
+
+    def get_nearest(self, source):
+        '''
+        Fetch the nearest destinations of source.
+        Returns: DataFrame of dest, (category,) rank and seconds
+        '''
+        assert self.nearest is not None, "no nearest destination results"
+        return self.nearest.get(source)
+
+
+    def _compute_packed(self, graph, loc, ids, src_imp, dst_imp, outfile,
+        num_threads, rows_per_task, write_to_file, load_to_mem):
+        '''
+        Compute a symmetric matrix as its packed upper triangle. A .tmat
+        output is written packed; a csv output is still written in full.
+        '''
+        to_tmat = write_to_file and outfile.endswith('.tmat')
+        if to_tmat and not load_to_mem:
+            packed = packedMatrix.create(ids, loc, src_imp, dst_imp, outfile)
+        else:
+            packed = packedMatrix.create(ids, loc, src_imp, dst_imp)
+        logger.info('Network is undirected and the request symmetric; storing the upper triangle only')
+
+        outcsv = None
+        if write_to_file and not to_tmat:
+            outcsv = open(outfile, 'w', newline='')
+            writer = csv.writer(outcsv)
+            writer.writerow([''] + list(ids))
+        try:
+            for rows, block in network_times(graph, loc, loc, num_threads, np.inf,
+                None, rows_per_task):
+                packed.set_rows(rows, block)
+                if outcsv:
+                    result = finalize_block(block, loc[rows], loc, src_imp[rows], dst_imp)
+                    for source_id, values in zip(ids[rows], result):
+                        writer.writerow([source_id] + values.tolist())
+        finally:
+            if outcsv:
+                outcsv.close()
+
+        if to_tmat:
+            packed.save(outfile)
+        if load_to_mem:
+            self.matrix = packed
+            self.row_index = packed.row_index
+            self.col_index = packed.col_index
+        else:
+            packed.close()
+
+
+    def _set_index(self, row_ids, col_ids):
+        '''
+        Map row and column ids to their positions.
+        '''
+        self.row_index = pd.Index([str(idx) for idx in row_ids], dtype=object)
+        self.col_index = pd.Index([str(idx) for idx in col_ids], dtype=object)
+
+
+    def _find_best(self, result, src_ids, src_loc, dst_ids, dst_loc, n_best, best):
+        '''
+        Keep the n_best closest destinations for each source, skipping
+        unreachable destinations and those on the source's own node.
+        '''
+        for i, source_id in enumerate(src_ids):
+            values = result[i]
+            valid = np.flatnonzero((values != UNREACHABLE) & (dst_loc != src_loc[i]))
+            if len(valid) > n_best:
+                valid = valid[np.argpartition(values[valid], n_best - 1)[:n_best]]
+            best[source_id] = {dst_ids[j]: int(values[j]) for j in valid}
+
+
+    def _load_csv(self, infile):
+        '''
+        Load a matrix written in the csv format.
+        '''
+        df = pd.read_csv(infile, index_col=0, dtype=str)
+        self.data = df.values.astype(np.int32)
+        self._set_index(df.index, df.columns)
+
+
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        self._check_loaded()
+        if self.matrix is not None:
+            return self.matrix.get(source, dest)
+        if self.sparse is not None:
+            return self.sparse.get_loc(self.row_index.get_loc(source), self.col_index.get_loc(dest))
+
+        return int(self.data[self.row_index.get_loc(source), self.col_index.get_loc(dest)])
+
+
+    def _check_loaded(self):
+        assert self.matrix is not None or self.sparse is not None or self.data is not None, "no matrix in memory (use load_to_mem, or read_from_file the output)"
+
+
+    def _locate(self, index, ids, kind):
+        '''
+        Return the positions of ids in index (-1 for missing ids).
+        '''
+        locs = index.get_indexer([str(idx) for idx in ids])
+        missing = (locs < 0).sum()
+        if missing:
+            logger.error('{:,} {} ids could not be found'.format(missing, kind))
+
+        return locs
+
+
+    def get_locs(self, rows, cols):
+        '''
+        Fetch the time values at (broadcastable) arrays of row and col
+        positions. Positions of -1 give UNREACHABLE.
+        '''
+        self._check_loaded()
+        rows, cols = np.broadcast_arrays(rows, cols)
+        valid = (rows >= 0) & (cols >= 0)
+        values = np.full(rows.shape, UNREACHABLE, dtype=np.int64)
+        if self.matrix is not None:
+            values[valid] = self.matrix.get_locs(rows[valid], cols[valid])
+        elif self.sparse is not None:
+            values[valid] = self.sparse.get_locs(rows[valid], cols[valid])
+        elif self.data is not None:
+            values[valid] = self.data[rows[valid], cols[valid]]
+
+        return values
+
+
+    def get_many(self, sources, dests):
+        '''
+        Fetch the time values for each (sources[i], dests[i]) pair.
+        '''
+        return self.get_locs(self._locate(self.row_index, sources, 'source'),
+            self._locate(self.col_index, dests, 'dest'))
+
+
+    def get_submatrix(self, sources, dests):
+        '''
+        Fetch the times from every source to every dest, as a
+        (len(sources), len(dests)) array.
+        '''
+        rows = self._locate(self.row_index, sources, 'source')
+        cols = self._locate(self.col_index, dests, 'dest')
+
+        return self.get_locs(rows[:, None], cols[None, :])
+
+
+    def get_row(self, source):
+        '''
+        Fetch the times from source to every dest, as a Series.
+        '''
+        rows = self._locate(self.row_index, [source], 'source')
+        values = self.get_locs(rows[:, None], np.arange(len(self.col_index))[None, :])
+
+        return pd.Series(values[0], index=self.col_index)
+
+
+    def get_col(self, dest):
+        '''
+        Fetch the times from every source to dest, as a Series.
+        '''
+        cols = self._locate(self.col_index, [dest], 'dest')
+        values = self.get_locs(np.arange(len(self.row_index))[:, None], cols[None, :])
+
+        return pd.Series(values[:, 0], index=self.row_index)
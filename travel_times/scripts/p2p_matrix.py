@@ -0,0 +1,608 @@
+import numpy as np
+import pandas as pd
+import logging, os, struct, time
+
+# Binary (.tmat) matrix files for p2p. A fixed size header is followed by
+# the row major array of seconds (uint16, or uint32 when a time doesn't
+# fit) and then the row and column ids as fixed width byte strings, so a
+# matrix opens with numpy.memmap in milliseconds and reads of single
+# pairs, rows or slices never touch the rest of the file. Symmetric
+# matrices can be stored as their packed upper triangle instead. Nearest
+# destination (top-k) results are kept as compact arrays in .topk files.
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'P2PTMAT1'
+
+#packed upper triangle of a symmetric matrix
+PACKED_MAGIC = b'P2PTRIU1'
+
+#magic, itemsize, n_rows, n_cols, row id width, col id width
+HEADER_FORMAT = '<8sIQQQQ'
+
+#data starts here (room to grow the header)
+HEADER_SIZE = 64
+
+#value returned for unreachable pairs, as in tmat.h
+UNREACHABLE = -1
+
+#rows read at once when converting csv matrices
+CONVERT_CHUNK_ROWS = 1000
+
+
+def sentinel(itemsize):
+    '''
+    The value stored for unreachable pairs in an array of itemsize bytes.
+    '''
+    return (1 << (8 * itemsize)) - 1
+
+
+def _encode_ids(ids):
+    return np.array([str(idx).encode('utf-8') for idx in ids], dtype=bytes)
+
+
+class binaryMatrix(object):
+    '''
+    A matrix of network times in seconds, memory mapped from a .tmat file.
+    data holds the raw stored values; unreachable pairs hold the
+    sentinel for the itemsize instead of -1.
+    '''
+    def __init__(self, filename, data, row_ids, col_ids):
+        self.filename = filename
+        self.data = data
+        self.row_ids = row_ids
+        self.col_ids = col_ids
+        self.sentinel = sentinel(data.dtype.itemsize)
+        self.row_index = pd.Index(row_ids)
+        self.col_index = pd.Index(col_ids)
+
+
+    @classmethod
+    def open(cls, filename):
+        '''
+        Memory map a .tmat file (read only).
+        '''
+        with open(filename, 'rb') as infile:
+            header = infile.read(struct.calcsize(HEADER_FORMAT))
+        magic, itemsize, n_rows, n_cols, row_width, col_width = struct.unpack(HEADER_FORMAT, header)
+        assert magic == MAGIC, "{} is not a p2p .tmat matrix".format(filename)
+
+        dtype = np.dtype('<u{}'.format(itemsize))
+        data = np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_SIZE,
+            shape=(n_rows, n_cols))
+        ids_offset = HEADER_SIZE + n_rows * n_cols * itemsize
+        row_ids = np.memmap(filename, dtype='S{}'.format(max(row_width, 1)), mode='r',
+            offset=ids_offset, shape=(n_rows,))
+        col_ids = np.memmap(filename, dtype='S{}'.format(max(col_width, 1)), mode='r',
+            offset=ids_offset + n_rows * max(row_width, 1), shape=(n_cols,))
+
+        return cls(filename, data, np.char.decode(row_ids, 'utf-8').astype(object),
+            np.char.decode(col_ids, 'utf-8').astype(object))
+
+
+    def __len__(self):
+        return len(self.row_ids)
+
+
+    def get_loc(self, row, col):
+        '''
+        Return the time at a row, col position, or UNREACHABLE.
+        '''
+        value = int(self.data[row, col])
+        if value == self.sentinel:
+            return UNREACHABLE
+
+        return value
+
+
+    def get_locs(self, rows, cols):
+        '''
+        Vectorized get_loc over (broadcastable) arrays of positions.
+        '''
+        values = self.data[rows, cols].astype(np.int64)
+        values[values == self.sentinel] = UNREACHABLE
+
+        return values
+
+
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        return self.get_loc(self.row_index.get_loc(source), self.col_index.get_loc(dest))
+
+
+class binaryMatrixWriter(object):
+    '''
+    Stream rows of a matrix (int arrays with -1 for unreachable) into
+    a .tmat file. Values are stored as uint16 until one doesn't fit,
+    at which point the rows written so far are widened to uint32.
+    '''
+    def __init__(self, filename, col_ids, itemsize=2):
+        self.filename = filename
+        self.col_ids = _encode_ids(col_ids)
+        self.row_ids = []
+        self.itemsize = itemsize
+        self.n_rows = 0
+        self.outfile = open(filename, 'wb')
+        self.outfile.write(b'\0' * HEADER_SIZE)
+
+
+    def _widen(self):
+        '''
+        Rewrite the rows written so far as uint32.
+        '''
+        self.outfile.close()
+        old = np.memmap(self.filename, dtype='<u2', mode='r', offset=HEADER_SIZE,
+            shape=(self.n_rows, len(self.col_ids)))
+        temp_filename = self.filename + '.widen'
+        with open(temp_filename, 'wb') as outfile:
+            outfile.write(b'\0' * HEADER_SIZE)
+            for start in range(0, self.n_rows, CONVERT_CHUNK_ROWS):
+                rows = old[start:start + CONVERT_CHUNK_ROWS].astype('<u4')
+                rows[rows == sentinel(2)] = sentinel(4)
+                outfile.write(rows.tobytes())
+        del old
+        os.replace(temp_filename, self.filename)
+        self.outfile = open(self.filename, 'r+b')
+        self.outfile.seek(0, os.SEEK_END)
+        self.itemsize = 4
+        logger.debug('Widened {} to uint32 after {:,} rows'.format(self.filename, self.n_rows))
+
+
+    def write_rows(self, row_ids, block):
+        '''
+        Append a block of rows (one per id in row_ids).
+        '''
+        block = np.asarray(block)
+        unreachable = block == UNREACHABLE
+        if self.itemsize == 2 and block[~unreachable].max(initial=0) >= sentinel(2):
+            self._widen()
+        rows = block.astype('<u{}'.format(self.itemsize))
+        rows[unreachable] = sentinel(self.itemsize)
+        self.outfile.write(rows.tobytes())
+        self.row_ids.extend(row_ids)
+        self.n_rows += len(block)
+
+
+    def close(self):
+        '''
+        Write the ids and the header.
+        '''
+        row_ids = _encode_ids(self.row_ids)
+        row_width = row_ids.dtype.itemsize if len(row_ids) else 0
+        col_width = self.col_ids.dtype.itemsize if len(self.col_ids) else 0
+        self.outfile.write(row_ids.astype('S{}'.format(max(row_width, 1))).tobytes())
+        self.outfile.write(self.col_ids.astype('S{}'.format(max(col_width, 1))).tobytes())
+        self.outfile.seek(0)
+        self.outfile.write(struct.pack(HEADER_FORMAT, MAGIC, self.itemsize,
+            self.n_rows, len(self.col_ids), row_width, col_width))
+        self.outfile.close()
+
+
+def packed_offset(rows, cols, n):
+    '''
+    Position of (row, col) in the packed upper triangle (row major, with
+    the diagonal) of an n by n symmetric matrix.
+    '''
+    low = np.minimum(rows, cols).astype(np.int64)
+    high = np.maximum(rows, cols).astype(np.int64)
+
+    return low * n - low * (low - 1) // 2 + (high - low)
+
+
+class packedMatrix(object):
+    '''
+    A symmetric request (sources = destinations) over an undirected
+    network. Only the upper triangle of the network times is stored,
+    packed, along with each point's node and last mile impedences
+    (which differ by direction, as in tmat.h), so every pair of the full
+    matrix is recovered exactly. data holds the raw stored network
+    times; unreachable pairs hold the sentinel for the itemsize.
+    '''
+    def __init__(self, filename, data, ids, loc, src_imp, dst_imp):
+        self.filename = filename
+        self.data = data
+        self.row_ids = ids
+        self.col_ids = ids
+        self.loc = loc
+        self.src_imp = src_imp
+        self.dst_imp = dst_imp
+        self.sentinel = sentinel(data.dtype.itemsize)
+        self.row_index = pd.Index(ids)
+        self.col_index = self.row_index
+
+
+    @classmethod
+    def create(cls, ids, loc, src_imp, dst_imp, filename=None):
+        '''
+        An empty (all unreachable) uint32 matrix to fill with set_rows,
+        in memory or, if filename is given, memory mapped from a
+        scratch file next to it.
+        '''
+        n = len(ids)
+        size = n * (n + 1) // 2
+        if filename:
+            data = np.memmap(filename + '.part', dtype='<u4', mode='w+', shape=(size,))
+        else:
+            data = np.empty(size, dtype='<u4')
+        data[:] = sentinel(4)
+
+        return cls(filename, data, np.asarray(ids, dtype=object), np.asarray(loc, dtype=np.int64),
+            np.asarray(src_imp, dtype=np.int64), np.asarray(dst_imp, dtype=np.int64))
+
+
+    @classmethod
+    def open(cls, filename):
+        '''
+        Memory map a packed .tmat file (read only).
+        '''
+        with open(filename, 'rb') as infile:
+            header = infile.read(struct.calcsize(HEADER_FORMAT))
+        magic, itemsize, n, _, id_width, _ = struct.unpack(HEADER_FORMAT, header)
+        assert magic == PACKED_MAGIC, "{} is not a packed p2p .tmat matrix".format(filename)
+
+        size = n * (n + 1) // 2
+        data = np.memmap(filename, dtype='<u{}'.format(itemsize), mode='r',
+            offset=HEADER_SIZE, shape=(size,))
+        offset = HEADER_SIZE + size * itemsize
+        loc, src_imp, dst_imp = np.memmap(filename, dtype='<i8', mode='r',
+            offset=offset, shape=(3, n))
+        ids = np.memmap(filename, dtype='S{}'.format(max(id_width, 1)), mode='r',
+            offset=offset + 3 * n * 8, shape=(n,))
+
+        return cls(filename, data, np.char.decode(ids, 'utf-8').astype(object),
+            loc, src_imp, dst_imp)
+
+
+    def __len__(self):
+        return len(self.row_ids)
+
+
+    def set_rows(self, rows, times):
+        '''
+        Store the network times (inf if unreachable) from the points at
+        positions rows to every point; only the upper triangle is kept.
+        '''
+        n = len(self.row_ids)
+        for row, values in zip(rows, times):
+            values = values[row:]
+            stored = np.where(np.isinf(values), self.sentinel, values).astype(self.data.dtype)
+            start = packed_offset(row, row, n)
+            self.data[start:start + n - row] = stored
+
+
+    def get_locs(self, rows, cols):
+        '''
+        Fetch the times at (broadcastable) arrays of row and col positions.
+        '''
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.int64),
+            np.asarray(cols, dtype=np.int64))
+        times = self.data[packed_offset(rows, cols, len(self.row_ids))].astype(np.int64)
+        values = times + self.src_imp[rows] + self.dst_imp[cols]
+        values[self.loc[rows] == self.loc[cols]] = 0
+        values[times == self.sentinel] = UNREACHABLE
+
+        return values
+
+
+    def get_loc(self, row, col):
+        '''
+        Return the time at a row, col position, or UNREACHABLE.
+        '''
+        return int(self.get_locs([row], [col])[0])
+
+
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        return self.get_loc(self.row_index.get_loc(source), self.col_index.get_loc(dest))
+
+
+    def save(self, filename):
+        '''
+        Write the matrix as a packed .tmat file, as uint16 if every
+        stored time fits.
+        '''
+        ids = _encode_ids(self.row_ids)
+        id_width = ids.dtype.itemsize if len(ids) else 0
+        step = CONVERT_CHUNK_ROWS * max(len(ids), 1)
+        largest = 0
+        for start in range(0, len(self.data), step):
+            chunk = np.asarray(self.data[start:start + step])
+            largest = max(largest, int(chunk[chunk != self.sentinel].max(initial=0)))
+        itemsize = 2 if largest < sentinel(2) else 4
+
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as outfile:
+            outfile.write(b'\0' * HEADER_SIZE)
+            for start in range(0, len(self.data), step):
+                chunk = np.asarray(self.data[start:start + step])
+                values = chunk.astype('<u{}'.format(itemsize))
+                values[chunk == self.sentinel] = sentinel(itemsize)
+                outfile.write(values.tobytes())
+            outfile.write(np.vstack([self.loc, self.src_imp, self.dst_imp]).astype('<i8').tobytes())
+            outfile.write(ids.astype('S{}'.format(max(id_width, 1))).tobytes())
+            outfile.seek(0)
+            outfile.write(struct.pack(HEADER_FORMAT, PACKED_MAGIC, itemsize,
+                len(ids), len(ids), id_width, 0))
+        os.replace(temp_filename, filename)
+
+
+    def close(self):
+        '''
+        Drop the scratch file of a matrix made by create(filename=...).
+        '''
+        if isinstance(self.data, np.memmap) and self.data.filename.endswith('.part'):
+            scratch = self.data.filename
+            self.data = None
+            os.remove(scratch)
+
+
+class nearestMatrix(object):
+    '''
+    The k nearest destinations of each origin as compact arrays: entry i
+    says dest col_ids[dest[i]] is the rank[i]-th fastest (from 0, within
+    its category if there are categories) from source row_ids[source[i]],
+    taking seconds[i]. Entries are ordered by source.
+    '''
+    def __init__(self, row_ids, col_ids, source, rank, dest, seconds, categories=None):
+        self.row_ids = np.asarray(row_ids).astype(str)
+        self.col_ids = np.asarray(col_ids).astype(str)
+        self.source = source
+        self.rank = rank
+        self.dest = dest
+        self.seconds = seconds
+        self.categories = None if categories is None else np.asarray(categories).astype(str)
+        self._row_index = None
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Load arrays written by save().
+        '''
+        with np.load(filename) as data:
+            categories = data['categories'] if len(data['categories']) else None
+            return cls(data['row_ids'], data['col_ids'], data['source'], data['rank'],
+                data['dest'], data['seconds'], categories)
+
+    def save(self, filename):
+        '''
+        Write the arrays to an .npz archive (keeping filename as given).
+        '''
+        categories = self.categories if self.categories is not None else np.array([], dtype=str)
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, row_ids=self.row_ids, col_ids=self.col_ids,
+                source=self.source, rank=self.rank, dest=self.dest,
+                seconds=self.seconds, categories=categories)
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def pieces(self):
+        '''
+        The entries as one (row ids, count per row, col positions, times)
+        piece, col positions sorted within each row (see
+        p2p_engine.sparseMatrix.from_pieces).
+        '''
+        order = np.lexsort((self.dest, self.source))
+        counts = np.bincount(self.source, minlength=len(self.row_ids))
+
+        return self.row_ids, counts, self.dest[order], self.seconds[order]
+
+    def to_frame(self):
+        '''
+        Return the entries as a DataFrame of source, dest, (category,)
+        rank and seconds.
+        '''
+        df = pd.DataFrame({'source': self.row_ids[self.source],
+            'dest': self.col_ids[self.dest]})
+        if self.categories is not None:
+            df['category'] = self.categories[self.dest]
+        df['rank'] = self.rank
+        df['seconds'] = self.seconds
+
+        return df
+
+    def get(self, source):
+        '''
+        The nearest destinations of source, as a DataFrame in the
+        format of to_frame() (without the source column).
+        '''
+        if self._row_index is None:
+            self._row_index = pd.Index(self.row_ids)
+        row = self._row_index.get_loc(source)
+        start, end = np.searchsorted(self.source, [row, row + 1])
+        df = pd.DataFrame({'dest': self.col_ids[self.dest[start:end]]})
+        if self.categories is not None:
+            df['category'] = self.categories[self.dest[start:end]]
+        df['rank'] = self.rank[start:end]
+        df['seconds'] = self.seconds[start:end]
+
+        return df
+
+
+def index_filename(infile):
+    '''
+    The sidecar index file of a csv matrix.
+    '''
+    return infile + '.idx'
+
+
+def _csv_ids(line):
+    return [field.strip('"') for field in line.decode('utf-8').rstrip('\r\n').split(',')]
+
+
+class indexedCsvMatrix(object):
+    '''
+    A csv matrix (as written by p2p) read through its sidecar index of
+    row byte offsets (see index_csv), so single pairs and rows are read
+    by seeking to their line instead of parsing the whole file. Exposes
+    the same lookups as binaryMatrix.
+    '''
+    def __init__(self, filename, offsets, row_ids, col_ids):
+        self.filename = filename
+        self.offsets = offsets
+        self.row_ids = row_ids
+        self.col_ids = col_ids
+        self.row_index = pd.Index(row_ids)
+        self.col_index = pd.Index(col_ids)
+        #read with pread (no shared file position) so threads, like the
+        #handlers of p2p_server, can read rows at the same time
+        self.fd = os.open(filename, os.O_RDONLY)
+
+
+    @staticmethod
+    def is_current(filename):
+        '''
+        Whether filename has an index built from its current contents
+        (going by its size and modification time).
+        '''
+        if not os.path.isfile(index_filename(filename)):
+            return False
+        stat = os.stat(filename)
+        with np.load(index_filename(filename)) as index:
+            current = (int(index['csv_size']) == stat.st_size and
+                int(index['csv_mtime']) == stat.st_mtime_ns)
+        if not current:
+            logger.warning('Ignoring the outdated index of {}'.format(filename))
+
+        return current
+
+
+    @classmethod
+    def open(cls, filename):
+        '''
+        Open a csv matrix through its index.
+        '''
+        assert cls.is_current(filename), "{} has no current index, run index_csv".format(filename)
+        with np.load(index_filename(filename)) as index:
+            return cls(filename, index['offsets'], index['row_ids'].astype(object),
+                index['col_ids'].astype(object))
+
+
+    def __len__(self):
+        return len(self.row_ids)
+
+
+    def read_row(self, row):
+        '''
+        Read and parse the line of a row position.
+        Returns: int64 array of times (-1 for unreachable)
+        '''
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        fields = os.pread(self.fd, end - start, start).rstrip(b'\r\n').split(b',')
+
+        return np.array(fields[1:]).astype(np.int64)
+
+
+    def get_loc(self, row, col):
+        '''
+        Return the time at a row, col position, or UNREACHABLE.
+        '''
+        return int(self.read_row(row)[col])
+
+
+    def get_locs(self, rows, cols):
+        '''
+        Vectorized get_loc over (broadcastable) arrays of positions,
+        reading each row needed once.
+        '''
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.int64),
+            np.asarray(cols, dtype=np.int64))
+        shape = rows.shape
+        rows, cols = rows.ravel(), cols.ravel()
+        values = np.empty(len(rows), dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        unique_rows, starts = np.unique(rows[order], return_index=True)
+        for row, needed in zip(unique_rows, np.split(order, starts[1:])):
+            values[needed] = self.read_row(row)[cols[needed]]
+
+        return values.reshape(shape)
+
+
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        return self.get_loc(self.row_index.get_loc(source), self.col_index.get_loc(dest))
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def index_csv(infile, outfile=None):
+    '''
+    Build the sidecar index of a csv matrix (the byte offset of every
+    row's line, the row ids and the column ids of the header) in one
+    streaming pass, without parsing any times. Returns the index filename.
+    '''
+    start_time = time.time()
+    if not outfile:
+        outfile = index_filename(infile)
+
+    stat = os.stat(infile)
+    offsets = []
+    row_ids = []
+    with open(infile, 'rb') as csvfile:
+        header = csvfile.readline()
+        col_ids = _csv_ids(header)[1:]
+        position = len(header)
+        for line in csvfile:
+            if line.strip():
+                offsets.append(position)
+                row_ids.append(line[:line.index(b',')].strip(b'"').decode('utf-8'))
+            position += len(line)
+    #the end of the last row
+    offsets.append(position)
+
+    with open(outfile, 'wb') as indexfile:
+        np.savez(indexfile, offsets=np.array(offsets, dtype=np.int64),
+            row_ids=np.array(row_ids, dtype=str), col_ids=np.array(col_ids, dtype=str),
+            csv_size=stat.st_size, csv_mtime=stat.st_mtime_ns)
+
+    logger.info('Indexed {:,} rows of {} in {:,.2f} seconds'.format(len(row_ids), infile,
+        time.time() - start_time))
+
+    return outfile
+
+
+def open_matrix(filename):
+    '''
+    Memory map a .tmat file, dense or packed.
+    '''
+    with open(filename, 'rb') as infile:
+        magic = infile.read(len(MAGIC))
+    if magic == PACKED_MAGIC:
+        return packedMatrix.open(filename)
+
+    return binaryMatrix.open(filename)
+
+
+def convert_csv(infile, outfile=None):
+    '''
+    Convert a csv matrix (as written by p2p) to a .tmat file,
+    a chunk of rows at a time. Returns the new filename.
+    '''
+    start_time = time.time()
+    if not outfile:
+        outfile = os.path.splitext(infile)[0] + '.tmat'
+
+    reader = pd.read_csv(infile, index_col=0, dtype=str, chunksize=CONVERT_CHUNK_ROWS)
+    writer = None
+    for chunk in reader:
+        if writer is None:
+            writer = binaryMatrixWriter(outfile, chunk.columns)
+        writer.write_rows(chunk.index, chunk.values.astype(np.int64))
+    if writer is None:
+        writer = binaryMatrixWriter(outfile, pd.read_csv(infile, index_col=0, nrows=0).columns)
+    writer.close()
+
+    logger.info('Converted {} to {} in {:,.2f} seconds'.format(infile, outfile,
+        time.time() - start_time))
+
+    return outfile
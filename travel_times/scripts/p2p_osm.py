@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+import xml.etree.ElementTree as ET
+from array import array
+import bz2, gzip, logging, re, time
+from NetworkQuery import WAY_FILTERS
+try:
+    import osmium
+except:
+    osmium = None
+
+# Build p2p networks from a local OSM extract (.osm, .osm.bz2, .osm.gz
+# or .osm.pbf) instead of the Overpass API. The file is streamed twice:
+# once for the ways that pass the network type's filters and once for
+# the coordinates of the nodes those ways use, so memory is bounded by
+# the size of the resulting network rather than the extract.
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371000 #meters
+
+#nodes read before unused ones are dropped
+NODE_BUFFER = 1000000
+
+#way tags carried over to the edges frame
+EDGE_TAGS = ['name', 'oneway', 'highway', 'maxspeed', 'service', 'junction']
+
+
+def way_passes(tags, network_type):
+    '''
+    True if a way with these tags belongs to the network type.
+    '''
+    if 'highway' not in tags:
+        return False
+    for tag, regex in WAY_FILTERS[network_type]:
+        if tag in tags and re.search(regex, tags[tag]):
+            return False
+
+    return True
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Great circle distance in meters between arrays of points.
+    '''
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _open(filename):
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _iter_xml(filename, element):
+    '''
+    Stream the node or way elements of an OSM XML file, yielding
+    (id, lat, lon) for nodes or (id, refs, tags) for ways.
+    '''
+    with _open(filename) as infile:
+        context = ET.iterparse(infile, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                continue
+            if elem.tag == element == 'node':
+                yield int(elem.get('id')), float(elem.get('lat')), float(elem.get('lon'))
+            elif elem.tag == element == 'way':
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+                yield int(elem.get('id')), refs, tags
+            root.clear()
+
+
+def _iter_pbf(filename, element):
+    '''
+    Stream the node or way elements of an OSM PBF file (needs pyosmium).
+    '''
+    assert osmium is not None, "reading .osm.pbf files requires pyosmium (pip3 install osmium)"
+    if element == 'node':
+        for n in osmium.FileProcessor(filename, osmium.osm.NODE):
+            yield n.id, n.location.lat, n.location.lon
+    else:
+        for w in osmium.FileProcessor(filename, osmium.osm.WAY):
+            yield w.id, [nd.ref for nd in w.nodes], {t.k: t.v for t in w.tags}
+
+
+def _iter_elements(filename, element):
+    if filename.endswith('.pbf'):
+        return _iter_pbf(filename, element)
+    return _iter_xml(filename, element)
+
+
+def network_from_file(filename, network_type, bbox=None):
+    '''
+    Load the network_type from a local OSM extract. If bbox (as in
+    TransitMatrix.bbox, two lat/lon corners) is given, only nodes inside
+    it and the edges between them are kept.
+    Returns: (nodes, edges) in the same layout as pandana's osm loader:
+    nodes indexed by OSM id with x (lon) and y (lat), edges with from,
+    to, distance (meters) and way tags.
+    '''
+    assert network_type in WAY_FILTERS, "network_type is not one of: {}".format(list(WAY_FILTERS))
+    start_time = time.time()
+
+    #pass 1: ways
+    way_refs = array('q')
+    way_ptr = array('q', [0])
+    way_tags = {tag: [] for tag in EDGE_TAGS}
+    n_ways = 0
+    for way_id, refs, tags in _iter_elements(filename, 'way'):
+        if len(refs) < 2 or not way_passes(tags, network_type):
+            continue
+        way_refs.extend(refs)
+        way_ptr.append(len(way_refs))
+        for tag in EDGE_TAGS:
+            way_tags[tag].append(tags.get(tag))
+        n_ways += 1
+
+    refs = np.frombuffer(way_refs, dtype=np.int64)
+    ptr = np.frombuffer(way_ptr, dtype=np.int64)
+    needed = np.unique(refs)
+
+    #pass 2: coordinates of the nodes used by those ways
+    ids = array('q')
+    lats = array('d')
+    lons = array('d')
+    buffer_limit = NODE_BUFFER
+    for node_id, lat, lon in _iter_elements(filename, 'node'):
+        ids.append(node_id)
+        lats.append(lat)
+        lons.append(lon)
+        #keep memory bounded on large extracts
+        if len(ids) >= buffer_limit:
+            ids, lats, lons = _keep_needed(ids, lats, lons, needed)
+            buffer_limit = max(NODE_BUFFER, 2 * len(ids))
+    ids, lats, lons = _keep_needed(ids, lats, lons, needed)
+    nodes = pd.DataFrame({'x': np.frombuffer(lons, dtype=np.float64),
+        'y': np.frombuffer(lats, dtype=np.float64)},
+        index=pd.Index(np.frombuffer(ids, dtype=np.int64), name='id'))
+    nodes = nodes[~nodes.index.duplicated()]
+
+    if bbox is not None:
+        lat_a, lon_a, lat_b, lon_b = bbox
+        inside = ((nodes['y'] >= min(lat_a, lat_b)) & (nodes['y'] <= max(lat_a, lat_b)) &
+                  (nodes['x'] >= min(lon_a, lon_b)) & (nodes['x'] <= max(lon_a, lon_b)))
+        nodes = nodes[inside]
+
+    #consecutive nodes of each way become an edge
+    way_of_ref = np.repeat(np.arange(n_ways), np.diff(ptr))
+    is_start = np.ones(len(refs), dtype=bool)
+    is_start[ptr[1:] - 1] = False
+    from_pos = np.flatnonzero(is_start)
+    from_ids = refs[from_pos]
+    to_ids = refs[from_pos + 1]
+    keep = np.isin(from_ids, nodes.index.values) & np.isin(to_ids, nodes.index.values)
+    from_ids = from_ids[keep]
+    to_ids = to_ids[keep]
+    edge_way = way_of_ref[from_pos[keep]]
+
+    from_xy = nodes.loc[from_ids]
+    to_xy = nodes.loc[to_ids]
+    edges = pd.DataFrame({'from': from_ids, 'to': to_ids,
+        'distance': haversine(from_xy['y'].values, from_xy['x'].values,
+            to_xy['y'].values, to_xy['x'].values)})
+    for tag in EDGE_TAGS:
+        edges[tag] = np.array(way_tags[tag], dtype=object)[edge_way] if n_ways else []
+    edges['oneway'] = edges['oneway'].fillna('no')
+    edges = edges.drop_duplicates(subset=['from', 'to'])
+    edges.index = pd.MultiIndex.from_arrays([edges['from'].values, edges['to'].values])
+
+    #drop nodes that aren't on any edge
+    used = np.union1d(edges['from'].values, edges['to'].values)
+    nodes = nodes[nodes.index.isin(used)]
+
+    logger.info('Loaded {} network with {:,} nodes and {:,} edges from {} in {:,.2f} seconds'.format(network_type,
+        len(nodes), len(edges), filename, time.time() - start_time))
+
+    return nodes, edges
+
+
+def _keep_needed(ids, lats, lons, needed):
+    '''
+    Drop buffered nodes that aren't used by any kept way.
+    '''
+    id_arr = np.frombuffer(ids, dtype=np.int64)
+    keep = np.isin(id_arr, needed)
+
+    return (array('q', id_arr[keep].tobytes()),
+            array('d', np.frombuffer(lats, dtype=np.float64)[keep].tobytes()),
+            array('d', np.frombuffer(lons, dtype=np.float64)[keep].tobytes()))
@@ -0,0 +1,126 @@
+import psutil
+import logging
+from p2p_engine import ROWS_PER_TASK
+from p2p_checkpoint import BLOCK_ROWS
+
+# Memory aware planning for p2p runs. Given the size of the network and of
+# the matrix, estimate what each search thread and the output will need
+# and pick the thread count, rows per search task, checkpoint block size
+# and whether the matrix can be held in memory, so the run stays within
+# a memory budget.
+
+logger = logging.getLogger(__name__)
+
+GB = 1073741824
+
+#share of the available memory used when no budget is given
+DEFAULT_BUDGET_SHARE = 0.8
+
+#smallest number of rows worth handing to a search task
+MIN_ROWS_PER_TASK = 4
+
+#bytes per matrix entry held in memory (int32 in both backends)
+MATRIX_ITEMSIZE = 4
+
+
+def graph_bytes(num_nodes, num_edges, backend):
+    '''
+    Estimated size of the directed search graph. num_edges counts
+    undirected edges, so assume both directions are present.
+    '''
+    directed_edges = 2 * num_edges
+    if backend == 'scipy':
+        #csr: int32 indptr, int32 indices and float64 weights
+        return 4 * (num_nodes + 1) + 12 * directed_edges
+    #adjacency list nodes (dest, weight, next) plus list heads
+    return 8 * num_nodes + 16 * directed_edges
+
+
+def search_bytes(num_nodes, rows_per_task, backend):
+    '''
+    Estimated working set of one search thread running rows_per_task
+    searches at once.
+    '''
+    if backend == 'scipy':
+        #a dense float64 row of distances per search, plus dijkstra's own
+        #per node arrays
+        return 8 * rows_per_task * num_nodes + 24 * num_nodes
+    #dist, heap and heap positions per thread
+    return 16 * num_nodes
+
+
+class runPlan(object):
+    '''
+    The resources chosen for a run.
+    '''
+    def __init__(self, num_threads, rows_per_task, block_rows, load_to_mem,
+        write_to_file, budget):
+        self.num_threads = num_threads
+        self.rows_per_task = rows_per_task
+        self.block_rows = block_rows
+        self.load_to_mem = load_to_mem
+        self.write_to_file = write_to_file
+        self.budget = budget
+
+
+def plan_run(num_nodes, num_edges, n_rows, n_cols, backend='scipy',
+    max_threads=1, load_to_mem=True, write_to_file=False, dense=True,
+    memory_budget=None, max_time=None):
+    '''
+    Choose the resources for a run within memory_budget (GB, defaults
+    to most of the available memory). dense is False when the matrix
+    won't be held as a dense array (json or max_time output). Each
+    decision is logged.
+    Returns: runPlan
+    '''
+    if memory_budget:
+        budget = int(memory_budget * GB)
+    else:
+        budget = int(DEFAULT_BUDGET_SHARE * psutil.virtual_memory().available)
+    graph = graph_bytes(num_nodes, num_edges, backend)
+    logger.info('Memory budget {:,.2f} GB, graph ~{:,.2f} GB'.format(budget / GB, graph / GB))
+
+    #the matrix itself (searches need at least half of the budget)
+    output = n_rows * n_cols * MATRIX_ITEMSIZE if dense else 0
+    if load_to_mem and output:
+        logger.info('Matrix needs ~{:,.2f} GB in memory'.format(output / GB))
+        if output + graph > budget / 2:
+            logger.warning('Matrix (~{:,.2f} GB) does not fit in the memory budget; writing it to file instead of loading it to memory'.format(output / GB))
+            load_to_mem = False
+            write_to_file = True
+    if not load_to_mem:
+        output = 0
+    #reversed searches without max_time hold every pair (float32) until
+    #the end, whatever the output (with it, only the pairs kept)
+    if backend == 'scipy' and max_time is None and n_cols < n_rows:
+        output += 4 * n_rows * n_cols
+    remaining = max(budget - output - graph, 0)
+
+    #threads (with more than one, each worker has its own copy of the graph)
+    rows_per_task = ROWS_PER_TASK
+    search = search_bytes(num_nodes, rows_per_task, backend)
+    num_threads = int(min(max_threads, remaining // (graph + search)))
+    if num_threads <= 1:
+        num_threads = 1
+        if search > remaining and backend == 'scipy':
+            rows_per_task = int((remaining - 24 * num_nodes) // (8 * max(num_nodes, 1)))
+            rows_per_task = max(MIN_ROWS_PER_TASK, min(rows_per_task, ROWS_PER_TASK))
+            search = search_bytes(num_nodes, rows_per_task, backend)
+            logger.warning('Searches only fit in the memory budget {} rows at a time'.format(rows_per_task))
+        elif search > remaining:
+            logger.warning('A single search thread may not fit in the memory budget')
+    per_thread = search + (graph if num_threads > 1 else 0)
+    if num_threads < max_threads:
+        logger.info('Using {} of {} threads (~{:,.2f} GB each) to stay within the memory budget'.format(num_threads,
+            max_threads, per_thread / GB))
+    else:
+        logger.info('Using {} threads (~{:,.2f} GB each)'.format(num_threads, per_thread / GB))
+
+    #checkpoint blocks are held by each worker until they are written
+    share = remaining // num_threads - per_thread
+    block_rows = int(min(BLOCK_ROWS, max(rows_per_task, share // max(2 * MATRIX_ITEMSIZE * n_cols, 1))))
+    if block_rows < BLOCK_ROWS:
+        logger.info('Using checkpoint blocks of {:,} rows'.format(block_rows))
+
+    return runPlan(num_threads, rows_per_task, block_rows, load_to_mem,
+        write_to_file, budget)
@@ -0,0 +1,391 @@
+import numpy as np
+import pandas as pd
+import http.client, http.server, socketserver
+import json, logging, os, socket, sys, threading, time
+from p2p import TransitMatrix
+from p2p_engine import UNREACHABLE
+
+# A local query service for p2p matrices. A matrixServer keeps matrices
+# loaded (.tmat files memory mapped) and answers batch lookups over
+# localhost HTTP or a Unix socket, so analysts on one machine can share a
+# single warm copy instead of each loading the matrix. A matrixClient
+# has the lookup methods of TransitMatrix, so it can stand in for one
+# (ModelData.load_sp_matrix uses it when P2P_SERVER is set).
+#
+# Requests are POSTed as JSON to /<operation>. Times come back as raw
+# int32 arrays (-1 for unreachable or unknown pairs), everything else as
+# JSON. Matrices are named by the real path of their file.
+
+logger = logging.getLogger(__name__)
+
+#address (host:port or a Unix socket path) ModelData looks for a server at
+SERVER_VARIABLE = 'P2P_SERVER'
+
+DEFAULT_PORT = 8750
+
+#seconds a client waits for an answer (loading a csv matrix can be slow)
+TIMEOUT = 600
+
+#rows looked up at a time for in range pairs
+WITHIN_ROWS = 1024
+
+
+def matrix_name(filename):
+    '''
+    The name a matrix file is served under.
+    '''
+    return os.path.realpath(filename)
+
+
+def _is_socket_path(address):
+    return ':' not in address
+
+
+def _k_fastest(times, ids, k):
+    '''
+    The k fastest reachable entries of a row of times (ties going to
+    the earlier column), as a DataFrame of dest, rank and seconds.
+    '''
+    reachable = np.flatnonzero(times != UNREACHABLE)
+    order = reachable[np.argsort(times[reachable], kind='stable')][:k]
+
+    return pd.DataFrame({'dest': np.asarray(ids)[order], 'rank': np.arange(len(order)),
+        'seconds': times[order]})
+
+
+class matrixServer(object):
+    '''
+    Serve the matrices in filenames (more can be opened by clients) at
+    address: 'host:port' (keep the host local, there is no
+    authentication) or the path of a Unix socket.
+    '''
+    def __init__(self, filenames=(), address='127.0.0.1:{}'.format(DEFAULT_PORT)):
+        self.address = address
+        self.matrices = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+        for filename in filenames:
+            self.open(filename)
+
+
+    def open(self, filename):
+        '''
+        Load a matrix (once) and return its name.
+        Raises: OSError if the matrix can't be loaded
+        '''
+        name = matrix_name(filename)
+        with self.lock:
+            if name not in self.matrices:
+                assert os.path.isfile(name), "no matrix file at {}".format(name)
+                start_time = time.time()
+                tm = TransitMatrix('walk', read_from_file=name, backend='scipy')
+                try:
+                    tm.process()
+                except SystemExit:
+                    #TransitMatrix exits when it can't read the matrix, which
+                    #would only end the thread of the request
+                    raise OSError('unable to load matrix from {}'.format(name))
+                self.matrices[name] = tm
+                logger.info('Loaded {} in {:,.2f} seconds'.format(name, time.time() - start_time))
+
+        return name
+
+
+    def info(self, name):
+        '''
+        Describe a loaded matrix.
+        '''
+        tmatrix = self.matrices[name].tmatrix
+
+        return {'name': name, 'rows': len(tmatrix.row_index), 'cols': len(tmatrix.col_index),
+            'nearest': tmatrix.nearest is not None}
+
+
+    def handle(self, operation, request):
+        '''
+        Answer one request.
+        Returns: numpy array of times, or a JSON-able object
+        '''
+        if operation == 'list':
+            return [self.info(name) for name in sorted(self.matrices)]
+        if operation == 'open':
+            return self.info(self.open(request['matrix']))
+
+        name = matrix_name(request['matrix'])
+        if name not in self.matrices:
+            raise KeyError('{} is not loaded'.format(name))
+        tm = self.matrices[name]
+        tmatrix = tm.tmatrix
+
+        if operation == 'ids':
+            return {'rows': tmatrix.row_index.tolist(), 'cols': tmatrix.col_index.tolist()}
+        if operation == 'get_many':
+            return tm.get_many(request['sources'], request['dests'])
+        if operation == 'submatrix':
+            return tm.get_submatrix(request['sources'], request['dests'])
+        if operation == 'row':
+            return tm.get_row(request['source']).values
+        if operation == 'col':
+            return tm.get_col(request['dest']).values
+        if operation == 'nearest':
+            #topk matrices keep their own ranking (with categories)
+            if tmatrix.nearest is not None:
+                df = tm.get_nearest(request['source'])
+                if request.get('k') is not None:
+                    df = df[df['rank'] < request['k']]
+            else:
+                df = _k_fastest(tm.get_row(request['source']).values, tmatrix.col_index,
+                    request['k'])
+            return df.to_dict(orient='list')
+        if operation == 'within':
+            sources = request.get('sources')
+            if sources is None:
+                sources = tmatrix.row_index.tolist()
+            sources = np.asarray(sources).astype(str)
+            pairs = {'source': [], 'dest': [], 'seconds': []}
+            #a few rows at a time, so a large matrix is never copied whole
+            for start in range(0, len(sources), WITHIN_ROWS):
+                block = sources[start:start + WITHIN_ROWS]
+                times = tm.get_submatrix(block, tmatrix.col_index)
+                rows, cols = np.nonzero((times != UNREACHABLE) & (times <= request['max_time']))
+                pairs['source'] += block[rows].tolist()
+                pairs['dest'] += tmatrix.col_index[cols].tolist()
+                pairs['seconds'] += times[rows, cols].tolist()
+            return pairs
+
+        raise ValueError('unknown operation: {}'.format(operation))
+
+
+    def serve_forever(self):
+        '''
+        Answer requests until interrupted.
+        '''
+        if _is_socket_path(self.address):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.httpd = _unixServer(self.address, _requestHandler)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            self.httpd = _tcpServer((host, int(port)), _requestHandler)
+        self.httpd.matrix_server = self
+        logger.info('Serving {:,} matrices at {}'.format(len(self.matrices), self.address))
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            if _is_socket_path(self.address) and os.path.exists(self.address):
+                os.remove(self.address)
+
+
+    def shutdown(self):
+        '''
+        Stop serve_forever (from another thread).
+        '''
+        if self.httpd:
+            self.httpd.shutdown()
+
+
+class _requestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        operation = self.path.strip('/')
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            result = self.server.matrix_server.handle(operation, request)
+        except KeyError as err:
+            logger.error('{}: {}'.format(operation, err))
+            return self._reply(404, 'application/json', json.dumps({'error': str(err)}).encode())
+        except OSError as err:
+            logger.error('{} failed: {}'.format(operation, err))
+            return self._reply(500, 'application/json', json.dumps({'error': str(err)}).encode())
+        except Exception as err:
+            logger.error('{} failed: {}'.format(operation, err))
+            return self._reply(400, 'application/json', json.dumps({'error': str(err)}).encode())
+
+        if isinstance(result, np.ndarray):
+            self._reply(200, 'application/octet-stream', result.astype('<i4').tobytes())
+        else:
+            self._reply(200, 'application/json', json.dumps(result).encode())
+
+
+    def _reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _tcpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _unixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        #BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class _unixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class matrixClient(object):
+    '''
+    A TransitMatrix like view of a matrix held by a matrixServer at
+    address. The server loads the matrix if it doesn't hold it yet.
+    Raises: OSError if no server answers at address
+    '''
+    def __init__(self, address, filename, timeout=TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.connection = None
+        self.matrix = matrix_name(filename)
+        self.info = self._request('open', {'matrix': self.matrix})
+        self._row_ids = None
+        self._col_ids = None
+
+
+    def _connect(self):
+        if _is_socket_path(self.address):
+            return _unixConnection(self.address, self.timeout)
+        host, port = self.address.rsplit(':', 1)
+
+        return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+
+    def _request(self, operation, request):
+        '''
+        POST a request (reusing the connection) and decode the answer.
+        '''
+        body = json.dumps(request).encode()
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self._connect()
+            try:
+                self.connection.request('POST', '/' + operation, body,
+                    {'Content-Type': 'application/json'})
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                #the server may have closed an idle connection
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise ValueError('{} failed: {}'.format(operation, json.loads(data)['error']))
+        if response.getheader('Content-Type') == 'application/octet-stream':
+            return np.frombuffer(data, dtype='<i4').astype(np.int64)
+
+        return json.loads(data)
+
+
+    def _ids(self):
+        if self._row_ids is None:
+            ids = self._request('ids', {'matrix': self.matrix})
+            self._row_ids = pd.Index(ids['rows'], dtype=object)
+            self._col_ids = pd.Index(ids['cols'], dtype=object)
+
+        return self._row_ids, self._col_ids
+
+
+    def get(self, source, dest):
+        '''
+        Fetch the time value associated with the source, dest pair.
+        '''
+        return int(self.get_many([source], [dest])[0])
+
+
+    def get_many(self, sources, dests):
+        '''
+        Fetch the time values for each (sources[i], dests[i]) pair.
+        Returns: numpy array (-1 for unreachable or unknown pairs)
+        '''
+        assert len(sources) == len(dests), "sources and dests must be the same length"
+        return self._request('get_many', {'matrix': self.matrix,
+            'sources': [str(source) for source in sources], 'dests': [str(dest) for dest in dests]})
+
+
+    def get_submatrix(self, source_ids, dest_ids):
+        '''
+        Fetch the times from every source to every dest.
+        Returns: numpy array of shape (len(source_ids), len(dest_ids))
+        '''
+        values = self._request('submatrix', {'matrix': self.matrix,
+            'sources': [str(source) for source in source_ids], 'dests': [str(dest) for dest in dest_ids]})
+
+        return values.reshape(len(source_ids), len(dest_ids))
+
+
+    def get_row(self, source):
+        '''
+        Fetch the times from source to every dest.
+        Returns: pandas Series indexed by dest id
+        '''
+        _, col_ids = self._ids()
+        return pd.Series(self._request('row', {'matrix': self.matrix, 'source': str(source)}),
+            index=col_ids)
+
+
+    def get_col(self, dest):
+        '''
+        Fetch the times from every source to dest.
+        Returns: pandas Series indexed by source id
+        '''
+        row_ids, _ = self._ids()
+        return pd.Series(self._request('col', {'matrix': self.matrix, 'dest': str(dest)}),
+            index=row_ids)
+
+
+    def get_nearest(self, source, k=None):
+        '''
+        Fetch the k nearest destinations of source (all of them kept by a
+        topk matrix if k isn't given).
+        Returns: pandas DataFrame of dest, (category,) rank and seconds
+        '''
+        assert k is not None or self.info['nearest'], "k is required for a full matrix"
+        return pd.DataFrame(self._request('nearest', {'matrix': self.matrix,
+            'source': str(source), 'k': k}))
+
+
+    def get_within(self, max_time, sources=None):
+        '''
+        Fetch the pairs within max_time (seconds) from sources (every
+        source if not given).
+        Returns: pandas DataFrame of source, dest and seconds
+        '''
+        request = {'matrix': self.matrix, 'max_time': max_time}
+        if sources is not None:
+            request['sources'] = [str(source) for source in sources]
+
+        return pd.DataFrame(self._request('within', request))
+
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    address = os.environ.get(SERVER_VARIABLE, '127.0.0.1:{}'.format(DEFAULT_PORT))
+    matrixServer(sys.argv[1:], address).serve_forever()
@@ -0,0 +1,217 @@
+import numpy as np
+import pandas as pd
+from pandana.loaders import osm
+from p2p_osm import network_from_file
+import json, logging, os, time
+
+# A local, persistent store of street networks for p2p. Each network_type
+# is filled once (from an OSM download or a local extract) and written to
+# disk with a grid index over its nodes, so the network for any bounding
+# box can later be cut out without any network access.
+
+logger = logging.getLogger(__name__)
+
+#size of a grid index cell, in degrees
+CELL_SIZE = 0.01
+
+
+def normalize_bbox(bbox):
+    '''
+    Return (lat_min, lon_min, lat_max, lon_max) for a bounding box
+    given as two (lat, lon) corners in any order, e.g. TransitMatrix.bbox.
+    '''
+    lat_a, lon_a, lat_b, lon_b = bbox
+
+    return (min(lat_a, lat_b), min(lon_a, lon_b), max(lat_a, lat_b), max(lon_a, lon_b))
+
+
+def bbox_contains(outer, inner):
+    '''
+    True if the normalized bbox inner lies entirely within outer.
+    '''
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+class gridIndex(object):
+    '''
+    A uniform grid over node coordinates. Nodes are kept sorted by
+    cell so each row of cells in a query is one contiguous range.
+    '''
+    def __init__(self, lat0, lon0, n_cols, keys):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.n_cols = n_cols
+        self.keys = keys
+
+    @classmethod
+    def build(cls, lat, lon):
+        '''
+        Index the given coordinates. Returns (index, order) where order
+        sorts the nodes into cell order.
+        '''
+        lat0 = float(lat.min()) if len(lat) else 0.0
+        lon0 = float(lon.min()) if len(lon) else 0.0
+        n_cols = int((lon.max() - lon0) / CELL_SIZE) + 2 if len(lon) else 1
+        keys = cls._rows(lat, lat0) * n_cols + cls._cols(lon, lon0)
+        order = np.argsort(keys, kind='stable')
+
+        return cls(lat0, lon0, n_cols, keys[order]), order
+
+    @staticmethod
+    def _rows(lat, lat0):
+        return np.floor((np.asarray(lat) - lat0) / CELL_SIZE).astype(np.int64)
+
+    @staticmethod
+    def _cols(lon, lon0):
+        return np.floor((np.asarray(lon) - lon0) / CELL_SIZE).astype(np.int64)
+
+    def query(self, bbox):
+        '''
+        Return the positions of nodes in cells touching the normalized bbox.
+        '''
+        row_0, row_1 = self._rows([bbox[0], bbox[2]], self.lat0)
+        col_0, col_1 = np.clip(self._cols([bbox[1], bbox[3]], self.lon0), 0, self.n_cols - 1)
+        rows = np.arange(max(row_0, 0), max(row_1 + 1, 0))
+        starts = np.searchsorted(self.keys, rows * self.n_cols + col_0)
+        ends = np.searchsorted(self.keys, rows * self.n_cols + col_1, side='right')
+        if not len(rows):
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+
+class NetworkStore(object):
+    '''
+    On disk store of nodes, edges (with their OSM tags) and the bounding
+    boxes they cover, for each network_type, under one directory.
+    '''
+    def __init__(self, directory='data/network_store'):
+        self.directory = directory
+        self._cache = {}
+
+
+    def _path(self, network_type, name):
+        return os.path.join(self.directory, network_type, name)
+
+
+    def _meta(self, network_type):
+        '''
+        Return the metadata (covered bounding boxes) for a network_type.
+        '''
+        filename = self._path(network_type, 'meta.json')
+        if not os.path.isfile(filename):
+            return {'bboxes': []}
+        with open(filename) as json_data:
+            return json.load(json_data)
+
+
+    def covers(self, network_type, bbox):
+        '''
+        True if the store holds the network_type for all of bbox.
+        '''
+        bbox = normalize_bbox(bbox)
+        return any(bbox_contains(covered, bbox) for covered in self._meta(network_type)['bboxes'])
+
+
+    def _load(self, network_type):
+        '''
+        Load (nodes, edges, index) for a network_type, from memory if possible.
+        '''
+        if network_type not in self._cache:
+            nodes = pd.read_pickle(self._path(network_type, 'nodes.pkl'))
+            edges = pd.read_pickle(self._path(network_type, 'edges.pkl'))
+            with np.load(self._path(network_type, 'index.npz')) as data:
+                index = gridIndex(float(data['lat0']), float(data['lon0']),
+                    int(data['n_cols']), data['keys'])
+            self._cache[network_type] = (nodes, edges, index)
+
+        return self._cache[network_type]
+
+
+    def add(self, network_type, nodes, edges, bbox):
+        '''
+        Merge a network (nodes indexed by OSM id with x=lon, y=lat, and
+        edges with from/to columns plus tags) covering bbox into the store.
+        '''
+        start_time = time.time()
+        meta = self._meta(network_type)
+        if meta['bboxes']:
+            old_nodes, old_edges, _ = self._load(network_type)
+            nodes = pd.concat([old_nodes, nodes])
+            edges = pd.concat([old_edges, edges])
+        nodes = nodes[~nodes.index.duplicated(keep='last')]
+        edges = edges.drop_duplicates(subset=['from', 'to'], keep='last')
+
+        index, order = gridIndex.build(nodes['y'].values, nodes['x'].values)
+        nodes = nodes.iloc[order]
+
+        os.makedirs(os.path.join(self.directory, network_type), exist_ok=True)
+        nodes.to_pickle(self._path(network_type, 'nodes.pkl'))
+        edges.to_pickle(self._path(network_type, 'edges.pkl'))
+        with open(self._path(network_type, 'index.npz'), 'wb') as outfile:
+            np.savez(outfile, lat0=index.lat0, lon0=index.lon0,
+                n_cols=index.n_cols, keys=index.keys)
+        meta['bboxes'].append(list(normalize_bbox(bbox)))
+        with open(self._path(network_type, 'meta.json'), 'w') as outfile:
+            json.dump(meta, outfile)
+        self._cache[network_type] = (nodes, edges, index)
+
+        logger.info('Stored {} network with {:,} nodes and {:,} edges in {:,.2f} seconds'.format(network_type,
+            len(nodes), len(edges), time.time() - start_time))
+
+
+    def fill_from_osm(self, network_type, bbox):
+        '''
+        Download the network_type for bbox from OSM and add it to the store.
+        '''
+        lat_min, lon_min, lat_max, lon_max = normalize_bbox(bbox)
+        nodes, edges = osm.network_from_bbox(lat_min, lon_min, lat_max, lon_max,
+            network_type=network_type)
+        self.add(network_type, nodes, edges, bbox)
+
+
+    def fill_from_file(self, network_type, filename, bbox=None):
+        '''
+        Load the network_type from a local OSM extract (.osm or .osm.pbf)
+        and add it to the store. The store is marked as covering bbox, or
+        the extent of the loaded nodes if bbox isn't given.
+        '''
+        nodes, edges = network_from_file(filename, network_type, bbox)
+        if bbox is None:
+            bbox = (nodes['y'].min(), nodes['x'].min(), nodes['y'].max(), nodes['x'].max())
+        self.add(network_type, nodes, edges, bbox)
+
+
+    def extract(self, network_type, bbox):
+        '''
+        Return (nodes, edges) of the stored network_type inside bbox.
+        Only edges with both ends inside bbox are kept.
+        '''
+        start_time = time.time()
+        bbox = normalize_bbox(bbox)
+        nodes, edges, index = self._load(network_type)
+        candidates = nodes.iloc[index.query(bbox)]
+        inside = ((candidates['y'] >= bbox[0]) & (candidates['y'] <= bbox[2]) &
+                  (candidates['x'] >= bbox[1]) & (candidates['x'] <= bbox[3]))
+        sub_nodes = candidates[inside.values]
+        keep = (np.isin(edges['from'].values, sub_nodes.index.values) &
+                np.isin(edges['to'].values, sub_nodes.index.values))
+        sub_edges = edges[keep]
+
+        logger.info('Extracted {:,} nodes and {:,} edges from the {} store in {:,.2f} seconds'.format(len(sub_nodes),
+            len(sub_edges), network_type, time.time() - start_time))
+
+        return sub_nodes.copy(), sub_edges.copy()
+
+
+    def get_network(self, network_type, bbox):
+        '''
+        Return (nodes, edges) for bbox, downloading and storing the
+        network first only if the store doesn't already cover bbox.
+        '''
+        if not self.covers(network_type, bbox):
+            logger.info('{} store does not cover {}, downloading from OSM'.format(network_type, bbox))
+            self.fill_from_osm(network_type, bbox)
+
+        return self.extract(network_type, bbox)
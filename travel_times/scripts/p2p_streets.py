@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+import hashlib, json, logging, os, re
+from collections import Counter
+from jellyfish import jaro_winkler
+
+# Street name matching for the p2p drive cost model. OSM street names are
+# matched to the names in a speed limit table exactly, after normalizing
+# directions and suffixes ("NORTH STATE STREET" -> "N STATE ST"), or by
+# Jaro-Winkler similarity against a few candidates that share character
+# n-grams with the name. Matches are cached on disk per speed limit table.
+# Speeds can also come from the maxspeed and highway tags of the edges.
+
+logger = logging.getLogger(__name__)
+
+#similarity needed for a near perfect/good fuzzy match
+GREAT_MATCH = 0.97
+GOOD_MATCH = 0.9
+
+#n-gram length used to find candidates, and candidates scored per name
+NGRAM = 3
+MAX_CANDIDATES = 20
+
+DIRECTIONS = {'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW'}
+
+SUFFIXES = {'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'BOULEVARD': 'BLVD',
+    'ROAD': 'RD', 'DRIVE': 'DR', 'LANE': 'LN', 'PLACE': 'PL', 'COURT': 'CT',
+    'PARKWAY': 'PKWY', 'HIGHWAY': 'HWY', 'EXPRESSWAY': 'EXPY', 'TERRACE': 'TER',
+    'CIRCLE': 'CIR', 'SQUARE': 'SQ', 'TRAIL': 'TRL', 'PLAZA': 'PLZ'}
+
+_STOPWORDS = set(DIRECTIONS.values()) | set(SUFFIXES.values()) | {'WAY'}
+
+#speeds (km/h, as in the cost model) for road classes whose speed is set
+#by the class rather than by the street; other classes are left to the
+#speed limit table
+HIGHWAY_SPEEDS = {'motorway': 90, 'motorway_link': 60, 'trunk': 70,
+    'trunk_link': 50, 'living_street': 10}
+
+MPH_TO_KMH = 1.609344
+
+
+def speed_limit_hash(filename, street_name, speed_limit):
+    '''
+    Return the sha1 of a speed limit table and the columns used from it.
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(chunk)
+    sha.update('\0{}\0{}'.format(street_name, speed_limit).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def normalize(name):
+    '''
+    Upper case a street name, drop punctuation and abbreviate
+    directions and suffixes.
+    '''
+    tokens = re.sub(r"[.,'#]", ' ', name.upper()).split()
+    tokens = [DIRECTIONS.get(token, SUFFIXES.get(token, token)) for token in tokens]
+
+    return ' '.join(tokens)
+
+
+def _ngrams(normalized):
+    '''
+    Character n-grams of the distinctive part of a normalized name
+    (without directions and suffixes, unless that's all there is).
+    '''
+    tokens = normalized.split()
+    core = [token for token in tokens if token not in _STOPWORDS] or tokens
+    padded = '#{}#'.format(' '.join(core))
+
+    return set(padded[i:i + NGRAM] for i in range(max(len(padded) - NGRAM + 1, 1)))
+
+
+class streetNameIndex(object):
+    '''
+    An n-gram index over the street names of a speed limit table.
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.by_normalized = {}
+        self.postings = {}
+        for position, name in enumerate(self.names):
+            normalized = normalize(name)
+            self.by_normalized.setdefault(normalized, name)
+            for gram in _ngrams(normalized):
+                self.postings.setdefault(gram, []).append(position)
+
+
+    def candidates(self, name):
+        '''
+        The names sharing the most n-grams with name (the
+        MAX_CANDIDATES best, and any tied with the last of them).
+        '''
+        shared = Counter()
+        for gram in _ngrams(normalize(name)):
+            shared.update(self.postings.get(gram, ()))
+        ranked = shared.most_common()
+        if len(ranked) > MAX_CANDIDATES:
+            cutoff = ranked[MAX_CANDIDATES - 1][1]
+            ranked = [(position, count) for position, count in ranked if count >= cutoff]
+
+        return [self.names[position] for position, _ in ranked]
+
+
+    def match(self, name):
+        '''
+        Find the table name for a street name.
+        Returns: (match or None, kind) where kind is one of 'normalized',
+        'great', 'good' or 'none'
+        '''
+        normalized = self.by_normalized.get(normalize(name))
+        if normalized is not None:
+            return normalized, 'normalized'
+
+        best_distance = 0
+        best_match = None
+        for potential_match in self.candidates(name):
+            distance = jaro_winkler(name, potential_match)
+            if distance > best_distance:
+                best_distance = distance
+                best_match = potential_match
+        if best_distance >= GREAT_MATCH:
+            return best_match, 'great'
+        if best_distance > GOOD_MATCH:
+            return best_match, 'good'
+
+        return None, 'none'
+
+
+def match_speed_limits(names, limits, cache_filename=None):
+    '''
+    Map street names to the speed limits in limits (dict of table
+    street name -> speed limit). Matches are read from and added to
+    cache_filename when given.
+    Returns: dict of name -> speed limit (None when unmatched) and a
+    Counter of match kinds ('perfect', 'normalized', 'great', 'good',
+    'none' and 'cached')
+    '''
+    cache = {}
+    if cache_filename and os.path.isfile(cache_filename):
+        with open(cache_filename) as json_data:
+            cache = json.load(json_data)
+
+    speeds = {}
+    counts = Counter()
+    index = None
+    for name in names:
+        if name in limits:
+            speeds[name] = limits[name]
+            counts['perfect'] += 1
+        elif name in cache:
+            speeds[name] = cache[name]
+            counts['cached'] += 1
+        else:
+            if index is None:
+                index = streetNameIndex(limits.keys())
+            match, kind = index.match(name)
+            speeds[name] = cache[name] = limits[match] if match is not None else None
+            counts[kind] += 1
+
+    #only names that needed matching are cached
+    if cache_filename and index is not None:
+        temp_filename = cache_filename + '.tmp'
+        with open(temp_filename, 'w') as outfile:
+            json.dump(cache, outfile, default=float)
+        os.replace(temp_filename, cache_filename)
+        logger.info('Wrote {:,} street name matches to: {}'.format(len(cache), cache_filename))
+
+    return speeds, counts
+
+
+def parse_maxspeed(maxspeed):
+    '''
+    Parse OSM maxspeed tags ("50", "30 mph", "50 km/h"; the first value
+    of a list) to km/h.
+    Returns: float array, NaN where the tag is missing or not a number
+    ("none", "signals", "US:urban")
+    '''
+    parts = pd.Series(maxspeed, dtype=object).astype(str).str.extract(r'^\s*(\d+(?:\.\d+)?)\s*(mph)?',
+        flags=re.IGNORECASE)
+    speed = parts[0].astype(float).values.copy()
+    speed[parts[1].notna().values] *= MPH_TO_KMH
+    speed[speed <= 0] = np.nan
+
+    return speed
+
+
+def highway_speeds(highway):
+    '''
+    The HIGHWAY_SPEEDS default for each OSM highway tag.
+    Returns: float array, NaN for other classes
+    '''
+    return pd.Series(highway, dtype=object).map(HIGHWAY_SPEEDS).astype(float).values
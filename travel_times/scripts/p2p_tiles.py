@@ -0,0 +1,126 @@
+import numpy as np
+import logging, multiprocessing, time
+from scipy.sparse.csgraph import dijkstra
+from p2p_engine import network_times, finalize_block, UNREACHABLE, ROWS_PER_TASK
+
+# Tiled matrix generation for p2p. When only pairs within max_time are
+# kept, the origins can be split into spatial tiles, and each tile only
+# needs the part of the network its origins reach within max_time (the
+# tile plus a halo). Tiles are searched on their own subnetworks in
+# parallel processes and their sparse results merged, so no process
+# runs searches over (or holds dense rows of) the whole network.
+
+logger = logging.getLogger(__name__)
+
+
+def tile_subnetwork(graph, sources, limit):
+    '''
+    Find the nodes within limit of any of the source nodes (the tile
+    and its halo) and the subgraph they induce. Every shortest path of
+    at most limit from a source stays within these nodes, so times
+    within limit are the same on the subgraph.
+    Returns: (boolean node mask, subgraph)
+    '''
+    dist = dijkstra(graph, directed=True, indices=np.unique(sources),
+        limit=limit, min_only=True)
+    inside = np.isfinite(dist)
+    subgraph = graph[inside][:, inside]
+
+    return inside, subgraph
+
+
+def _run_tile(task):
+    '''
+    Search a tile's subnetwork and keep the pairs within max_time.
+    Returns: (source positions, count per source, dest positions, times)
+    '''
+    rows, subgraph, src_loc, dst_cols, dst_loc, src_imp, dst_imp, max_time, rows_per_task = task
+    positions = []
+    counts = []
+    cols = []
+    times = []
+    for block_rows, block in network_times(subgraph, src_loc, dst_loc, 1, max_time,
+        None, rows_per_task):
+        result = finalize_block(block, src_loc[block_rows], dst_loc,
+            src_imp[block_rows], dst_imp, max_time)
+        keep = result != UNREACHABLE
+        positions.append(rows[block_rows])
+        counts.append(keep.sum(axis=1))
+        cols.append(dst_cols[np.nonzero(keep)[1]].astype(np.int32))
+        times.append(result[keep].astype(np.int32))
+
+    if not positions:
+        return rows[:0], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+
+    return np.concatenate(positions), np.concatenate(counts), np.concatenate(cols), np.concatenate(times)
+
+
+def _tile_tasks(graph, tiles, src_loc, dst_loc, src_imp, dst_imp, max_time, rows_per_task):
+    '''
+    Generator over the work for each tile: its origins and the
+    destinations on its subnetwork, by local node position.
+    '''
+    for tile in np.unique(tiles):
+        rows = np.flatnonzero(tiles == tile)
+        inside, subgraph = tile_subnetwork(graph, src_loc[rows], max_time)
+        new_loc = np.cumsum(inside) - 1
+        dst_cols = np.flatnonzero(inside[dst_loc])
+        logger.debug('Tile {}: {:,} origins, {:,} of {:,} nodes, {:,} destinations'.format(tile,
+            len(rows), subgraph.shape[0], graph.shape[0], len(dst_cols)))
+        yield (rows, subgraph, new_loc[src_loc[rows]], dst_cols, new_loc[dst_loc[dst_cols]],
+            src_imp[rows], dst_imp[dst_cols], max_time, rows_per_task)
+
+
+class tileSet(object):
+    '''
+    The spatial tile of each origin (labels, aligned with the primary
+    nn file).
+    '''
+    def __init__(self, labels):
+        self.labels = np.asarray(labels)
+
+
+    @classmethod
+    def from_xy(cls, xy, tile_size):
+        '''
+        Assign (N, 2) projected coordinates (meters) to square tiles of
+        tile_size meters.
+        '''
+        cells = np.floor((xy - xy.min(axis=0)) / tile_size).astype(np.int64)
+        _, labels = np.unique(cells, axis=0, return_inverse=True)
+
+        return cls(labels.ravel())
+
+
+    def __len__(self):
+        return len(np.unique(self.labels))
+
+
+    def results(self, graph, src_loc, dst_loc, src_imp, dst_imp, max_time,
+        num_threads=1, rows_per_task=ROWS_PER_TASK):
+        '''
+        Generator over (source positions, count per source, dest
+        positions, times) holding the pairs within max_time for each tile,
+        computed by num_threads processes.
+        '''
+        start_time = time.time()
+        tasks = _tile_tasks(graph, self.labels, src_loc, dst_loc, src_imp, dst_imp,
+            max_time, rows_per_task)
+        if num_threads > 1 and len(self) > 1:
+            pool = multiprocessing.Pool(min(num_threads, len(self)))
+            computed = pool.imap_unordered(_run_tile, tasks)
+        else:
+            pool = None
+            computed = (_run_tile(task) for task in tasks)
+
+        try:
+            for done, piece in enumerate(computed):
+                logger.debug('Finished tile {} of {}'.format(done + 1, len(self)))
+                yield piece
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        logger.info('Computed {:,} tiles in {:,.2f} seconds'.format(len(self),
+            time.time() - start_time))
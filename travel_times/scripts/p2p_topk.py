@@ -0,0 +1,127 @@
+import numpy as np
+import logging, time
+from p2p_engine import network_times, finalize_block, UNREACHABLE, ROWS_PER_TASK
+
+# Nearest destination (top-k) search for p2p. Instead of the full matrix,
+# only the k fastest destinations of each origin are kept (k per
+# destination category, if categories are given). Searches are bounded:
+# every origin is searched out to START_LIMIT seconds first, and only the
+# origins that haven't settled their k destinations within their limit
+# are searched again with a larger one. An origin's searches cover about
+# the area holding its k nearest destinations rather than the network.
+
+logger = logging.getLogger(__name__)
+
+#limit (seconds) of the first round of searches, and its growth per round
+START_LIMIT = 900
+LIMIT_GROWTH = 4
+
+#past this limit (seconds) the last round of searches is unbounded
+MAX_LIMIT = 86400
+
+#sorts after every reachable pair
+_NO_KEY = np.iinfo(np.int64).max
+
+
+def _k_fastest(result, cols, k):
+    '''
+    The (up to) k fastest reachable destinations among cols for each
+    row of a finalized block, ties going to the lower column.
+    Returns: (dest positions, times) as (rows, min(k, len(cols))) arrays
+    in rank order, and the count found per row
+    '''
+    n = len(cols)
+    times = result[:, cols]
+    keys = np.where(times != UNREACHABLE, times * n + np.arange(n), _NO_KEY)
+    if n > k:
+        keys = np.partition(keys, k - 1, axis=1)[:, :k]
+    keys.sort(axis=1)
+    found = keys != _NO_KEY
+
+    return cols[keys % n], keys // n, found.sum(axis=1)
+
+
+class nearestSearch(object):
+    '''
+    A top-k request: k destinations per origin, per category when
+    categories (one label per destination) are given.
+    '''
+    def __init__(self, k, categories=None):
+        assert k > 0, "k must be positive"
+        self.k = k
+        self.categories = None if categories is None else np.asarray(categories).astype(str)
+
+
+    def _groups(self, n_cols):
+        if self.categories is None:
+            return [np.arange(n_cols)]
+        assert len(self.categories) == n_cols, "need one category per destination"
+        return [np.flatnonzero(self.categories == label) for label in np.unique(self.categories)]
+
+
+    def results(self, graph, src_loc, dst_loc, src_imp, dst_imp, num_threads=1,
+        max_time=None, ch=None, rows_per_task=ROWS_PER_TASK, skip_same_node=False):
+        '''
+        Find the k fastest destinations of every origin, in rounds of
+        searches with a growing limit (capped at max_time, if given).
+        With skip_same_node, destinations on the origin's own node are
+        left out (a symmetric request would match every point to itself).
+        Returns: (source positions, rank, dest positions, times) arrays,
+        ordered by source, category and rank
+        '''
+        start_time = time.time()
+        groups = self._groups(len(dst_loc))
+        final_limit = max_time if max_time is not None else np.inf
+        limit = min(START_LIMIT, final_limit)
+        pending = np.arange(len(src_loc))
+        pieces = []
+        rounds = 0
+        while len(pending):
+            rounds += 1
+            last = limit >= final_limit
+            unfinished = []
+            for rows, times in network_times(graph, src_loc[pending], dst_loc, num_threads,
+                limit, ch, rows_per_task):
+                positions = pending[rows]
+                result = finalize_block(times, src_loc[positions], dst_loc,
+                    src_imp[positions], dst_imp, max_time)
+                if skip_same_node:
+                    result[src_loc[positions][:, None] == dst_loc[None, :]] = UNREACHABLE
+
+                done = np.ones(len(positions), dtype=bool)
+                found = []
+                for group, cols in enumerate(groups):
+                    dest, seconds, counts = _k_fastest(result, cols, self.k)
+                    #a destination not found is more than limit away over the
+                    #network, so it can't beat one found within limit (plus
+                    #the origin's last mile)
+                    if not last:
+                        done &= (counts == len(cols)) | ((counts >= self.k) &
+                            (seconds[:, -1] - src_imp[positions] < limit))
+                    found.append((group, dest, seconds, counts))
+
+                unfinished.append(positions[~done])
+                for group, dest, seconds, counts in found:
+                    keep = (np.arange(dest.shape[1])[None, :] < counts[:, None]) & done[:, None]
+                    entry_rows, rank = np.nonzero(keep)
+                    pieces.append((positions[entry_rows], np.full(len(rank), group), rank,
+                        dest[keep], seconds[keep]))
+
+            pending = np.concatenate(unfinished) if unfinished else pending[:0]
+            logger.info('Round {}: searched up to {} seconds, {:,} origins need a longer search'.format(rounds,
+                limit, len(pending)))
+            limit = limit * LIMIT_GROWTH
+            if limit > MAX_LIMIT:
+                limit = np.inf
+            limit = min(limit, final_limit)
+
+        if pieces:
+            source, group, rank, dest, seconds = (np.concatenate(column) for column in zip(*pieces))
+        else:
+            source, group, rank, dest, seconds = (np.zeros(0, dtype=np.int64) for _ in range(5))
+        order = np.lexsort((rank, group, source))
+        logger.info('Found {:,} nearest destinations for {:,} origins in {:,.2f} seconds'.format(len(order),
+            len(src_loc), time.time() - start_time))
+
+        return (source[order].astype(np.int32), rank[order].astype(np.int32),
+            dest[order].astype(np.int32), seconds[order].astype(np.int32))
@@ -0,0 +1,62 @@
+import os, shutil, sys
+import pytest
+
+#the scripts import each other as top level modules
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+#south west corner and spacing (degrees) of the test grid
+LAT0, LON0, STEP = 41.80, -87.70, 0.002
+
+
+def grid_osm(filename, n=8, tags=None):
+    '''
+    Write an n x n grid of two way streets as an OSM XML extract. Rows
+    are ways named 'ROW <i>', columns 'COL <j>'; tags maps a way name to
+    extra tags for it.
+    '''
+    tags = tags or {}
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for i in range(n):
+        for j in range(n):
+            lines.append('<node id="{}" lat="{}" lon="{}"/>'.format(i * n + j + 1,
+                LAT0 + i * STEP, LON0 + j * STEP))
+    ways = [('ROW {}'.format(i), [i * n + j + 1 for j in range(n)]) for i in range(n)]
+    ways += [('COL {}'.format(j), [i * n + j + 1 for i in range(n)]) for j in range(n)]
+    for way_id, (name, refs) in enumerate(ways, 1):
+        lines.append('<way id="{}">'.format(way_id))
+        lines += ['<nd ref="{}"/>'.format(ref) for ref in refs]
+        way_tags = dict({'highway': 'residential', 'name': name}, **tags.get(name, {}))
+        lines += ['<tag k="{}" v="{}"/>'.format(k, v) for k, v in way_tags.items()]
+        lines.append('</way>')
+    lines.append('</osm>')
+    with open(filename, 'w') as outfile:
+        outfile.write('\n'.join(lines))
+
+    return filename
+
+
+def points_csv(filename, prefix, cells, n=8):
+    '''
+    Write points (id, lat, lon) near the given (i, j) grid nodes.
+    '''
+    with open(filename, 'w') as outfile:
+        outfile.write('id,lat,lon\n')
+        for k, (i, j) in enumerate(cells):
+            outfile.write('{}{},{},{}\n'.format(prefix, k, LAT0 + i * STEP + 0.0002,
+                LON0 + j * STEP + 0.0001))
+
+    return filename
+
+
+HINTS = {'xcol': 'lat', 'ycol': 'lon', 'idx': 'id'}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    #p2p reads its parameters from, and writes its intermediate and
+    #output files under, the current directory
+    shutil.copy(os.path.join(SCRIPTS_DIR, 'p2p_parameters.json'), tmp_path)
+    os.makedirs(os.path.join(str(tmp_path), 'data', 'matrices'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
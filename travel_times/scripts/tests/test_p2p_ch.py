@@ -0,0 +1,52 @@
+import glob
+import pandas as pd
+import p2p
+from conftest import grid_osm, points_csv, HINTS
+
+
+def _run(workdir, cells, prefix, use_ch):
+    points = points_csv(str(workdir / '{}.csv'.format(prefix)), prefix, cells)
+    tm = p2p.TransitMatrix('walk', primary_input=points, primary_hints=HINTS,
+        backend='scipy', osm_file=str(workdir / 'grid.osm'), use_ch=use_ch,
+        write_to_file=True)
+    tm.process(output_filename=str(workdir / '{}_out.csv'.format(prefix)), cleanup=False)
+
+    return tm, pd.read_csv(workdir / '{}_out.csv'.format(prefix), index_col=0)
+
+
+def test_ch_reused_for_new_points(workdir):
+    grid_osm(str(workdir / 'grid.osm'))
+    #the same corners (so the same network), different points inside
+    corners = [(0, 0), (7, 7)]
+    first, first_matrix = _run(workdir, corners + [(2, 3), (5, 1)], 'p', True)
+    second, second_matrix = _run(workdir, corners + [(4, 6), (1, 5), (6, 2)], 'q', True)
+    assert len(glob.glob('data/**/ch_*.npz', recursive=True)) == 1
+
+    _, plain = _run(workdir, corners + [(4, 6), (1, 5), (6, 2)], 'r', False)
+    assert (second_matrix.values == plain.values).all()
+
+
+def test_num_edges_counts_one_way_edges_once(workdir, monkeypatch):
+    #one way streets around two sides of the grid, two way inside
+    tags = {'ROW 0': {'oneway': 'yes'}, 'COL 7': {'oneway': 'yes'}}
+    grid_osm(str(workdir / 'grid.osm'), tags=tags)
+    points = points_csv(str(workdir / 'p.csv'), 'p', [(0, 0), (7, 7), (3, 3)])
+    with open('speeds.csv', 'w') as outfile:
+        outfile.write('street,mph\n')
+        for k in range(8):
+            outfile.write('ROW {0},30\nCOL {0},30\n'.format(k))
+    answers = iter(['street', 'mph'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+
+    tm = p2p.TransitMatrix('drive', primary_input=points, primary_hints=HINTS,
+        backend='scipy', osm_file=str(workdir / 'grid.osm'))
+    tm.set_logging()
+    tm._load_all('speeds.csv')
+    tm._request_network()
+    tm._match_nn(False)
+    tm._simplify_network()
+    all_from, all_to, _ = tm.edge_list
+    pairs = set(zip(all_from.tolist(), all_to.tolist()))
+    one_way = sum((b, a) not in pairs for a, b in pairs)
+    assert one_way > 0
+    assert tm.num_edges == one_way + (len(pairs) - one_way) // 2
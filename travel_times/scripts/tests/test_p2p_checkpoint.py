@@ -0,0 +1,40 @@
+import pandas as pd
+import p2p
+from conftest import grid_osm, points_csv, HINTS
+
+
+def _run(workdir, primary, resume, output):
+    tm = p2p.TransitMatrix('walk', primary_input=str(primary), primary_hints=HINTS,
+        backend='scipy', osm_file=str(workdir / 'grid.osm'),
+        checkpoint_dir=str(workdir / 'ckpt'), resume=resume, write_to_file=True)
+    tm.process(output_filename=str(workdir / output), cleanup=False)
+
+    return pd.read_csv(workdir / output, index_col=0)
+
+
+def test_resume_with_changed_input_starts_over(workdir):
+    grid_osm(str(workdir / 'grid.osm'))
+    cells = [(1, 1), (2, 5), (6, 3), (4, 4), (7, 7)]
+    first = _run(workdir, points_csv(str(workdir / 'points.csv'), 'p', cells), False, 'first.csv')
+    assert list(first.index) == ['p{}'.format(k) for k in range(5)]
+
+    #same file, new ids and a moved point
+    cells[2] = (0, 7)
+    resumed = _run(workdir, points_csv(str(workdir / 'points.csv'), 'q', cells), True, 'resumed.csv')
+    assert list(resumed.index) == ['q{}'.format(k) for k in range(5)]
+    assert list(resumed.columns) == list(resumed.index)
+    assert resumed.loc['q0', 'q2'] != first.loc['p0', 'p2']
+
+
+def test_resume_with_same_input_reuses_checkpoint(workdir):
+    grid_osm(str(workdir / 'grid.osm'))
+    points = points_csv(str(workdir / 'points.csv'), 'p', [(1, 1), (2, 5), (6, 3)])
+    first = _run(workdir, points, False, 'first.csv')
+    tm = p2p.TransitMatrix('walk', primary_input=str(points), primary_hints=HINTS,
+        backend='scipy', osm_file=str(workdir / 'grid.osm'),
+        checkpoint_dir=str(workdir / 'ckpt'), resume=True)
+    tm.set_logging()
+    tm._load_all(None)
+    tm.checkpoint = p2p.blockCheckpoint(tm.checkpoint_dir)
+    assert tm._restore_checkpoint_inputs()
+    assert (_run(workdir, points, True, 'resumed.csv').values == first.values).all()
@@ -0,0 +1,39 @@
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+from p2p_engine import network_times, count_edges
+
+
+def _random_graph(num_nodes=300, num_edges=1200, seed=0):
+    rng = np.random.default_rng(seed)
+    from_loc = rng.integers(num_nodes, size=num_edges)
+    to_loc = rng.integers(num_nodes, size=num_edges)
+    impedence = rng.integers(1, 100, size=num_edges).astype(np.float64)
+
+    return scipy.sparse.csr_matrix((impedence, (from_loc, to_loc)), shape=(num_nodes, num_nodes))
+
+
+def _times(graph, sources, targets, limit):
+    times = np.full((len(sources), len(targets)), np.nan)
+    for positions, block in network_times(graph, sources, targets, limit=limit,
+        rows_per_task=16):
+        times[positions] = block
+
+    return times
+
+
+def test_reversed_searches_match_dijkstra():
+    graph = _random_graph()
+    rng = np.random.default_rng(1)
+    #more (and repeated) sources than targets, so searches run backwards
+    sources = rng.integers(graph.shape[0], size=150)
+    targets = rng.integers(graph.shape[0], size=20)
+    for limit in (np.inf, 120):
+        expected = dijkstra(graph, directed=True, indices=sources)[:, targets]
+        expected[expected > limit] = np.inf
+        assert np.array_equal(_times(graph, sources, targets, limit), expected)
+
+
+def test_count_edges():
+    #a two way pair, a one way edge and a self loop
+    assert count_edges([0, 1, 1, 2], [1, 0, 2, 2], 3) == 3
@@ -0,0 +1,36 @@
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from p2p_server import matrixServer, matrixClient
+
+
+@pytest.fixture
+def server(workdir):
+    address = str(workdir / 'p2p.sock')
+    server = matrixServer(address=address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while server.httpd is None:
+        thread.join(0.01)
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def test_unloadable_matrix_is_an_error(server, workdir):
+    (workdir / 'broken.npz').write_bytes(b'not a matrix')
+    with pytest.raises(ValueError, match='unable to load matrix'):
+        matrixClient(server.address, str(workdir / 'broken.npz'))
+
+    #the server keeps answering
+    pd.DataFrame([[0, 5], [7, 0]], index=['a', 'b'], columns=['a', 'b']).to_csv('good.csv')
+    client = matrixClient(server.address, str(workdir / 'good.csv'))
+    assert client.get('b', 'a') == 7
+    assert np.array_equal(client.get_many(['a', 'b'], ['b', 'a']), [5, 7])
+
+
+def test_unloadable_matrix_stops_startup(workdir):
+    (workdir / 'broken.npz').write_bytes(b'not a matrix')
+    with pytest.raises(OSError):
+        matrixServer([str(workdir / 'broken.npz')], str(workdir / 'p2p.sock'))
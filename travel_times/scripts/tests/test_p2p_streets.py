@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import json
+import p2p
+from p2p_streets import parse_maxspeed, MPH_TO_KMH
+
+
+def test_parse_maxspeed_units():
+    speeds = parse_maxspeed(['50', '30 mph', '50 km/h', 'none', None, '20;30'])
+    assert np.allclose(speeds[[0, 2, 5]], [50, 50, 20])
+    assert np.isclose(speeds[1], 30 * MPH_TO_KMH)
+    assert np.isnan(speeds[[3, 4]]).all()
+
+
+def test_same_street_speed_from_tag_and_table(workdir):
+    tm = p2p.TransitMatrix('drive')
+    tm.set_logging()
+    tm._load_parameters()
+    #both 30 mph streets, one tagged and one only in the table
+    tm.edges = pd.DataFrame({'name': ['TAGGED ST', 'TABLE ST', 'UNKNOWN ST'],
+        'maxspeed': ['30 mph', None, None], 'highway': ['residential'] * 3,
+        'distance': [500.0, 500.0, 500.0]})
+    tm.sl_data = pd.DataFrame({'street_name': ['TABLE ST'], 'speed_limit': [30]})
+    tm.sl_hash = '0' * 40
+    #earlier (cached) misses, so no name needs fuzzy matching
+    with open('data/street_names_{}.json'.format(tm.sl_hash[:16]), 'w') as outfile:
+        json.dump({'TAGGED ST': None, 'UNKNOWN ST': None}, outfile)
+    tm._clean_speed_limits()
+
+    assert np.allclose(tm.edge_speeds, [30 * MPH_TO_KMH, 30 * MPH_TO_KMH, 25 * MPH_TO_KMH])
+    impedence = tm._cost_model(tm.edges['distance'].values, tm.edge_speeds)
+    assert impedence[0] == impedence[1] == int(500 / (30 * MPH_TO_KMH / 3.6))